@@ -1,6 +1,14 @@
 # coding: utf-8
-from .import_serial import run
+__all__ = ['run', 'compute_statistics']
+__version__ = '0.8'
 
 
-__all__ = ['run']
-__version__ = '0.8'
+def __getattr__(name):
+    # CCTBX and NumPy are imported with `run` or the API, not with the package
+    if name == "run":
+        from .import_serial import run
+        return run
+    if name == "compute_statistics":
+        from .api import compute_statistics
+        return compute_statistics
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
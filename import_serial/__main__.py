@@ -1,4 +1,5 @@
 # coding: utf-8
-from .import_serial import run
+from .cli import main
 
-run()
+if __name__ == "__main__":
+    main()
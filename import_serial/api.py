@@ -0,0 +1,174 @@
+# coding: utf-8
+"""In-process API: statistics of merged serial MX data without running the
+command line program. Nothing is printed and no files are written unless
+requested, errors are raised as exceptions derived from `ImportSerialError`.
+
+    from import_serial.api import compute_statistics
+    result = compute_statistics("data.hkl", symmetry=("P21", (39.4, 78.5, 48.0, 90, 97.94, 90)),
+                                d_min=1.8, n_bins=20)
+    result.stats["overall"]["cc"]
+    result.miller_arrays()["IMEAN"]
+"""
+import io
+import os
+import shutil
+from .import_serial import ImportSerialError, InputError, SymmetryError, StatisticsError, \
+    get_hklin_format, find_half_dataset, read_reflections, load_reflection_table, \
+    stats_cache_key, calc_stats, write_stats, write_mtz_crystfel
+from .profiling import Profiler
+
+
+__all__ = ["compute_statistics", "StatisticsResult", "ImportSerialError", "InputError",
+           "SymmetryError", "StatisticsError"]
+
+
+class StatisticsResult:
+    """Statistics of one data set.
+
+    Attributes:
+        stats (dict): Statistics "overall" and "binned" (and "cumulative",
+            "sweep"), the same as in the JSON output of the program
+        table (ReflectionTable): Reflections after the resolution cutoff
+        hklin_format (str): "crystfel" or "dials" (xia2.ssx)
+        crystal_symmetry (cctbx.crystal.symmetry): Symmetry used
+        log (str): Text printed during the calculation (tables of statistics
+            and warnings)
+        performance (dict): Wall time, CPU time, peak memory and input
+            sizes of the stages, see `Profiler.as_dict()`
+    """
+    def __init__(self, stats, table, hklin, hklin_format, crystal_symmetry, log="",
+                 performance=None):
+        self.stats = stats
+        self.table = table
+        self.hklin = hklin
+        self.hklin_format = hklin_format
+        self.crystal_symmetry = crystal_symmetry
+        self.log = log
+        self.performance = performance
+
+    @property
+    def overall(self):
+        return self.stats["overall"]
+
+    @property
+    def binned(self):
+        return self.stats["binned"]
+
+    def miller_arrays(self):
+        """Returns:
+            dict: Miller arrays IMEAN (with sigmas) and NMEAS in the order
+                of the input file and IHALF1, IHALF2 (if available) in the
+                asymmetric unit
+        """
+        m_i, m_nmeas = self.table.input_order_arrays()
+        arrays = {"IMEAN": m_i, "NMEAS": m_nmeas}
+        if self.table.has_halves:
+            both = self.table.has_half1 & self.table.has_half2
+            arrays["IHALF1"] = self.table.miller_array("I_half1", selection=both)
+            arrays["IHALF2"] = self.table.miller_array("I_half2", selection=both)
+        return arrays
+
+    def write(self, hklout=None, jsonout=None, xmlout=None, wavelength=None):
+        """Writes the output files of the program, only those given.
+        Args:
+            hklout (str): MTZ file, a copy of the input file for xia2.ssx
+            jsonout (str): Statistics in JSON
+            xmlout (str): Statistics in XML for CCP4i2
+            wavelength (float): Wavelength, required for an MTZ file from
+                CrystFEL data
+        """
+        if jsonout or xmlout:
+            stats = self.stats
+            if self.performance:
+                stats = {**stats, "performance": self.performance}
+            write_stats(stats, jsonout or os.devnull, xmlout or os.devnull)
+        if hklout and self.hklin_format == "crystfel":
+            if not wavelength:
+                raise InputError("Wavelength is required to write an MTZ file from CrystFEL data")
+            write_mtz_crystfel(self.table, hklout, wavelength)
+        elif hklout:
+            shutil.copy2(self.hklin, hklout)
+
+
+def get_crystal_symmetry(symmetry, log=None):
+    """Crystal symmetry from a cctbx object, a tuple (space group, unit cell
+    parameters) or a reference file (PDB, mmCIF or MTZ, the symmetry found
+    is printed to `log`)."""
+    from cctbx import crystal
+    if symmetry is None or isinstance(symmetry, crystal.symmetry):
+        return symmetry
+    if isinstance(symmetry, (str, os.PathLike)):
+        from .import_serial import get_cs_reference
+        cs = get_cs_reference(str(symmetry), log or io.StringIO())[0]
+        if cs is None:
+            raise SymmetryError(f"Symmetry could not be found in the reference file {symmetry}")
+        return cs
+    try:
+        spacegroup, cell = symmetry
+        return crystal.symmetry(unit_cell=tuple(cell), space_group_symbol=str(spacegroup))
+    except (TypeError, ValueError, RuntimeError) as e:
+        raise SymmetryError(f"Invalid symmetry {symmetry!r}: {e}") from e
+
+
+def compute_statistics(hklin, half_dataset=None, symmetry=None, d_min=0, d_max=0, n_bins=10,
+                       sweep_dmin=None, sweep_shells=None, cc_min=None, ccstar_min=None,
+                       isigi_min=None, cache=None, verbose=False, profile=False):
+    """Calculates statistics of merged data from CrystFEL or xia2.ssx.
+    Args:
+        hklin (str): Merged reflection list from CrystFEL (.hkl) or MTZ file
+            from xia2.ssx
+        half_dataset (tuple): CrystFEL only: two half-data-set files, by
+            default .hkl1 and .hkl2 next to `hklin` are used if they exist
+        symmetry: CrystFEL only (required): cctbx.crystal.symmetry, a tuple
+            (space group, unit cell parameters) or a reference file
+        d_min, d_max (float): Resolution cutoffs, 0 for no cutoff
+        n_bins (int): Number of resolution bins
+        sweep_dmin, sweep_shells, cc_min, ccstar_min, isigi_min:
+            Resolution cutoff sweep, see `calc_stats()`
+        cache (Cache): Cache of parsed files and statistics
+        verbose (bool): Print the tables of statistics and warnings
+        profile (bool): Measure the peak memory of each stage separately
+    Returns:
+        StatisticsResult: Statistics, reflections and Miller arrays
+    Raises:
+        InputError: Missing, unreadable or empty input files
+        SymmetryError: Missing or invalid symmetry
+        StatisticsError: Statistics could not be calculated
+    """
+    hklin = str(hklin)
+    for filename in [hklin] + list(half_dataset or []):
+        if not os.path.isfile(filename):
+            raise InputError(f"The file {filename} does not exist")
+    hklin_format = get_hklin_format(hklin)
+    # printed output of this call only (not redirection of the process-wide
+    # standard output), so that calls in several threads do not mix
+    log = None if verbose else io.StringIO()
+    cs = get_crystal_symmetry(symmetry, log)
+    if hklin_format == "crystfel" and cs is None:
+        raise SymmetryError("Space group and unit cell parameters are required for CrystFEL data")
+    if hklin_format == "crystfel" and half_dataset is None:
+        half_dataset = find_half_dataset(hklin)
+
+    profiler = Profiler(profile)
+    try:
+        reflections = read_reflections(
+            hklin, hklin_format, half_dataset, cache, profiler, concurrent=True)
+    except ImportSerialError:
+        raise
+    except (OSError, RuntimeError, ValueError) as e:
+        raise InputError(f"Reflections could not be read from {hklin}: {e}") from e
+    try:
+        table, cs = load_reflection_table(
+            hklin, hklin_format, cs, half_dataset, d_max, d_min, n_bins, cache, profiler,
+            reflections, log=log)
+        stats_key = None
+        if cache:
+            stats_key = stats_cache_key(hklin, half_dataset, cs, d_max, d_min, n_bins)
+        stats = calc_stats(table, cache, stats_key, sweep_dmin, sweep_shells,
+                           cc_min, ccstar_min, isigi_min, profiler, log)
+    except ImportSerialError:
+        raise
+    except (RuntimeError, ValueError) as e:
+        raise StatisticsError(f"Statistics could not be calculated: {e}") from e
+    return StatisticsResult(stats, table, hklin, hklin_format, cs, log.getvalue() if log else "",
+                            profiler.as_dict())
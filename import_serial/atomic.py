@@ -0,0 +1,20 @@
+# coding: utf-8
+"""Atomic replacement of output files, so that readers (other programs or
+processes sharing the cache) never see a partially written file"""
+import contextlib
+import os
+import threading
+
+
+@contextlib.contextmanager
+def atomic_output(filename):
+    """Yields a temporary path next to `filename` (unique for the process
+    and thread) which replaces the file when the block succeeds. The
+    temporary file is removed if the block fails."""
+    tmp = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        yield tmp
+        os.replace(tmp, filename)
+    finally:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
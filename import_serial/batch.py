@@ -0,0 +1,287 @@
+# coding: utf-8
+"""Batch mode: statistics of many data sets listed in a manifest file,
+processed in a pool of worker processes"""
+import argparse
+import contextlib
+import csv
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+BATCH_SUMMARY = "batch_summary"  # file names of the combined summary (.json, .csv)
+BATCH_LOG = "import_serial.log"  # log file in the directory of each data set
+# options with paths that are made absolute (relative to the manifest file)
+PATH_OPTIONS = ("hklin", "half_dataset", "cellfile", "streamfile", "ref", "cache_dir", "profile_dir",
+                "results_db")
+
+
+def read_manifest(manifest):
+    """Reads a manifest with one data set per row: a CSV file with a header
+    or a JSON list of objects. Keys are names of the options of
+    `import_serial` (e.g. hklin, half_dataset, spacegroup, cell, reference,
+    dmin, dmax), an optional key "name" sets the output directory.
+    Args:
+        manifest (str): Path to the manifest file
+    Returns:
+        list: Dictionaries, empty values are left out
+    """
+    with open(manifest, "r", newline="") as f:
+        if manifest.lower().endswith(".json"):
+            rows = json.load(f)
+            if isinstance(rows, dict):
+                rows = rows["datasets"]
+        else:
+            rows = list(csv.DictReader(
+                (line for line in f if line.strip() and not line.startswith("#")),
+                skipinitialspace=True))
+    return [
+        {key.strip(): value for key, value in row.items()
+         if key and value is not None and value != "" and value is not False}
+        for row in rows]
+
+
+def _option_actions(parser):
+    actions = {}
+    for action in parser._actions:
+        for option in action.option_strings:
+            actions[option.lstrip("-").lower().replace("_", "-")] = action
+    return actions
+
+
+def absolute_paths(argv, parser, base_dir="."):
+    """Makes paths in command line arguments of `run()` absolute.
+    Args:
+        argv (list): Arguments
+        parser (MyArgumentParser): Parser from `get_parser()`
+        base_dir (str): Directory for relative paths
+    Returns:
+        list: Arguments
+    """
+    actions = _option_actions(parser)
+    argv = list(argv)
+    dest = None
+    for i, arg in enumerate(argv):
+        if arg.startswith("--"):
+            action = actions.get(arg.split("=")[0][2:].lower())
+            dest = action.dest if action else None
+        elif dest in PATH_OPTIONS:
+            argv[i] = os.path.join(os.path.abspath(base_dir), arg)
+    return argv
+
+
+def manifest_row_argv(row, parser, base_dir="."):
+    """Converts a row of a manifest to command line arguments of `run()`.
+    Args:
+        row (dict): Option names (with "_" or "-") and values, lists or
+            space-separated strings are used for options with several values
+        parser (MyArgumentParser): Parser from `get_parser()`
+        base_dir (str): Directory for relative paths
+    Returns:
+        list: Arguments
+    """
+    actions = _option_actions(parser)
+    argv = []
+    for key, value in row.items():
+        if key.lower() == "name":
+            continue
+        option = key.lstrip("-").lower().replace("_", "-")
+        if option not in actions:
+            raise ValueError(f"Unknown option in the manifest: {key}")
+        action = actions[option]
+        if action.nargs == 0:  # flags
+            if str(value).lower() in ("1", "true", "yes", "y"):
+                argv.append(action.option_strings[0])
+            continue
+        if isinstance(value, (list, tuple)):
+            values = [str(v) for v in value]
+        elif action.nargs is None:
+            values = [str(value).strip()]
+        else:
+            values = str(value).split()
+        if action.dest in PATH_OPTIONS:
+            values = [os.path.join(os.path.abspath(base_dir), v) for v in values]
+        argv += [action.option_strings[0]] + values
+    return argv
+
+
+def dataset_name(row, i):
+    """Name of the output directory of a data set."""
+    if row.get("name"):
+        name = str(row["name"])
+    elif row.get("project") or row.get("dataset"):
+        name = f"{row.get('project', 'project')}_{row.get('dataset', 'dataset')}"
+    else:
+        name = f"{i + 1:04d}_" + os.path.splitext(os.path.basename(str(row.get("hklin", ""))))[0]
+    return "".join(c for c in name if c not in r"\/:*?<>|")
+
+
+def process_dataset(name, argv, workdir):
+    """Runs `import_serial` for one data set in its own directory, the
+    printed output is saved to a log file there. Errors do not propagate.
+    Returns:
+        dict: Name, status, error message, time and overall statistics
+    """
+    from .import_serial import run
+    result = {"name": name, "status": "ok", "error": None, "directory": workdir}
+    start = time.perf_counter()
+    cwd = os.getcwd()
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    try:
+        with open(BATCH_LOG, "w") as log, \
+                contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+            stats = None
+            try:
+                stats = run(argv)
+            except SystemExit as e:
+                if e.code:
+                    result["status"] = "failed"
+                    result["error"] = f"Aborted with exit code {e.code}"
+            except Exception as e:
+                traceback.print_exc()
+                result["status"] = "failed"
+                result["error"] = f"{type(e).__name__}: {e}"
+        if stats is not None:
+            result["overall"] = stats["overall"]
+        elif result["status"] == "ok":
+            result["status"] = "failed"
+            result["error"] = "Statistics could not be calculated"
+    finally:
+        os.chdir(cwd)
+    result["time"] = round(time.perf_counter() - start, 2)
+    return result
+
+
+def run_datasets(tasks, nproc=1):
+    """Processes the data sets, in parallel if `nproc` > 1.
+    Args:
+        tasks (list): Tuples (name, argv, workdir)
+        nproc (int): Number of worker processes
+    Returns:
+        list: Results of `process_dataset()` in the order of `tasks`
+    """
+    results = [None] * len(tasks)
+
+    def report(i):
+        result = results[i]
+        message = f"  [{i + 1}/{len(tasks)}] {result['name']}: {result['status']}"
+        if result["error"]:
+            message += f" ({result['error']})"
+        print(message, flush=True)
+
+    if nproc <= 1:
+        for i, task in enumerate(tasks):
+            results[i] = process_dataset(*task)
+            report(i)
+        return results
+    with ProcessPoolExecutor(max_workers=nproc) as executor:
+        futures = {executor.submit(process_dataset, *task): i for i, task in enumerate(tasks)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:  # e.g. a crashed worker process
+                results[i] = {"name": tasks[i][0], "status": "failed",
+                              "error": f"{type(e).__name__}: {e}", "directory": tasks[i][2]}
+            report(i)
+    return results
+
+
+def write_summary(results, outdir):
+    """Writes the combined summary of all data sets as JSON and CSV
+    (one row per data set with overall statistics).
+    Returns:
+        tuple: Paths to the JSON and CSV files
+    """
+    jsonout = os.path.join(outdir, BATCH_SUMMARY + ".json")
+    csvout = os.path.join(outdir, BATCH_SUMMARY + ".csv")
+    with open(jsonout, "w") as f:
+        f.write(json.dumps(results, indent=4))
+    stats_keys = []
+    for result in results:
+        for key in result.get("overall", {}):
+            if key not in stats_keys:
+                stats_keys.append(key)
+    with open(csvout, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["name", "status", "time", "error"] + stats_keys)
+        for result in results:
+            overall = result.get("overall", {})
+            writer.writerow(
+                [result["name"], result["status"], result.get("time"), result["error"] or ""]
+                + [overall.get(key, "") for key in stats_keys])
+    return jsonout, csvout
+
+
+def run_batch(argv=None):
+    from .cli import get_parser
+    parser = argparse.ArgumentParser(
+        description="Calculate statistics of many data sets listed in a manifest file "
+                    "(CSV or JSON). Other options are passed to import_serial for all "
+                    "data sets, values in the manifest take precedence.",
+    )
+    parser.add_argument(
+        "manifest",
+        help="CSV file with a header or JSON list of objects, one data set per row "
+             "with options of import_serial as keys (e.g. hklin, half_dataset, spacegroup, "
+             "cell, reference, dmin, dmax) and an optional name of the output directory",
+    )
+    parser.add_argument(
+        "--nproc", "-j",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of worker processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--outdir", "-o",
+        type=str,
+        default="import_serial_batch",
+        help="Output directory with a subdirectory for each data set",
+    )
+    if argv is None:
+        argv = sys.argv[1:]
+    args, common_argv = parser.parse_known_args(argv)
+    if not os.path.isfile(args.manifest):
+        parser.error(f"The file {args.manifest} does not exist!")
+
+    import_serial_parser = get_parser()
+    base_dir = os.path.dirname(os.path.abspath(args.manifest))
+    common_argv = absolute_paths(common_argv, import_serial_parser)
+    rows = read_manifest(args.manifest)
+    outdir = os.path.abspath(args.outdir)
+    tasks = []
+    names = set()
+    for i, row in enumerate(rows):
+        name = dataset_name(row, i)
+        if name in names:
+            name = f"{name}_{i + 1}"
+        names.add(name)
+        try:
+            argv_row = manifest_row_argv(row, import_serial_parser, base_dir)
+        except ValueError as e:
+            sys.stderr.write(f"ERROR: Row {i + 1} of the manifest: {e}\nAborting.\n")
+            sys.exit(1)
+        tasks.append((name, common_argv + argv_row, os.path.join(outdir, name)))
+    os.makedirs(outdir, exist_ok=True)
+
+    print("")
+    print(f"Processing {len(tasks)} data sets from {args.manifest} "
+          f"using {min(args.nproc, len(tasks)) or 1} processes:")
+    start = time.perf_counter()
+    results = run_datasets(tasks, min(args.nproc, len(tasks)))
+    jsonout, csvout = write_summary(results, outdir)
+    n_failed = sum(result["status"] != "ok" for result in results)
+    print("")
+    print(f"Finished in {time.perf_counter() - start:.1f} s: "
+          f"{len(results) - n_failed} succeeded, {n_failed} failed")
+    print(f"Summary: {jsonout} {csvout}")
+    if n_failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run_batch()
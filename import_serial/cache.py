@@ -0,0 +1,158 @@
+# coding: utf-8
+"""Content-addressed cache of parsed reflection data and statistics"""
+import functools
+import hashlib
+import io
+import json
+import mmap
+import os
+import sys
+import zipfile
+from .atomic import atomic_output
+
+
+CACHE_VERSION = 2
+CACHE_SIZE_MB = 1024  # default size limit of the cache directory
+FINGERPRINT_MEMO_SIZE = 256  # number of memoized hashes of files
+
+
+@functools.lru_cache(maxsize=FINGERPRINT_MEMO_SIZE)
+def _content_hash(path, size, mtime_ns):
+    h = hashlib.blake2b(digest_size=20)
+    if size:
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+    return h.hexdigest()
+
+
+def file_fingerprint(filename):
+    """Hash of the content of a file, memoized (for the last
+    `FINGERPRINT_MEMO_SIZE` files) by path, size and modification time.
+    Args:
+        filename (str): Path to the file
+    Returns:
+        str: Hexadecimal hash
+    """
+    stat = os.stat(filename)
+    return _content_hash(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+
+def symmetry_key(cs):
+    """String identifying crystal symmetry: space group and unit cell."""
+    cell = " ".join(f"{p:.6g}" for p in cs.unit_cell().parameters())
+    return f"{cs.space_group_info().type().lookup_symbol()} {cell}"
+
+
+class Cache:
+    """Directory with cached numpy arrays (.npz) and JSON documents. Entries
+    are addressed by a hash of their key, e.g. fingerprints of the input
+    files, symmetry and parameters. The least recently used entries are
+    removed when the total size exceeds the limit.
+    """
+    def __init__(self, cache_dir, max_size_mb=CACHE_SIZE_MB):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """Hash of the key parts (strings or numbers)."""
+        h = hashlib.blake2b(digest_size=20)
+        h.update(repr((CACHE_VERSION,) + parts).encode())
+        return h.hexdigest()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.cache_dir, key[:2], key + suffix)
+
+    def _read(self, key, suffix, load):
+        path = self._path(key, suffix)
+        try:
+            result = load(path)
+            os.utime(path)  # mark as recently used
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def _write(self, key, suffix, save):
+        path = self._path(key, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_output(path) as tmp:
+            with open(tmp, "wb") as f:
+                save(f)
+        self.evict()
+
+    def get_arrays(self, key):
+        """Returns:
+            dict: Cached numpy arrays or None
+        """
+        import numpy as np
+
+        def load(path):
+            with np.load(path, allow_pickle=False) as npz:
+                return {name: npz[name] for name in npz.files}
+        return self._read(key, ".npz", load)
+
+    def put_arrays(self, key, arrays):
+        import numpy as np
+        self._write(key, ".npz", lambda f: np.savez(f, **arrays))
+
+    def get_json(self, key):
+        """Returns:
+            Cached JSON document or None
+        """
+        def load(path):
+            with open(path, "r") as f:
+                return json.load(f)
+        return self._read(key, ".json", load)
+
+    def put_json(self, key, document):
+        self._write(key, ".json", lambda f: f.write(json.dumps(document).encode()))
+
+    def call(self, key, function, *args, log=None):
+        """Memoizes the result (must be JSON serializable) and the printed
+        output of `function(*args, log=stream)`. The output is written to
+        `log` (default standard output), also if the result is found in
+        the cache.
+        """
+        cached = self.get_json(key)
+        if cached is not None:
+            (log or sys.stdout).write(cached["log"])
+            return cached["result"]
+        buffer = io.StringIO()
+        result = function(*args, log=buffer)
+        (log or sys.stdout).write(buffer.getvalue())
+        self.put_json(key, {"result": result, "log": buffer.getvalue()})
+        return result
+
+    def evict(self):
+        """Removes the least recently used entries above the size limit."""
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+                total += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def report(self):
+        return f"Cache {self.cache_dir}: {self.hits} hits, {self.misses} misses"
@@ -0,0 +1,270 @@
+# coding: utf-8
+"""Unit cell parameters of individual crystals from a CrystFEL stream file:
+a columnar table tied to images, robust estimates of the unit cell,
+clustering of similar cells (e.g. polymorphs or mis-indexed lattices) and
+histograms. All of them are vectorized over the crystals."""
+import numpy as np
+from .atomic import atomic_output
+
+
+CELL_PARAMETERS = ("a", "b", "c", "alpha", "beta", "gamma")
+CELL_ESTIMATES = {  # descriptions of the estimates
+    "mean": "mean",
+    "median": "median",
+    "trimmed": "trimmed mean",
+    "cluster": "median of the largest cluster",
+}
+CELL_TRIM = 0.1  # fraction of crystals removed from each side for the trimmed mean
+CELL_TOLERANCE = 0.01  # relative difference of cell parameters within a cluster
+CELL_MIN_CLUSTER = 0.02  # smallest cluster as a fraction of the crystals
+CELL_MAX_CLUSTERS = 5
+CELL_HISTOGRAM_BINS = 100
+MAD_SCALE = 1.4826  # MAD of a normal distribution as its standard deviation
+GRID_HASH = np.array([1, 1000003, 998244353, 2654435761, 40503, 2246822519], dtype=np.int64)
+
+
+class CellTable:
+    """Unit cell parameters of all crystals in a stream file with the image
+    filename and event of each crystal.
+
+    Attributes:
+        cells (numpy.ndarray): a, b, c (A), alpha, beta, gamma (deg) of each
+            crystal (n, 6), NaN if not found in the stream file
+        file (numpy.ndarray): Image filename of each crystal (index to
+            `filenames`)
+        event (numpy.ndarray): Event of each crystal (bytes)
+        filenames (list): Image filenames (bytes)
+    """
+    def __init__(self, cells, file, event, filenames):
+        self.cells = cells
+        self.file = file
+        self.event = event
+        self.filenames = filenames
+        self._labels = None
+
+    @classmethod
+    def from_index(cls, index):
+        """Table from a `StreamIndex` (cell lengths are converted from nm)."""
+        index.as_arrays()
+        chunk = index.crystals["chunk"]
+        cells = index.crystals["cell"] * np.array([10, 10, 10, 1, 1, 1])
+        return cls(cells, index.chunks["file"][chunk], index.chunks["event"][chunk],
+                   list(index.filenames))
+
+    def __len__(self):
+        return len(self.cells)
+
+    def image(self, i):
+        """Returns:
+            tuple: Image filename and event of a crystal (str)
+        """
+        return self.filenames[int(self.file[i])].decode(), bytes(self.event[i]).decode()
+
+    def complete(self):
+        """Returns:
+            numpy.ndarray: Mask of the crystals with all six parameters
+        """
+        return np.isfinite(self.cells).all(axis=1)
+
+    def cluster(self):
+        """Returns:
+            numpy.ndarray: Cluster of each crystal from `cluster_cells()`,
+            -1 also for crystals without all parameters
+        """
+        if self._labels is None:
+            complete = self.complete()
+            self._labels = np.full(len(self.cells), -1, dtype=np.int64)
+            self._labels[complete] = cluster_cells(self.cells[complete])
+        return self._labels
+
+    def save(self, filename, labels=None):
+        """Saves the table atomically in the numpy .npz format: a column for
+        each cell parameter (single precision), `image` (index to
+        `filenames`) and `event` of each crystal, image filenames,
+        histograms of the parameters (`<parameter>_edges` and
+        `<parameter>_counts`) and optionally cluster labels of crystals.
+        """
+        arrays = {
+            "image": self.file.astype(np.int32),
+            "event": np.asarray(self.event, dtype=bytes),
+            "filenames": np.array(self.filenames, dtype=bytes),
+        }
+        for i, name in enumerate(CELL_PARAMETERS):
+            arrays[name] = self.cells[:, i].astype(np.float32)
+        for name, (edges, counts) in cell_histograms(self.cells[self.complete()]).items():
+            arrays[name + "_edges"] = edges
+            arrays[name + "_counts"] = counts
+        if labels is not None:
+            arrays["cluster"] = labels.astype(np.int16)
+        save_npz(filename, arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """Loads a table saved with `save()`."""
+        with np.load(filename, allow_pickle=False) as arrays:
+            cells = np.column_stack([arrays[name].astype(np.float64)
+                                     for name in CELL_PARAMETERS])
+            return cls(cells, arrays["image"], arrays["event"],
+                       [bytes(f) for f in arrays["filenames"]])
+
+
+def trimmed_mean(cells, trim=CELL_TRIM):
+    """Mean of each parameter without the fraction `trim` of the lowest and
+    of the highest values."""
+    n = len(cells)
+    k = int(n * trim)
+    if n - 2 * k < 1:
+        return np.median(cells, axis=0)
+    return np.sort(cells, axis=0)[k:n - k].mean(axis=0)
+
+
+def median_abs_deviation(cells):
+    """Median absolute deviation of each parameter, scaled to the standard
+    deviation of a normal distribution."""
+    return MAD_SCALE * np.median(np.abs(cells - np.median(cells, axis=0)), axis=0)
+
+
+def cluster_cells(cells, tolerance=CELL_TOLERANCE, min_cluster=CELL_MIN_CLUSTER,
+                  max_clusters=CELL_MAX_CLUSTERS):
+    """Groups crystals with similar unit cells. The most populated cell of
+    a grid with the spacing of `tolerance` (relative to the median of each
+    parameter) seeds a cluster; crystals whose parameters all differ from
+    the median of the seed by at most `tolerance` form the cluster. This is
+    repeated for the remaining crystals, so the clusters are ordered by size
+    (approximately) and the crystals left over are outliers.
+    Args:
+        cells (numpy.ndarray): Cells (n, 6) without missing values
+        tolerance (float): Relative difference of parameters in a cluster
+        min_cluster (float): Smallest cluster as a fraction of the crystals
+        max_clusters (int): Maximum number of clusters
+    Returns:
+        numpy.ndarray: Cluster of each crystal, 0 for the first one, -1 for outliers
+    """
+    labels = np.full(len(cells), -1, dtype=np.int64)
+    if not len(cells):
+        return labels
+    scale = tolerance * np.abs(np.median(cells, axis=0))
+    x = cells / np.where(scale > 0, scale, tolerance)
+    remaining = np.arange(len(cells))
+    min_size = max(int(np.ceil(min_cluster * len(cells))), 1)
+    for cluster in range(max_clusters):
+        if remaining.size < min_size:
+            break
+        xr = x[remaining]
+        grid = np.floor(xr).astype(np.int64)
+        # grid cells hashed to one integer (sorting rows is much slower), a rare
+        # collision only affects the seed, the members are checked below
+        keys = grid @ GRID_HASH
+        values, counts = np.unique(keys, return_counts=True)
+        seed = grid[np.argmax(keys == values[np.argmax(counts)])] + 0.5
+        center = np.median(xr[np.abs(xr - seed).max(axis=1) <= 1], axis=0)
+        member = np.abs(xr - center).max(axis=1) <= 1
+        if np.count_nonzero(member) < min_size:
+            break
+        labels[remaining[member]] = cluster
+        remaining = remaining[~member]
+    return labels
+
+
+def robust_cell(cells, estimate="median", labels=None):
+    """Unit cell parameters estimated from the cells of all crystals.
+    Args:
+        cells (numpy.ndarray): Cells (n, 6) without missing values
+        estimate (str): "mean", "median", "trimmed" (mean without 10 % of
+            the lowest and highest values) or "cluster" (median of the
+            largest cluster of similar cells)
+        labels (numpy.ndarray): Clusters of the cells if already known
+    Returns:
+        numpy.ndarray: a, b, c, alpha, beta, gamma or None if there are no cells
+    """
+    if not len(cells):
+        return None
+    if estimate == "mean":
+        return cells.mean(axis=0)
+    if estimate == "median":
+        return np.median(cells, axis=0)
+    if estimate == "trimmed":
+        return trimmed_mean(cells)
+    if estimate == "cluster":
+        if labels is None:
+            labels = cluster_cells(cells)
+        if not np.any(labels == 0):
+            return np.median(cells, axis=0)
+        return np.median(cells[labels == 0], axis=0)
+    raise ValueError(f"Unknown estimate of the unit cell: {estimate}")
+
+
+def histograms(values, names, n_bins=CELL_HISTOGRAM_BINS):
+    """Histograms of the columns of `values` between their 0.5th and 99.5th
+    percentiles (values outside and missing values are not counted).
+    Args:
+        values (numpy.ndarray): Values (n, number of names)
+        names (tuple): Names of the columns
+        n_bins (int): Number of bins
+    Returns:
+        dict: Bin edges and counts by names
+    """
+    finite = np.isfinite(values)
+    if not finite.any(axis=0).all():
+        return {name: (np.zeros(n_bins + 1), np.zeros(n_bins, dtype=np.int64))
+                for name in names}
+    if finite.all():
+        low, high = np.percentile(values, [0.5, 99.5], axis=0)
+    else:
+        low, high = np.nanpercentile(values, [0.5, 99.5], axis=0)
+    width = np.where(high > low, (high - low) / n_bins, 1e-3)
+    with np.errstate(invalid="ignore"):
+        bins = np.floor((values - low) / width)
+    bins[values == low + width * n_bins] = n_bins - 1  # the upper edge is included
+    inside = finite & (bins >= 0) & (bins < n_bins)
+    # bins of all columns counted at once
+    bins = (bins[inside] + np.nonzero(inside)[1] * n_bins).astype(np.int64)
+    counts = np.bincount(bins, minlength=len(names) * n_bins).reshape(len(names), n_bins)
+    return {name: (low[i] + width[i] * np.arange(n_bins + 1), counts[i])
+            for i, name in enumerate(names)}
+
+
+def cell_histograms(cells, n_bins=CELL_HISTOGRAM_BINS):
+    """Histograms of the cell parameters, see `histograms()`.
+    Args:
+        cells (numpy.ndarray): Cells (n, 6) without missing values
+        n_bins (int): Number of bins
+    Returns:
+        dict: Bin edges and counts by parameters
+    """
+    return histograms(cells, CELL_PARAMETERS, n_bins)
+
+
+def save_npz(filename, arrays):
+    """Saves arrays to a .npz file atomically, readers never see a partial file."""
+    with atomic_output(filename) as tmp:
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+
+
+def cell_distribution(cells, labels=None):
+    """Summary of the distribution of the unit cells of crystals for the
+    JSON and XML outputs.
+    Args:
+        cells (numpy.ndarray): Cells (n, 6) without missing values
+        labels (numpy.ndarray): Clusters of the cells from `cluster_cells()`
+    Returns:
+        dict: Number of crystals, mean, median, trimmed mean and MAD of
+        the parameters (and the size and median of each cluster)
+    """
+    def parameters(values):
+        return {name: round(float(x), 3) for name, x in zip(CELL_PARAMETERS, values)}
+    distribution = {"n_crystals": len(cells)}
+    if not len(cells):
+        return distribution
+    distribution["mean"] = parameters(cells.mean(axis=0))
+    distribution["median"] = parameters(np.median(cells, axis=0))
+    distribution["trimmed_mean"] = parameters(trimmed_mean(cells))
+    distribution["mad"] = parameters(median_abs_deviation(cells))
+    if labels is not None:
+        distribution["clusters"] = [
+            {"n_crystals": int(np.count_nonzero(labels == i)),
+             "median": parameters(np.median(cells[labels == i], axis=0))}
+            for i in range(labels.max() + 1)]
+        distribution["n_outliers"] = int(np.count_nonzero(labels < 0))
+    return distribution
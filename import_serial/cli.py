@@ -0,0 +1,258 @@
+# coding: utf-8
+"""Command line interface. This module does not import any scientific
+libraries, so that the help message and errors in the arguments are shown
+without delay. CCTBX and NumPy are loaded only afterwards by `run()`."""
+import argparse
+import os
+import sys
+from .cache import CACHE_SIZE_MB
+
+
+class MyArgumentParser(argparse.ArgumentParser):
+    """ Helper class for `argparse`
+
+    It adds an attribute `add_argument_with_check` that check if file
+    given in argument exist but not open it.
+    Inspired by `https://codereview.stackexchange.com/questions/28608/
+    checking-if-cli-arguments-are-valid-files-directories-in-python`
+    """
+    def __is_valid_file(self, parser, arg):
+        """Checks if file
+        given in argument `arg` exists but does not open it.
+        If not, abort.
+
+        Args:
+            self
+            parser: parser of `argparse`
+            arg (str): argument of `argparse`
+
+        Returns:
+            str: Name of the checked file
+        """
+        if not os.path.isfile(arg):
+            parser.error('The file {} does not exist!'.format(arg))
+        else:
+            # File exists so return the filename
+            return arg
+
+    def add_argument_with_check(self, *args, **kwargs):
+        """New attribute for `argparse` that checks if file
+        given in argument exist but does not open it.
+        """
+        # Look for your FILE settings
+        # type = lambda x: self.__is_valid_file(self, x) # PEP8 E731
+        def type(x):
+            return self.__is_valid_file(self, x)
+        kwargs['type'] = type
+        self.add_argument(*args, **kwargs)
+
+    def error(self, message):
+        sys.stderr.write('error: %s\n' % message)
+        print('Run `ccp4-python -m import_serial -h` to show the help message.')
+        sys.exit(2)
+
+
+def get_parser():
+    """Returns:
+        MyArgumentParser: Parser of the command line arguments of `run()`
+    """
+    parser = MyArgumentParser(
+        description="Calculate statistics of serial MX data from xia2.ssx or CrystFEL and import them to CCP4"
+    )
+    parser.add_argument_with_check(
+        "--hklin", "--HKLIN",
+        help="Specify merged mtz file from xia2.ssx or merged hkl file from CrystFEL",
+        type=str,
+        required=True
+    )
+    parser.add_argument_with_check(
+        "--half-dataset",
+        metavar=("HKL1", "HKL2"),
+        help="CrystFEL only: two half-data-set merge files (usually .hkl1 and .hkl2)",
+        type=str,
+        nargs=2,
+    )
+    parser.add_argument(
+        "--wavelength", "-w",
+        type=float,
+        help="Wavelength (required for data from CrystFEL)",
+    )
+    parser.add_argument(
+        "--spacegroup",
+        type=str,
+        help="Space group",
+    )
+    parser.add_argument(
+        "--cell",
+        type=float,
+        nargs=6,
+        help="Unit cell parameters divided by spaces, e.g. 60 50 40 90 90 90",
+        metavar=("a", "b", "c", "alpha", "beta", "gamma"),
+    )
+    parser.add_argument_with_check(
+        "--cellfile",
+        help="Cell file from CrystFEL",
+        type=str,
+    )
+    parser.add_argument_with_check(
+        "--streamfile",
+        help="Stream file from CrystFEL",
+        type=str,
+    )
+    parser.add_argument(
+        "--stream-index",
+        action="store_true",
+        help="Build an index of the stream file next to it (or in ~/.cache/import_serial) "
+             "and reuse it in the next runs if the stream file has not changed",
+    )
+    parser.add_argument(
+        "--cell-estimate",
+        choices=("mean", "median", "trimmed", "cluster"),
+        help="Estimate of the unit cell parameters from the stream file: mean of all crystals "
+             "(default), median, trimmed mean (without 10 %% of the lowest and highest values) "
+             "or median of the largest cluster of similar unit cells",
+    )
+    parser.add_argument(
+        "--cell-table",
+        help="Save the unit cell parameters of all crystals in the stream file with their image "
+             "filenames and events, histograms of the parameters and cluster labels to this "
+             "file (NumPy .npz)",
+    )
+    parser.add_argument(
+        "--crystal-stats",
+        help="Save statistics of the reflection lists of all crystals in the stream file "
+             "(number of reflections, resolution limit, mean I/sigma(I) and profile radius) "
+             "with their image filenames and events and histograms to this file (NumPy .npz), "
+             "a summary is added to the JSON and XML outputs",
+    )
+    parser.add_argument(
+        "--stream-halves",
+        action="store_true",
+        help="CrystFEL only: if the half-data sets are not given or found, merge two random "
+             "halves of the crystals in the stream file (without scaling) for approximate "
+             "CC1/2, CC* and Rsplit",
+    )
+    parser.add_argument(
+        "--nproc",
+        type=int,
+        help="Number of processes used to scan the stream file",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Run the stages one after another (not concurrently), measure the peak memory "
+             "of each stage separately and print a table of the stages (wall time, CPU time "
+             "and peak memory are always saved in the JSON and XML outputs)",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        type=str,
+        help="Save cProfile statistics of each stage to this directory (implies --profile)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        help="Directory to cache parsed reflection files and calculated statistics "
+             "(addressed by the content of the input files) to speed up repeated runs",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=float,
+        help=f"Size limit of the cache directory in MB (default {CACHE_SIZE_MB}), "
+             "the least recently used entries are removed",
+    )
+    parser.add_argument(
+        "--results-db",
+        help="Append the statistics (overall and in resolution bins), fingerprints of the "
+             "input files, symmetry, resolution limits and timing of this run to this SQLite "
+             "database (can be shared by parallel jobs, query it with import_serial.results_db)",
+    )
+    parser.add_argument_with_check(
+        "--reference", "--ref", "--pdb", "--cif", "--mmcif",
+        metavar="REFERENCE",
+        help="Reference file (PDB, mmCIF or MTZ) to provide spacegroup and unit cell",
+        type=str,
+        dest="ref",
+    )
+    parser.add_argument(
+        "--dmin", "--highres",
+        type=float,
+        help="High-resolution cutoff",
+        default=0,
+        dest='d_min',
+    )
+    parser.add_argument(
+        "--dmax", "--lowres",
+        type=float,
+        help="Low-resolution cutoff",
+        default=0,
+        dest='d_max',
+    )
+    parser.add_argument(
+        "--nbins", "--nshells",
+        type=int,
+        help="Number of resolution bins",
+        default=10,
+        dest='n_bins',
+    )
+    parser.add_argument(
+        "--sweep-dmin",
+        type=float,
+        nargs="+",
+        metavar="D_MIN",
+        help="Calculate overall statistics for each of these high-resolution cutoffs "
+             "(from one load of the data)",
+    )
+    parser.add_argument(
+        "--sweep-shells",
+        type=int,
+        help="Calculate overall statistics for high-resolution cutoffs at the limits of "
+             "this number of shells with equal volume in reciprocal space "
+             "(default 50 if a threshold is given)",
+    )
+    parser.add_argument(
+        "--cc-min",
+        type=float,
+        help="Suggest a high-resolution cutoff with CC1/2 in the outer shell above this value",
+    )
+    parser.add_argument(
+        "--ccstar-min",
+        type=float,
+        help="Suggest a high-resolution cutoff with CC* in the outer shell above this value",
+    )
+    parser.add_argument(
+        "--isigi-min",
+        type=float,
+        help="Suggest a high-resolution cutoff with <I/sigma(I)> in the outer shell above this value",
+    )
+    parser.add_argument(
+        "--project",
+        type=str,
+        help="Project name",
+    )
+    parser.add_argument(
+        "--crystal",
+        type=str,
+        help="Crystal name",
+        dest='cryst',
+    )
+    parser.add_argument(
+        "--dataset",
+        type=str,
+        help="Dataset name",
+    )
+    return parser
+
+
+
+def main(argv=None):
+    """Entry point: validates the arguments and then runs `import_serial.run()`."""
+    if argv is None:
+        argv = sys.argv[1:]
+    get_parser().parse_args(argv)
+    from .import_serial import run
+    run(argv)
+
+
+if __name__ == "__main__":
+    main()
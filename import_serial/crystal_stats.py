@@ -0,0 +1,366 @@
+# coding: utf-8
+"""Statistics of the reflection lists of individual crystals in a CrystFEL
+stream file ("Reflections measured after indexing"): number of reflections,
+resolution limit, mean I/sigma(I) and profile radius of each crystal in
+a columnar table tied to images, with histograms and a summary."""
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from .cells import histograms, save_npz
+from .stream import open_stream, STREAM_WINDOW
+
+
+STREAM_REFLECTIONS_BEGIN = b"Reflections measured after indexing"
+STREAM_REFLECTIONS_END = b"End of reflections"
+STREAM_PROFILE_RADIUS_KEY = b"profile_radius = "  # nm^-1
+STREAM_RESOLUTION_KEY = b"diffraction_resolution_limit = "  # nm^-1
+CRYSTAL_STATS_COLUMNS = ("n_reflections", "resolution", "mean_i_over_sigma", "profile_radius")
+CRYSTAL_STATS_LABELS = {
+    "n_reflections": "Reflections per crystal",
+    "resolution": "Resolution limit (A)",
+    "mean_i_over_sigma": "Mean I/sigma(I)",
+    "profile_radius": "Profile radius (nm^-1)",
+}
+# CrystFEL writes the reflections of crystals with the format
+# "%4i %4i %4i %10.2f %10.2f %10.2f %10.2f %6.1f %6.1f %s"
+#    h    k    l          I   sigma(I)       peak background  fs/px  ss/px panel
+# (name, first character, last character + 1, decimal places); the fields
+# are also the first five words of a row
+STREAM_REFLECTION_FIELDS = (
+    ("h", 0, 4, 0),
+    ("k", 5, 9, 0),
+    ("l", 10, 14, 0),
+    ("I", 15, 25, 2),
+    ("sigma(I)", 26, 36, 2),
+)
+STREAM_REFLECTION_ROWS = 1 << 16  # rows converted at once
+
+
+def _lines_with_prefix(buf, line_starts, first_chars, prefix):
+    """Finds the lines that begin with `prefix` by comparing one character
+    after another only for the lines that matched so far.
+    Args:
+        buf (numpy.ndarray): Bytes (uint8)
+        line_starts (numpy.ndarray): Offsets of the lines in `buf`
+        first_chars (numpy.ndarray): First character of each line
+        prefix (bytes): Beginning of the lines
+    Returns:
+        numpy.ndarray: Indices of the lines in `line_starts`
+    """
+    lines = np.flatnonzero(first_chars == prefix[0])
+    lines = lines[line_starts[lines] + len(prefix) <= len(buf)]
+    for j, char in enumerate(prefix[1:], 1):
+        lines = lines[buf[line_starts[lines] + j] == char]
+    return lines
+
+
+def _numbers_at(buf, positions, width=16):
+    """Converts the words at `positions` in `buf` to numbers.
+    Returns:
+        numpy.ndarray: Numbers, NaN if a word is not a number
+    """
+    chars = buf[np.minimum(positions[:, None] + np.arange(width), len(buf) - 1)]
+    chars[np.cumsum(chars <= ord(" "), axis=1) > 0] = 0  # end at whitespace
+    words = chars.view(f"S{width}").ravel()
+    try:
+        return words.astype(np.float64)
+    except ValueError:
+        return np.array([_float(word) for word in words], dtype=np.float64)
+
+
+def _float(text):
+    try:
+        return float(text)
+    except ValueError:
+        return np.nan
+
+
+def _fixed_width_weights(fields):
+    """Place values of the characters of the fields (integers, so the
+    products are exact before the division by the power of ten), indicators
+    of the fields, separators and dots relative to the first field."""
+    first = fields[0][1]
+    width = fields[-1][2] - first
+    place_values = np.zeros((width, len(fields)))
+    indicators = np.zeros((width, len(fields)), dtype=np.float32)
+    dots = []
+    for i, (name, start, end, decimals) in enumerate(fields):
+        dot = end - decimals - 1 if decimals else None
+        if decimals:
+            dots.append(dot - first)
+        positions = [j for j in range(start, end) if j != dot]
+        for e, j in enumerate(reversed(positions)):
+            place_values[j - first, i] = 10.0 ** e
+        indicators[start - first:end - first, i] = 1
+    separators = [start - 1 for name, start, end, decimals in fields if start > 0] \
+        + [fields[-1][2]]
+    return place_values, indicators, separators, dots
+
+
+def parse_reflection_rows(buf, row_starts, row_ends, names=("I", "sigma(I)")):
+    """Parses columns of reflection rows of a stream file directly from
+    the raw bytes without splitting lines: the fixed-width fields are
+    converted to numbers with matrix products. Rows that are not in the
+    fixed-width format (e.g. values too large for the field) are split.
+    Args:
+        buf (numpy.ndarray): Bytes of a part of the stream file (uint8)
+        row_starts (numpy.ndarray): Offsets of the rows in `buf`
+        row_ends (numpy.ndarray): Offsets of the ends of the rows (newline)
+        names (tuple): Columns from `STREAM_REFLECTION_FIELDS`, in their order
+    Returns:
+        dict: numpy arrays (float64) by names, NaN in all columns of a row
+        that could not be parsed
+    """
+    fields = [field for field in STREAM_REFLECTION_FIELDS if field[0] in names]
+    words = [i for i, field in enumerate(STREAM_REFLECTION_FIELDS) if field[0] in names]
+    place_values, indicators, separators, dots = _fixed_width_weights(fields)
+    first = fields[0][1]
+    offsets = np.arange(first, first + len(place_values))
+    scale = np.array([10.0 ** decimals for name, start, end, decimals in fields])
+    values = np.full((len(row_starts), len(fields)), np.nan)
+    fixed = row_ends - row_starts > separators[-1]
+    for start in range(0, len(row_starts), STREAM_REFLECTION_ROWS):
+        stop = start + STREAM_REFLECTION_ROWS
+        rows = np.flatnonzero(fixed[start:stop]) + start
+        row_start = row_starts[rows]
+        chars = buf[row_start[:, None] + offsets]
+        # only spaces, minus signs and digits, dots and separators at the expected places
+        valid = (chars - np.uint8(ord("0"))) <= 9
+        valid |= chars == ord(" ")
+        valid |= chars == ord("-")
+        valid[:, dots] = chars[:, dots] == ord(".")
+        valid = valid.all(axis=1) & (buf[row_start[:, None] + separators] == ord(" ")).all(axis=1)
+        fixed[rows[~valid]] = False
+        rows, chars = rows[valid], chars[valid]
+        digits = np.maximum(chars, np.uint8(ord("0"))) - np.uint8(ord("0"))
+        digits[:, dots] = 0
+        value = (digits @ place_values) / scale
+        minus = (chars == ord("-")).astype(np.float32) @ indicators
+        np.negative(value, out=value, where=minus > 0)
+        values[rows] = value
+    for row in np.flatnonzero(~fixed):
+        items = bytes(buf[row_starts[row]:row_ends[row]]).split()
+        try:
+            values[row] = [float(items[i]) for i in words]
+        except (ValueError, IndexError):
+            pass
+    return {name: values[:, i] for i, (name, start, end, decimals) in enumerate(fields)}
+
+
+def stream_windows(mm, begins, ends):
+    """Splits crystals of a memory-mapped stream file into windows of at
+    most `STREAM_WINDOW` bytes (or one crystal) and finds all lines of
+    each window at once.
+    Args:
+        mm (mmap.mmap): Memory-mapped stream file
+        begins (numpy.ndarray): Offsets of the lines "--- Begin crystal"
+        ends (numpy.ndarray): Offsets of the ends of the crystals
+    Yields:
+        tuple: First and last + 1 crystal of the window, bytes of the window
+        (uint8, valid until the next window), offsets of its lines and
+        a function that finds the first line beginning with a key in each
+        crystal (returns the crystals, relative to the first one, and
+        the indices of the lines)
+    """
+    n = len(begins)
+    first = 0
+    while first < n:
+        last = max(int(np.searchsorted(ends, begins[first] + STREAM_WINDOW, "right")), first + 1)
+        offset = int(begins[first])
+        crystal_begins = begins[first:last] - offset
+        crystal_ends = ends[first:last] - offset
+        buf = np.frombuffer(mm, dtype=np.uint8, count=int(ends[last - 1]) - offset, offset=offset)
+        line_starts = np.concatenate(([0], np.flatnonzero(buf == ord("\n")) + 1))
+        first_chars = buf[np.minimum(line_starts, len(buf) - 1)]
+
+        def find(key):
+            lines = _lines_with_prefix(buf, line_starts, first_chars, key)
+            crystal = np.searchsorted(crystal_begins, line_starts[lines], "right") - 1
+            inside = line_starts[lines] < crystal_ends[crystal]
+            crystal, index = np.unique(crystal[inside], return_index=True)
+            return crystal, lines[inside][index]
+
+        yield first, last, buf, line_starts, find
+        del buf, first_chars, find  # the memory map can be closed only without exported buffers
+        first = last
+
+
+def reflection_rows(find, n_crystals):
+    """Reflection rows of the crystals of a window from `stream_windows()`:
+    the lines after the names of the columns until "End of reflections".
+    Returns:
+        tuple: Crystal (relative to the window) and line of each row, and
+        the mask of the crystals with a reflection list
+    """
+    row_first = np.zeros(n_crystals, dtype=np.int64)
+    row_last = np.zeros(n_crystals, dtype=np.int64)
+    crystal, lines = find(STREAM_REFLECTIONS_BEGIN)
+    row_first[crystal] = lines + 2
+    row_last[crystal] = lines + 2
+    has_reflections = np.zeros(n_crystals, dtype=bool)
+    has_reflections[crystal] = True
+    crystal, lines = find(STREAM_REFLECTIONS_END)
+    row_last[crystal] = lines
+    n_rows = np.maximum(row_last - row_first, 0)
+    crystal = np.repeat(np.arange(n_crystals), n_rows)
+    rows = np.arange(n_rows.sum()) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows) \
+        + np.repeat(row_first, n_rows)
+    return crystal, rows, has_reflections
+
+
+def crystal_stats_part(mm, begins, ends):
+    """Statistics of crystals in a memory-mapped stream file. In each window
+    of `stream_windows()`, the lines with the keys are selected by their
+    first characters and the reflection rows of all crystals are parsed
+    together, without a loop over lines or crystals.
+    Args:
+        mm (mmap.mmap): Memory-mapped stream file
+        begins (numpy.ndarray): Offsets of the lines "--- Begin crystal"
+        ends (numpy.ndarray): Offsets of the ends of the crystals
+    Returns:
+        numpy.ndarray: Columns `CRYSTAL_STATS_COLUMNS` of each crystal (n, 4)
+    """
+    stats = np.full((len(begins), len(CRYSTAL_STATS_COLUMNS)), np.nan)
+    for first, last, buf, line_starts, find in stream_windows(mm, begins, ends):
+        stats_window = stats[first:last]
+        for column, key in ((1, STREAM_RESOLUTION_KEY), (3, STREAM_PROFILE_RADIUS_KEY)):
+            crystal, lines = find(key)
+            stats_window[crystal, column] = _numbers_at(buf, line_starts[lines] + len(key))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            stats_window[:, 1] = np.where(stats_window[:, 1] > 0, 10 / stats_window[:, 1], np.nan)
+        crystal, rows, has_reflections = reflection_rows(find, last - first)
+        columns = parse_reflection_rows(buf, line_starts[rows], line_starts[rows + 1] - 1)
+        intensity, sigma = columns["I"], columns["sigma(I)"]
+        measured = sigma > 0
+        i_over_sigma = np.bincount(crystal[measured], intensity[measured] / sigma[measured],
+                                   minlength=last - first)
+        n_measured = np.bincount(crystal[measured], minlength=last - first)
+        n_rows = np.bincount(crystal, minlength=last - first)
+        stats_window[:, 0] = np.where(has_reflections, n_rows, np.nan)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            stats_window[:, 2] = np.where(n_measured > 0, i_over_sigma / n_measured, np.nan)
+    return stats
+
+
+def _crystal_stats_streamfile_part(streamfile, begins, ends):
+    mm = open_stream(streamfile)
+    try:
+        return crystal_stats_part(mm, begins, ends)
+    finally:
+        mm.close()
+
+
+class CrystalStatsTable:
+    """Statistics of the reflection lists of all crystals in a stream file
+    with the image filename and event of each crystal.
+
+    Attributes:
+        stats (numpy.ndarray): Number of reflections, resolution limit (A),
+            mean I/sigma(I) and profile radius (nm^-1) of each crystal
+            (n, 4), NaN if not found in the stream file
+        file (numpy.ndarray): Image filename of each crystal (index to
+            `filenames`)
+        event (numpy.ndarray): Event of each crystal (bytes)
+        filenames (list): Image filenames (bytes)
+    """
+    def __init__(self, stats, file, event, filenames):
+        self.stats = stats
+        self.file = file
+        self.event = event
+        self.filenames = filenames
+
+    @classmethod
+    def from_index(cls, index, nproc=1):
+        """Reads the reflection lists of all crystals in an indexed stream
+        file, in a pool of processes if `nproc` > 1."""
+        index.as_arrays()
+        begins, ends = index.crystals["begin"], index.crystals["end"]
+        if not len(begins):
+            stats = np.zeros((0, len(CRYSTAL_STATS_COLUMNS)))
+        elif nproc > 1:
+            parts = np.array_split(np.arange(len(begins)), nproc * 4)
+            with ProcessPoolExecutor(max_workers=nproc) as executor:
+                futures = [executor.submit(_crystal_stats_streamfile_part, index.streamfile,
+                                           begins[part], ends[part])
+                           for part in parts if len(part)]
+                stats = np.concatenate([future.result() for future in futures])
+        else:
+            stats = _crystal_stats_streamfile_part(index.streamfile, begins, ends)
+        chunk = index.crystals["chunk"]
+        return cls(stats, index.chunks["file"][chunk], index.chunks["event"][chunk],
+                   list(index.filenames))
+
+    def __len__(self):
+        return len(self.stats)
+
+    def column(self, name):
+        return self.stats[:, CRYSTAL_STATS_COLUMNS.index(name)]
+
+    def image(self, i):
+        """Returns:
+            tuple: Image filename and event of a crystal (str)
+        """
+        return self.filenames[int(self.file[i])].decode(), bytes(self.event[i]).decode()
+
+    def save(self, filename):
+        """Saves the table atomically in the numpy .npz format: a column for
+        each statistic, `image` (index to `filenames`) and `event` of each
+        crystal, image filenames and histograms of the statistics
+        (`<statistic>_edges` and `<statistic>_counts`).
+        """
+        arrays = {
+            "image": self.file.astype(np.int32),
+            "event": np.asarray(self.event, dtype=bytes),
+            "filenames": np.array(self.filenames, dtype=bytes),
+        }
+        for i, name in enumerate(CRYSTAL_STATS_COLUMNS):
+            arrays[name] = self.stats[:, i].astype(np.float32)
+        for name, (edges, counts) in histograms(self.stats, CRYSTAL_STATS_COLUMNS).items():
+            arrays[name + "_edges"] = edges
+            arrays[name + "_counts"] = counts
+        save_npz(filename, arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """Loads a table saved with `save()`."""
+        with np.load(filename, allow_pickle=False) as arrays:
+            stats = np.column_stack([arrays[name].astype(np.float64)
+                                     for name in CRYSTAL_STATS_COLUMNS])
+            return cls(stats, arrays["image"], arrays["event"],
+                       [bytes(f) for f in arrays["filenames"]])
+
+    def summary(self):
+        """Summary for the JSON and XML outputs.
+        Returns:
+            dict: Number of crystals and reflections, mean, median, minimum
+            and maximum of each statistic
+        """
+        summary = {
+            "n_crystals": len(self),
+            "n_reflections_total": int(np.nansum(self.column("n_reflections"))),
+        }
+        for i, name in enumerate(CRYSTAL_STATS_COLUMNS):
+            values = self.stats[:, i]
+            values = values[np.isfinite(values)]
+            if not len(values):
+                continue
+            digits = 5 if name == "profile_radius" else 2
+            summary[name] = {
+                "mean": round(float(values.mean()), digits),
+                "median": round(float(np.median(values)), digits),
+                "min": round(float(values.min()), digits),
+                "max": round(float(values.max()), digits),
+            }
+        return summary
+
+
+def format_crystal_stats(summary):
+    """Returns:
+        str: Lines with the numbers of crystals and reflections and the
+        medians of the statistics from `CrystalStatsTable.summary()`
+    """
+    lines = [f"Crystals: {summary['n_crystals']}",
+             f"Reflections: {summary['n_reflections_total']}"]
+    for name, label in CRYSTAL_STATS_LABELS.items():
+        if name in summary:
+            lines.append(f"{label}, median: {summary[name]['median']}")
+    return "\n".join(lines)
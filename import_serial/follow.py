@@ -0,0 +1,140 @@
+# coding: utf-8
+"""Follow mode: running estimates of the unit cell parameters and the
+wavelength from a CrystFEL stream file that is still being written"""
+import argparse
+import json
+import sys
+import time
+from .atomic import atomic_output
+from .stream import StreamFollower
+
+
+def follow_estimates(follower):
+    """Current estimates of a followed stream file.
+    Args:
+        follower (StreamFollower): Followed stream file
+    Returns:
+        dict: Number of crystals and chunks with a photon energy, mean and
+        median unit cell parameters (A, deg), median photon energy (eV) and
+        wavelength (A), parsed bytes
+    """
+    summary = follower.summary
+    estimates = {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "n_crystals": summary.n_cells,
+        "n_chunks_energy": summary.energies.n,
+        "cell_mean": None,
+        "cell_median": None,
+        "photon_energy_eV": None,
+        "wavelength": None,
+        "parsed_bytes": follower.offset,
+    }
+    for key, cell in (("cell_mean", summary.mean_cell()),
+                      ("cell_median", summary.median_cell())):
+        if cell:
+            estimates[key] = [round(p * 10, 2) for p in cell[:3]] + [round(p, 2) for p in cell[3:]]
+    energy = summary.median_energy()
+    if energy:
+        estimates["photon_energy_eV"] = energy
+        estimates["wavelength"] = round(12398.425 / energy, 5)
+    return estimates
+
+
+def format_estimates(estimates):
+    """Returns:
+        str: One line with the estimates from `follow_estimates()`
+    """
+    line = f"{estimates['time']}  crystals: {estimates['n_crystals']}"
+    if estimates["cell_mean"]:
+        line += "  cell mean: " + " ".join(map(str, estimates["cell_mean"]))
+        line += "  median: " + " ".join(map(str, estimates["cell_median"]))
+    if estimates["wavelength"]:
+        line += f"  wavelength: {estimates['wavelength']}"
+    return line
+
+
+def write_json_atomic(data, filename):
+    """Writes a JSON file atomically, readers never see a partial file."""
+    with atomic_output(filename) as tmp:
+        with open(tmp, "w") as f:
+            f.write(json.dumps(data, indent=4))
+
+
+def follow_stream(streamfile, interval=10, timeout=None, jsonout=None):
+    """Follows a growing stream file and prints updated estimates every
+    `interval` seconds if new crystals or chunks were added.
+    Args:
+        streamfile (str): Path to the stream file
+        interval (float): Seconds between updates
+        timeout (float): Stop if the file has not grown for this number of
+            seconds (default: follow until interrupted)
+        jsonout (str): JSON file rewritten with the latest estimates
+    Returns:
+        dict: Last estimates
+    """
+    follower = StreamFollower(streamfile)
+    last_change = time.monotonic()
+    estimates = None
+    try:
+        while True:
+            offset = follower.offset
+            n_restarts = follower.n_restarts
+            follower.update()
+            if follower.n_restarts != n_restarts:
+                sys.stderr.write(
+                    f"WARNING: The file {streamfile} was rewritten, "
+                    f"it is parsed again from the beginning.\n")
+            if estimates is None or follower.offset != offset \
+                    or follower.n_restarts != n_restarts:
+                last_change = time.monotonic()
+                estimates = follow_estimates(follower)
+                print(format_estimates(estimates), flush=True)
+                if jsonout:
+                    write_json_atomic(estimates, jsonout)
+            elif timeout is not None and time.monotonic() - last_change >= timeout:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    return estimates
+
+
+def run_follow(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Follow a CrystFEL stream file that is being written and print running "
+                    "estimates of the unit cell parameters (mean and median) and the wavelength. "
+                    "Only the chunks appended since the last update are parsed.",
+    )
+    parser.add_argument(
+        "streamfile",
+        help="Stream file from CrystFEL",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=10,
+        help="Seconds between updates (default 10)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="Stop if the stream file has not grown for this number of seconds "
+             "(default: follow until interrupted with Ctrl+C)",
+    )
+    parser.add_argument(
+        "--jsonout",
+        help="JSON file rewritten atomically with the latest estimates",
+    )
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parser.parse_args(argv)
+    if args.interval <= 0:
+        parser.error("--interval must be positive")
+
+    print("")
+    print(f"Following {args.streamfile} (every {args.interval:g} s):")
+    follow_stream(args.streamfile, args.interval, args.timeout, args.jsonout)
+
+
+if __name__ == "__main__":
+    run_follow()
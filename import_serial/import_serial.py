@@ -1,62 +1,111 @@
 # coding: utf-8
-import argparse
+import functools
 import os
 import sys
 from pathlib import Path
 import subprocess
 import traceback
 import math
-import pandas as pd
+import numpy as np
 from math import sqrt
 import json
+import mmap
+import multiprocessing
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from .stream import build_stream_index, get_stream_index, scan_streamfile, stream_file_id, \
+    summarize_stream
+from .cells import CELL_ESTIMATES, cell_distribution, median_abs_deviation, robust_cell
+from .crystal_stats import format_crystal_stats
+from .stream_merge import STREAM_SPLIT_SEED, merge_stream_halves
+from .cache import Cache, file_fingerprint, symmetry_key, CACHE_SIZE_MB
+from .cli import get_parser
+from .mtz_file import MtzFile
+from .mtz_format import is_mtz_file
+from .profiling import Profiler, file_size, stage, timed
+from .results_db import add_run
+from .reflections import build_reflection_table, map_columns_to_asu, group_sums, group_min_max
 try:
     from cctbx import miller, crystal, uctbx, sgtbx, xray
     from cctbx.array_family import flex
-    from iotbx import mtz, reflection_file_reader
 except ModuleNotFoundError:
     print("WARNING: ModuleNotFoundError: Module CCTBX was not found.")
 except ImportError:
     print("WARNING: ImportError: Module CCTBX was not found.")
 
 
+class ImportSerialError(Exception):
+    """Base class of errors raised instead of aborting the program."""
+
+
+class InputError(ImportSerialError):
+    """Input file is missing, unsupported or does not contain the expected data."""
+
+
+class SymmetryError(ImportSerialError):
+    """Space group or unit cell parameters are missing or invalid."""
+
+
+class StatisticsError(ImportSerialError):
+    """Statistics could not be calculated."""
+
+
+def is_hkl_line(line):
+    """Checks if `line` is in the format:
+    int int int float whatever
+    Args:
+        line (bytes or str): Line of a reflection file
+    Returns:
+        bool: True if the line contains a reflection
+    """
+    items = line.split()
+    try:
+        int(items[0])
+        int(items[1])
+        int(items[2])
+        float(items[3])
+    except (ValueError, IndexError):
+        return False
+    return True
+
+
 def hkl_strip(hklin):
-    """Keeps only lines in the format:
+    """Finds the lines in the format:
     int int int float whatever
-    in the `hklin` file and saves them in the file `hklin_strip`.
-    This routine checks only the lines in the beginning and end of
-    the file."""
-    with open(hklin, "r") as hklfile:
-        lines = hklfile.readlines()
-    line_start = 0
-    line_end = len(lines)
-    for i in range(len(lines)):
-        try:
-            int(lines[i].split()[0])
-            int(lines[i].split()[1])
-            int(lines[i].split()[2])
-            float(lines[i].split()[3])
+    in the `hklin` file. Only the header in the beginning (e.g.
+    "Symmetry:" and the column header) and the footer in the end of
+    the file (e.g. "End of reflections") are checked. The file is
+    memory-mapped and nothing is copied or written to disk.
+    Args:
+        hklin (str): Path to the .hkl file
+    Returns:
+        memoryview: Zero-copy view of the data region of the file
+    """
+    with open(hklin, "rb") as hklfile:
+        if os.fstat(hklfile.fileno()).st_size == 0:
+            return memoryview(b"")
+        mm = mmap.mmap(hklfile.fileno(), 0, access=mmap.ACCESS_READ)
+    size = len(mm)
+    # header: move forward line by line until the first reflection
+    start = 0
+    while start < size:
+        eol = mm.find(b"\n", start)
+        if eol == -1:
+            eol = size
+        if is_hkl_line(mm[start:eol]):
             break
-        #except ValueError or IndexError:
-        #except IndexError:
-        #    sys.stderr.write(f"ERROR: Provided file {hklin} is in an incorrect format.\n"
-        #                     "Aborting.\n")
-        #    sys.exit(1)
-        except:
-            line_start = i + 1
-    for i in reversed(range(len(lines))):
-        try:
-            int(lines[i].split()[0])
-            int(lines[i].split()[1])
-            int(lines[i].split()[2])
-            float(lines[i].split()[3])
+        start = eol + 1
+    start = min(start, size)
+    # footer: move backward line by line until the last reflection
+    end = size
+    while end > start:
+        line_end = end - 1 if mm[end - 1] == ord("\n") else end
+        bol = mm.rfind(b"\n", start, line_end)
+        bol = start if bol == -1 else bol + 1
+        if is_hkl_line(mm[bol:line_end]):
             break
-        except:
-            line_end = i
-    lines_strip = lines[line_start:line_end]
-    hkltmp = hklin + "_tmp"
-    with open(hkltmp, "w") as hklfile:
-        hklfile.writelines(lines_strip)
-    return hkltmp
+        end = bol
+    return memoryview(mm)[start:end]
 
 
 def which(program):
@@ -101,156 +150,539 @@ def calc_CCstar(CChalf):
     return CCstar
 
 
+# CrystFEL writes reflection lists with the format
+# "%4i %4i %4i %10.2f %s %10.2f %7i" where the phase is "%8.2f" or "       -"
+#    h    k    l          I    phase   sigma(I)   nmeas
+# (name, first character, last character + 1, decimal places, dtype)
+HKL_CRYSTFEL_FIELDS = (
+    ("h", 0, 4, 0, np.int32),
+    ("k", 5, 9, 0, np.int32),
+    ("l", 10, 14, 0, np.int32),
+    ("I", 15, 25, 2, np.float64),
+    ("sigma(I)", 35, 45, 2, np.float64),
+    ("nmeas", 46, 53, 0, np.int32),
+)
+HKL_CRYSTFEL_LINE_WIDTH = 53
+
+
+def _hkl_fixed_width_weights(width):
+    """Prepares matrices used to convert the characters of the fixed-width
+    fields to numbers with matrix products. Digits of each field are
+    summed by place value in groups of at most 5 digits so that float32
+    sums are exact; the groups are then combined in float64.
+    Args:
+        width (int): Number of characters on a line (including newline)
+    Returns:
+        tuple: place values of the characters (width x n_groups),
+        indicators of the fields (width x n_fields) and multipliers of
+        the groups (n_groups x n_fields)
+    """
+    place_values = []
+    multipliers = []
+    fields = np.zeros((width, len(HKL_CRYSTFEL_FIELDS)), dtype=np.float32)
+    for i, (name, first, last, decimals, dtype) in enumerate(HKL_CRYSTFEL_FIELDS):
+        fields[first:last, i] = 1
+        positions = [j for j in range(first, last)
+                     if not (decimals and j == last - decimals - 1)]
+        positions.reverse()  # least significant digit first
+        for g in range(0, len(positions), 5):
+            w = np.zeros(width, dtype=np.float32)
+            for e, j in enumerate(positions[g:g + 5]):
+                w[j] = 10.0 ** e
+            place_values.append(w)
+            m = np.zeros(len(HKL_CRYSTFEL_FIELDS))
+            m[i] = 10.0 ** g
+            multipliers.append(m)
+    return np.array(place_values).T.copy(), fields, np.array(multipliers)
+
+
+def parse_hkl_fixed_width(data, chunk_size=2048):
+    """Parses a CrystFEL reflection list written with the fixed-width
+    format directly from the raw bytes. Characters are converted to digits
+    and summed by place value with matrix products per chunk of lines,
+    the unused phase column is never converted.
+    Args:
+        data (buffer): Data region of the file, e.g. from `hkl_strip()`
+        chunk_size (int): Number of lines processed at once
+    Returns:
+        dict: numpy arrays h, k, l, I, sigma(I) and nmeas, or None if
+        the data are not in the expected fixed-width format
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if buf.size == 0:
+        return None
+    eol = np.flatnonzero(buf[:HKL_CRYSTFEL_LINE_WIDTH + 2] == ord("\n"))
+    if eol.size == 0:
+        return None
+    width = int(eol[0]) + 1
+    if width == HKL_CRYSTFEL_LINE_WIDTH + 2 and buf[width - 2] != ord("\r"):
+        return None
+    if width not in (HKL_CRYSTFEL_LINE_WIDTH + 1, HKL_CRYSTFEL_LINE_WIDTH + 2) \
+            or buf.size % width != 0:
+        return None
+    rows = buf.reshape(-1, width)
+    if not (rows[:, -1] == ord("\n")).all():
+        return None
+    n = rows.shape[0]
+    place_values, fields, multipliers = _hkl_fixed_width_weights(width)
+    separators = [first - 1 for name, first, last, decimals, dtype
+                  in HKL_CRYSTFEL_FIELDS if first > 0]
+    dots = [last - decimals - 1 for name, first, last, decimals, dtype
+            in HKL_CRYSTFEL_FIELDS if decimals]
+    # separators, dots, phase and line endings are checked separately
+    not_checked = np.ones(width, dtype=bool)
+    for name, first, last, decimals, dtype in HKL_CRYSTFEL_FIELDS:
+        not_checked[first:last] = False
+    not_checked[dots] = True
+    values = np.empty((n, len(HKL_CRYSTFEL_FIELDS)))
+    for start in range(0, n, chunk_size):
+        chunk = rows[start:start + chunk_size]
+        # only spaces, minus signs and digits, dots at the expected places
+        valid = (chunk - np.uint8(ord("0"))) <= 9
+        valid |= chunk == ord(" ")
+        valid |= chunk == ord("-")
+        valid |= not_checked
+        if not valid.all() \
+                or not (chunk[:, separators] == ord(" ")).all() \
+                or not (chunk[:, dots] == ord(".")).all():
+            return None
+        digits = np.maximum(chunk, np.uint8(ord("0"))) - np.uint8(ord("0"))
+        value = (digits.astype(np.float32) @ place_values).astype(np.float64) @ multipliers
+        minus = (chunk == ord("-")).astype(np.float32) @ fields
+        np.negative(value, out=value, where=minus > 0)
+        values[start:start + chunk_size] = value
+    columns = {}
+    for i, (name, first, last, decimals, dtype) in enumerate(HKL_CRYSTFEL_FIELDS):
+        if decimals:
+            columns[name] = values[:, i] / 10 ** decimals
+        else:
+            columns[name] = values[:, i].astype(dtype)
+    return columns
+
+
+def parse_hkl_whitespace(data):
+    """Parses a CrystFEL reflection list with columns separated by any
+    whitespace. Used if the file is not in the usual fixed-width format.
+    Args:
+        data (buffer): Data region of the file, e.g. from `hkl_strip()`
+    Returns:
+        dict: numpy arrays h, k, l, I, sigma(I) and nmeas
+    """
+    n_columns = 7  # h k l I phase sigma(I) nmeas
+    tokens = bytes(data).split()
+    if len(tokens) % n_columns != 0:
+        raise ValueError(
+            f"Unexpected number of columns in the reflection list, "
+            f"expected {n_columns}: h k l I phase sigma(I) nmeas")
+    positions = {"h": 0, "k": 1, "l": 2, "I": 3, "sigma(I)": 5, "nmeas": 6}
+    columns = {}
+    for name, first, last, decimals, dtype in HKL_CRYSTFEL_FIELDS:
+        column = np.array(tokens[positions[name]::n_columns], dtype=bytes)
+        columns[name] = column.astype(dtype)
+    return columns
+
+
+def read_hkl_crystfel(hklin, cache=None):
+    """Reads a merged reflection list from CrystFEL in a single pass.
+    Only the columns h, k, l, I, sigma(I) and nmeas are parsed, directly
+    from the memory-mapped file.
+
+    Expected format of a fixed-width .hkl file:
+       h    k    l          I    phase   sigma(I)   nmeas
+
+    Args:
+        hklin (str): Path to the .hkl, .hkl1 or .hkl2 file
+        cache (Cache): Optional cache of parsed files, addressed by
+            the content of the file
+
+    Returns:
+        dict: numpy arrays h, k, l (int32), I, sigma(I) (float64)
+        and nmeas (int32)
+    """
+    if cache:
+        key = cache.key("hkl", file_fingerprint(hklin))
+        columns = cache.get_arrays(key)
+        if columns is not None:
+            return columns
+    data = hkl_strip(hklin)
+    columns = parse_hkl_fixed_width(data)
+    if columns is None:
+        columns = parse_hkl_whitespace(data)
+    if cache:
+        cache.put_arrays(key, columns)
+    return columns
+
+
+def map_hkl_to_asu(hklin, columns, cs, cache):
+    """Maps a reflection list from CrystFEL to the asymmetric unit, cached
+    by the content of the file and the crystal symmetry.
+    Args:
+        hklin (str): Path to the .hkl, .hkl1 or .hkl2 file
+        columns (dict): Columns read by `read_hkl_crystfel()`
+        cs (cctbx.crystal.symmetry): Crystal symmetry
+        cache (Cache): Cache of the mapped Miller indices
+    Returns:
+        dict: Result of `map_columns_to_asu()`
+    """
+    key = cache.key("asu", file_fingerprint(hklin), symmetry_key(cs))
+    mapped = cache.get_arrays(key)
+    if mapped is None:
+        mapped = map_columns_to_asu(cs, columns)
+        cache.put_arrays(key, mapped)
+    return mapped
+
+
+def get_miller_arrays_crystfel(hklin, cs, d_max=0, d_min=0, cache=None):
+    """Loads intensities and multiplicities from a CrystFEL .hkl file
+    that is read only once. Both Miller arrays share the same Miller
+    indices and crystal symmetry.
+
+    Args:
+        hklin (str): Path to the .hkl, .hkl1 or .hkl2 file
+        cs (cctbx.crystal.symmetry): Crystal symmetry
+        d_max (float): Low-resolution cutoff
+        d_min (float): High-resolution cutoff
+        cache (Cache): Optional cache of parsed files
+
+    Returns:
+        tuple: Miller array of intensities (with sigmas) and
+        Miller array of multiplicities
+    """
+    hkl = read_hkl_crystfel(hklin, cache)
+    indices = flex.miller_index(flex.int(hkl["h"]), flex.int(hkl["k"]), flex.int(hkl["l"]))
+    miller_set = miller.set(cs, indices)
+    sel = miller_set.resolution_filter_selection(d_max=d_max, d_min=d_min)
+    miller_set = miller_set.select(sel)
+    sel = sel.as_numpy_array()
+
+    I = flex.double(hkl["I"][sel])
+    sig = flex.double(hkl["sigma(I)"][sel])
+    m_i = miller.array(
+        miller_set=miller_set,
+        data=I,
+        sigmas=sig,
+    )
+    m_i.set_observation_type_xray_intensity()
+    nmeas = flex.double(hkl["nmeas"][sel].astype(np.float64))  # ASK double x int
+    m_nmeas = miller.array(
+        miller_set=miller_set,
+        data=nmeas,
+    )
+    return m_i, m_nmeas
+
+
 def get_miller_array_crystfel(hklin, cs, values="I", d_max=0, d_min=0):
     assert values == "I" or values == "nmeas"
-    # read data from the text file
-    # expected format of a fixed-width .hkl file:
-    #    h    k    l          I    phase   sigma(I)   nmeas
-    hklin_strip = hkl_strip(hklin)
-    hklin_df = pd.read_csv(
-        hklin_strip, header=None, index_col=False, sep=r'\s+',
-        names=("h", "k", "l", "I", "phase", "sigma(I)", "nmeas"))
-    h = flex.int(hklin_df["h"])
-    k = flex.int(hklin_df["k"])
-    l = flex.int(hklin_df["l"])
-    indices = flex.miller_index(h,k,l)
-
+    m_i, m_nmeas = get_miller_arrays_crystfel(hklin, cs, d_max=d_max, d_min=d_min)
     if values == "I":
-        I = flex.double(hklin_df["I"])
-        sig = flex.double(hklin_df["sigma(I)"])
-        m = miller.array(
-            miller_set=miller.set(cs, indices),
-            data=I,
-            sigmas=sig,
-        )
-        m.set_observation_type_xray_intensity()
-    elif values == "nmeas":
-        nmeas = flex.double(hklin_df["nmeas"])  # ASK double x int
-        m = miller.array(
-            miller_set=miller.set(cs, indices),
-            data=nmeas,
-        )
-    else:
-        m = None
-        # TO DO warning
-    m = m.resolution_filter(d_max=d_max, d_min=d_min)
-    return m
+        return m_i
+    return m_nmeas
+
+
+def calc_stats_merged_grouped(table, groups, n_groups, nmeas, binned=False, cumulative=False):
+    """Statistics of the merged data set for groups of reflections
+    calculated with grouped reductions in a single pass over reflections.
+    Args:
+        table (ReflectionTable): Reflections
+        groups (numpy.ndarray): Group of each reflection of the merged
+            data set (in the order of the table)
+        n_groups (int): Number of groups
+        nmeas (numpy.ndarray): Multiplicity of each reflection
+        binned (bool): Completeness within the resolution range of each
+            group (otherwise from infinity to d_min)
+        cumulative (bool): Statistics of all reflections in groups up to
+            and including each group
+    Returns:
+        dict: numpy arrays of statistics with one value per group
+    """
+    I = table.I[table.has_I]
+    sigI = table.sigI[table.has_I]
+    positive = sigI > 0
+    sums = {
+        "n_unique": group_sums(groups, n_groups),
+        # rounded as flex.double.iround()
+        "n_obs": group_sums(groups, n_groups, np.trunc(nmeas + np.copysign(0.5, nmeas))),
+        "nmeas": group_sums(groups, n_groups, nmeas),
+        "I": group_sums(groups, n_groups, I),
+        "n_positive": group_sums(groups[positive], n_groups),
+        "IsigI": group_sums(groups[positive], n_groups, I[positive] / sigI[positive]),
+    }
+    res_high, res_low = group_min_max(groups, n_groups, table.d[table.has_I])
+    if cumulative:
+        sums = {key: np.cumsum(values) for key, values in sums.items()}
+        res_high = np.fmin.accumulate(res_high)
+        res_low = np.fmax.accumulate(res_low)
+    n_unique = sums["n_unique"]
+    n_complete = table.n_complete(res_high, res_low if binned else None)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {
+            "d_max": res_low,
+            "d_min": res_high,
+            "n_unique": n_unique.astype(int),
+            "n_obs": sums["n_obs"],
+            "completeness": np.minimum(n_unique / np.maximum(n_complete, 1), 1.0),
+            "multiplicity": sums["nmeas"] / n_unique,
+            "I": sums["I"] / n_unique,
+            "IsigI": sums["IsigI"] / sums["n_positive"],
+        }
 
 
-def calc_stats_merged(m_all_i, m_all_nmeas, d_max=0, d_min=0, n_bins=10):
+def calc_stats_merged(table, log=None):
+    """Statistics of the merged data set, overall and in resolution bins.
+    Args:
+        table (ReflectionTable): Reflections
+        log (file): Stream for the printed output (default standard output)
+    Returns:
+        dict: Statistics "overall" and "binned"
+    """
     stats = {"overall": {}, "binned": {}}
-    res_low, res_high = m_all_i.d_max_min()
-    n_unique = m_all_i.size()
-    completeness = m_all_i.as_non_anomalous_set().completeness()
-    m_all_i = m_all_i.map_to_asu()
-    m_all_i.setup_binner(n_bins=n_bins)
-    m_all_i = m_all_i.sort("packed_indices")
-    m_all_i.setup_binner(n_bins=n_bins) # need to redo the binner as is lost above
+    bins = table.bin[table.has_I]
+    # multiplicities are in the rows of their Miller indices
+    nmeas = table.nmeas[table.has_I]
+    overall = calc_stats_merged_grouped(table, np.zeros_like(bins), 1, nmeas)
+    binned = calc_stats_merged_grouped(table, bins, table.n_bins + 2, nmeas, binned=True)
 
     # overall values
-    i_mean = m_all_i.mean()
-    i_sig = m_all_i.i_over_sig_i()
-    # n_obs = int(m_all_nmeas.sum())
-    n_obs = sum(m_all_nmeas.data().iround())
-    multiplicity = m_all_nmeas.mean()
-    stats["overall"]["d_max"] = round(res_low, 3)
-    stats["overall"]["d_min"] = round(res_high, 3)
+    n_obs = int(overall["n_obs"][0])
+    n_unique = int(overall["n_unique"][0])
+    completeness = float(overall["completeness"][0])
+    multiplicity = float(overall["multiplicity"][0])
+    i_mean = float(overall["I"][0])
+    i_sig = float(overall["IsigI"][0])
+    stats["overall"]["d_max"] = round(float(overall["d_max"][0]), 3)
+    stats["overall"]["d_min"] = round(float(overall["d_min"][0]), 3)
     stats["overall"]["n_unique"] = n_unique
     stats["overall"]["n_obs"] = n_obs
     stats["overall"]["completeness"] = round(completeness * 100, 2)
     stats["overall"]["multiplicity"] = round(multiplicity, 2)
     stats["overall"]["I"] = round(i_mean, 2)
     stats["overall"]["IsigI"] = round(i_sig, 2)
-    print(f"#observed: {n_obs}")
-    print(f"#unique: {m_all_i.size()}")
-    print(f"completeness = {completeness * 100:.2f} %")
-    print(f"multiplicity = {multiplicity:.2f}")
-    print(f"<I> = {i_mean:.1f}")
-    print(f"<I/sigma(I)> = {i_sig:.1f}")
+    print(f"#observed: {n_obs}", file=log)
+    print(f"#unique: {n_unique}", file=log)
+    print(f"completeness = {completeness * 100:.2f} %", file=log)
+    print(f"multiplicity = {multiplicity:.2f}", file=log)
+    print(f"<I> = {i_mean:.1f}", file=log)
+    print(f"<I/sigma(I)> = {i_sig:.1f}", file=log)
 
     # binned values
-    stats["binned"]["d_max"] = []
-    stats["binned"]["d_min"] = []
-    stats["binned"]["n_obs"] = []
-    stats["binned"]["n_unique"] = []
-    stats["binned"]["completeness"] = []
-    stats["binned"]["multiplicity"] = []
-    stats["binned"]["I"] = []
-    stats["binned"]["IsigI"] = []
-    # print("Binned values:")
-    # print(f"d_max   d_min  #unique %complet. multip. <I> <I/sigma(I)>")
-    for i_bin in m_all_i.binner().range_used():
-        sel = m_all_i.binner().selection(i_bin)
-        m_all_i_sel = m_all_i.select(sel)
-        m_all_nmeas_sel = m_all_nmeas.select(sel)
-        res_low, res_high = m_all_i_sel.d_max_min()
-        n_unique = m_all_i_sel.size()
-        completeness = m_all_i_sel.as_non_anomalous_set().completeness(d_max=res_low)
-        # n_obs = int(m_all_nmeas_sel.sum())
-        n_obs = sum(m_all_nmeas_sel.data().iround())
-        n_ref_nmeas = int(m_all_nmeas_sel.size())
-        multiplicity = m_all_nmeas_sel.mean()
-        i_mean =  m_all_i_sel.mean()
-        i_sig =  m_all_i_sel.i_over_sig_i()
-        stats["binned"]["d_max"].append(round(res_low, 3))
-        stats["binned"]["d_min"].append(round(res_high, 3))
-        stats["binned"]["n_obs"].append(n_obs)
-        stats["binned"]["n_unique"].append(n_unique)
-        stats["binned"]["completeness"].append(round(completeness * 100, 2))
-        stats["binned"]["multiplicity"].append(round(multiplicity, 2))
-        stats["binned"]["I"].append(round(i_mean, 2))
-        stats["binned"]["IsigI"].append(round(i_sig, 2))
-        # print(f"{res_low:.3f}  {res_high:.3f}  {n_unique}   {completeness * 100:.1f}     {multiplicity:.1f}  {i_mean:.2f}  {i_sig:.2f}")
-        if n_unique != n_ref_nmeas:
-            sys.stderr.write(
-                f"WARNING: Numbers of reflections in bins for the intensity Miller"
-                f"array and multiplicity Miller array do not equal.\n"
-                f"{n_ref} is not {n_ref_nmeas} in bin {round(res_low, 3)}-{round(res_high, 3)}\n")
+    used = slice(1, table.n_bins + 1)
+    stats["binned"]["d_max"] = [round(x, 3) for x in binned["d_max"][used].tolist()]
+    stats["binned"]["d_min"] = [round(x, 3) for x in binned["d_min"][used].tolist()]
+    stats["binned"]["n_obs"] = [int(x) for x in binned["n_obs"][used].tolist()]
+    stats["binned"]["n_unique"] = binned["n_unique"][used].tolist()
+    stats["binned"]["completeness"] = [round(x * 100, 2) for x in binned["completeness"][used].tolist()]
+    stats["binned"]["multiplicity"] = [round(x, 2) for x in binned["multiplicity"][used].tolist()]
+    stats["binned"]["I"] = [round(x, 2) for x in binned["I"][used].tolist()]
+    stats["binned"]["IsigI"] = [round(x, 2) for x in binned["IsigI"][used].tolist()]
     return stats
 
 
-def calc_stats_compare(m_all, m1, m2, d_max, d_min, n_bins):
-    stats = {"overall": {}, "binned": {}}
-    m1 = m1.resolution_filter(d_max=d_max, d_min=d_min)
-    m1 = m1.map_to_asu()
-    m1 = m1.sort("packed_indices")
+def half_dataset_sums(I1, I2, groups, n_groups):
+    """Sufficient statistics of two half-data sets for each group of
+    reflections in a single pass. The sums of groups can be added together,
+    e.g. cumulatively over resolution bins.
+    Args:
+        I1 (numpy.ndarray): Intensities from the first half-data set
+        I2 (numpy.ndarray): Intensities from the second half-data set
+        groups (numpy.ndarray): Group of each reflection
+        n_groups (int): Number of groups
+    Returns:
+        dict: numpy arrays n, x, y, xx, yy, xy, abs_diff and sum
+        with one value per group
+    """
+    # deviations from the overall means keep the sums of squares accurate,
+    # the correlation coefficient does not depend on them
+    x = I1 - I1.mean() if I1.size else I1
+    y = I2 - I2.mean() if I2.size else I2
+    return {
+        "n": group_sums(groups, n_groups),
+        "x": group_sums(groups, n_groups, x),
+        "y": group_sums(groups, n_groups, y),
+        "xx": group_sums(groups, n_groups, x * x),
+        "yy": group_sums(groups, n_groups, y * y),
+        "xy": group_sums(groups, n_groups, x * y),
+        "abs_diff": group_sums(groups, n_groups, np.abs(I1 - I2)),
+        "sum": group_sums(groups, n_groups, I1 + I2),
+    }
 
-    m2 = m2.resolution_filter(d_max=d_max, d_min=d_min)
-    m2 = m2.map_to_asu()
-    m2 = m2.sort("packed_indices")
 
-    m1, m2 = m1.common_sets(m2, assert_no_singles=False)
+def calc_cc_rsplit_sums(sums):
+    """CC1/2, CC* and Rsplit from sufficient statistics of half-data sets.
+    Args:
+        sums (dict): numpy arrays from `half_dataset_sums()`
+    Returns:
+        tuple: numpy arrays CC1/2, CC* and Rsplit
+    """
+    n = sums["n"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        numerator = sums["xy"] - sums["x"] * sums["y"] / n
+        denominator = np.sqrt(
+            (sums["xx"] - sums["x"] ** 2 / n) * (sums["yy"] - sums["y"] ** 2 / n))
+        # as flex.linear_correlation(): 0 if not well defined
+        cc = np.where((n > 0) & (denominator >= 1e-15), numerator / denominator, 0.0)
+        rsplit = np.where(sums["sum"] != 0, sqrt(2) * sums["abs_diff"] / sums["sum"], 0.0)
+    CCstar = np.array([calc_CCstar(x) for x in cc])
+    return cc, CCstar, rsplit
+
+
+def calc_stats_compare(table, log=None):
+    """Statistics CC1/2, CC* and Rsplit from reflections present in both
+    half-data sets, overall, in resolution bins and cumulative from the
+    lowest resolution to the high-resolution limit of each bin.
+    Args:
+        table (ReflectionTable): Reflections
+        log (file): Stream for the printed output (default standard output)
+    Returns:
+        dict: Statistics "overall", "binned" and "cumulative"
+    """
+    stats = {"overall": {}, "binned": {}, "cumulative": {}}
+    sel = table.has_half1 & table.has_half2
+    sums = half_dataset_sums(
+        table.I_half1[sel], table.I_half2[sel], table.bin[sel], table.n_bins + 2)
+    used = slice(1, table.n_bins + 1)
 
     # overall values   
-    cc = flex.linear_correlation(m1.data(), m2.data()).coefficient()
-    CCstar = calc_CCstar(cc)
-    rsplit = calc_rsplit(m1.data(), m2.data())
+    overall = {key: values.sum(keepdims=True) for key, values in sums.items()}
+    cc, CCstar, rsplit = (float(x[0]) for x in calc_cc_rsplit_sums(overall))
     stats["overall"]["cc"] = round(cc, 3)
     stats["overall"]["CCstar"] = round(CCstar, 3)
     stats["overall"]["rsplit"] = round(rsplit, 3)
     # print("Overall values:")
-    print(f"CC1/2 = {cc:.3f}\nCC* = {CCstar:.3f}\nRsplit = {rsplit:.3f}")
+    print(f"CC1/2 = {cc:.3f}\nCC* = {CCstar:.3f}\nRsplit = {rsplit:.3f}", file=log)
 
     # binned values
-    m1.use_binning(m_all.binner())
-    m2.use_binning(m_all.binner())
-    stats["binned"]["cc"] = []
-    stats["binned"]["CCstar"] = []
-    stats["binned"]["rsplit"] = []
-    # print("Binned values:")
-    # print(f"d_max   d_min  CC1/2  CC*   Rsplit")
-    for i_bin in m1.binner().range_used():
-        sel = m1.binner().selection(i_bin)
-        m1_sel = m1.select(sel)
-        m2_sel = m2.select(sel)
-        res_low, res_high = m1_sel.d_max_min()
-        cc = flex.linear_correlation(m1_sel.data(), m2_sel.data()).coefficient()
-        CCstar = calc_CCstar(cc)
-        rsplit = calc_rsplit(m1_sel.data(), m2_sel.data())
-        stats["binned"]["cc"].append(round(cc, 3))
-        stats["binned"]["CCstar"].append(round(CCstar, 3))
-        stats["binned"]["rsplit"].append(round(rsplit, 3))
-        # print(f"{res_low:.3f}  {res_high:.3f}  {cc:.3f} {CCstar:.3f} {rsplit:.3f}")
+    cc, CCstar, rsplit = calc_cc_rsplit_sums(sums)
+    stats["binned"]["cc"] = [round(x, 3) for x in cc[used].tolist()]
+    stats["binned"]["CCstar"] = [round(x, 3) for x in CCstar[used].tolist()]
+    stats["binned"]["rsplit"] = [round(x, 3) for x in rsplit[used].tolist()]
+
+    # cumulative values from the lowest-resolution bin
+    cumulative = {key: np.cumsum(values[used]) for key, values in sums.items()}
+    cc, CCstar, rsplit = calc_cc_rsplit_sums(cumulative)
+    stats["cumulative"]["cc"] = [round(x, 3) for x in cc.tolist()]
+    stats["cumulative"]["CCstar"] = [round(x, 3) for x in CCstar.tolist()]
+    stats["cumulative"]["rsplit"] = [round(x, 3) for x in rsplit.tolist()]
+    return stats
+
+
+def sweep_cutoffs(table, n_shells):
+    """High-resolution cutoffs at the limits of shells with equal volume
+    in reciprocal space, from the lowest to the highest resolution.
+    Args:
+        table (ReflectionTable): Reflections
+        n_shells (int): Number of shells
+    Returns:
+        numpy.ndarray: Cutoffs d_min
+    """
+    d = table.d[table.has_I]
+    d_star_cubed = np.linspace(d.max() ** -3, d.min() ** -3, n_shells + 1)[1:]
+    cutoffs = d_star_cubed ** (-1 / 3)
+    cutoffs[-1] = d.min()
+    return cutoffs
+
+
+def calc_stats_sweep(table, cutoffs, cc_min=None, ccstar_min=None, isigi_min=None,
+                     log=None):
+    """Overall statistics for a series of high-resolution cutoffs, as if
+    the data were processed with each cutoff (option --dmin) separately.
+    Reflections are grouped in shells between the cutoffs and the
+    statistics are calculated from cumulative sums over the shells.
+    A cutoff is suggested as the highest resolution at which the outer
+    shell and all shells at lower resolution satisfy the thresholds.
+    Args:
+        table (ReflectionTable): Reflections
+        cutoffs (list): High-resolution cutoffs d_min
+        cc_min (float): Minimal CC1/2 in the outer shell
+        ccstar_min (float): Minimal CC* in the outer shell
+        isigi_min (float): Minimal <I/sigma(I)> in the outer shell
+        log (file): Stream for the printed output and warnings (default
+            standard output and standard error)
+    Returns:
+        dict: Statistics "sweep" (lists with values for each cutoff) and
+        "suggested_d_min" if thresholds are given
+    """
+    cutoffs = np.sort(np.asarray(cutoffs, dtype=float))[::-1]
+    n_cutoffs = cutoffs.size
+
+    def shells(d):
+        # number of cutoffs above d, reflections with d >= cutoff are used
+        return np.searchsorted(-cutoffs, -d, side="left")
+
+    shells_i = shells(table.d[table.has_I])
+    cumulative = calc_stats_merged_grouped(
+        table, shells_i, n_cutoffs + 1, table.nmeas[table.has_I], cumulative=True)
+    outer = calc_stats_merged_grouped(
+        table, shells_i, n_cutoffs + 1, table.nmeas[table.has_I], binned=True)
+    sweep = {"d_min_cutoff": cutoffs.tolist()}
+    for key, values in cumulative.items():
+        sweep[key] = values[:n_cutoffs]
+    sweep["outer_IsigI"] = outer["IsigI"][:n_cutoffs]
+    if table.has_halves:
+        sel = table.has_half1 & table.has_half2
+        sums = half_dataset_sums(
+            table.I_half1[sel], table.I_half2[sel], shells(table.d[sel]), n_cutoffs + 1)
+        sweep["cc"], sweep["CCstar"], sweep["rsplit"] = calc_cc_rsplit_sums(
+            {key: np.cumsum(values)[:n_cutoffs] for key, values in sums.items()})
+        sweep["outer_cc"], sweep["outer_CCstar"], _ = calc_cc_rsplit_sums(
+            {key: values[:n_cutoffs] for key, values in sums.items()})
+    elif cc_min is not None or ccstar_min is not None:
+        (log or sys.stderr).write(
+            "WARNING: Half-data sets are not available, "
+            "thresholds on CC1/2 and CC* are not used.\n")
+        cc_min = ccstar_min = None
+
+    # suggested cutoff
+    suggested = None
+    thresholds = [(key, value) for key, value in
+                  (("outer_cc", cc_min), ("outer_CCstar", ccstar_min), ("outer_IsigI", isigi_min))
+                  if value is not None]
+    if thresholds:
+        passed = np.ones(n_cutoffs, dtype=bool)
+        for key, value in thresholds:
+            passed &= sweep[key] >= value
+        n_passed = np.argmin(passed) if not passed.all() else n_cutoffs
+        if n_passed:
+            suggested = round(float(cutoffs[n_passed - 1]), 3)
+
+    # rounded as in the overall values
+    decimals = {"d_min_cutoff": 3, "d_max": 3, "d_min": 3, "completeness": 2, "multiplicity": 2,
+                "I": 2, "IsigI": 2, "outer_IsigI": 2,
+                "cc": 3, "CCstar": 3, "rsplit": 3, "outer_cc": 3, "outer_CCstar": 3}
+    for key, values in sweep.items():
+        values = np.asarray(values, dtype=float)
+        if key == "completeness":
+            values = values * 100
+        if key in decimals:
+            sweep[key] = [round(x, decimals[key]) for x in values.tolist()]
+        else:
+            sweep[key] = [int(x) for x in values.tolist()]
+
+    header = ["d_min", "#obs", "#uniq", "mult.", "%comp", "<I/sI>"]
+    format_header = '{:>8}{:>10}{:>8}{:>8}{:>8}{:>8}'
+    format_values = '{:>8.2f}{:>10d}{:>8d}{:>8.2f}{:>8.2f}{:>8.1f}'
+    keys = ["d_min_cutoff", "n_obs", "n_unique", "multiplicity", "completeness", "IsigI"]
+    if table.has_halves:
+        header += ["cc1/2", "r_split", "cc_outer"]
+        format_header += '{:>8}{:>8}{:>9}'
+        format_values += '{:>8.3f}{:>8.3f}{:>9.3f}'
+        keys += ["cc", "rsplit", "outer_cc"]
+    header.append("IsI_outer")
+    format_header += '{:>10}'
+    format_values += '{:>10.1f}'
+    keys.append("outer_IsigI")
+    print(format_header.format(*header), file=log)
+    for i in range(n_cutoffs):
+        print(format_values.format(*(sweep[key][i] for key in keys)), file=log)
+    stats = {"sweep": sweep}
+    if thresholds:
+        criteria = ", ".join(f"{key.replace('outer_', '')} >= {value}" for key, value in thresholds)
+        if suggested:
+            print(f"\nSuggested high-resolution cutoff: {suggested} A (outer shell {criteria})",
+                  file=log)
+        else:
+            print(f"\nNo high-resolution cutoff satisfies the thresholds (outer shell {criteria})",
+                  file=log)
+        stats["suggested_d_min"] = suggested
     return stats
 
 
@@ -258,27 +690,21 @@ def calc_cc_rsplit(half_dataset, spacegroup, cell, d_max=0, d_min=0, n_bins=10):
     """Code from James"""
     from cctbx import miller, crystal, uctbx, sgtbx, xray
     from cctbx.array_family import flex
-    import pandas as pd
     import math
     
     # read the data from the text file to get lists of the values
     # this code assumes the miller indices are the same and in the same order between files
     # TO DO: I/sigma?
     # expected format of a fixed-width .hkl file:
-    # it contains just data, no header or footer
     #    h    k    l          I    phase   sigma(I)   nmeas
-    half1 = pd.read_csv(
-        half_dataset[0], header=None, index_col=False, sep=r'\s+',
-        names=("h", "k", "l", "I", "phase", "sigma(I)", "nmeas"))
-    half2 = pd.read_csv(
-        half_dataset[1], header=None, index_col=False, sep=r'\s+',
-        names=("h", "k", "l", "I", "phase", "sigma(I)", "nmeas"))
+    half1 = read_hkl_crystfel(half_dataset[0])
+    half2 = read_hkl_crystfel(half_dataset[1])
     h1 = flex.int(half1["h"])
     k1 = flex.int(half1["k"])
     l1 = flex.int(half1["l"])
     I1 = flex.double(half1["I"])
     sig1 = flex.double(half1["sigma(I)"])
-    nmeas1 = flex.double(half1["nmeas"])
+    nmeas1 = flex.double(half1["nmeas"].astype(np.float64))
     h2 = flex.int(half2["h"])
     k2 = flex.int(half2["k"])
     l2 = flex.int(half2["l"])
@@ -355,11 +781,14 @@ def stats_to_xml(stats):  #, xmlout="program.xml"):
     lines = []
     lines.append("<import_serial>")
     for key1, key2 in stats.items():
-        lines.append(f"\t<{key1}>")  # overall or binned
+        if not isinstance(key2, dict):  # single value, e.g. suggested_d_min
+            lines.append(f"\t<{key1}>{'' if key2 is None else key2}</{key1}>")
+            continue
+        lines.append(f"\t<{key1}>")  # e.g. overall, binned or sweep
         if key1 == "overall":
             for key_2, value in key2.items():
                 lines.append(f"\t\t<{key_2}>{value}</{key_2}>")
-        elif key1 == "binned":
+        elif key1 in ("binned", "cumulative"):
             for i in range(len(list(key2.values())[0])):  # for individual bins
                 lines.append(f"\t\t<bin>")
                 lines.append(f"\t\t\t<n_bin>{i + 1}</n_bin>")
@@ -370,6 +799,47 @@ def stats_to_xml(stats):  #, xmlout="program.xml"):
                         over_d_min_sq = round(over_d_min_sq, 4)
                         lines.append(f"\t\t\t<one_over_d_min_sq>{over_d_min_sq}</one_over_d_min_sq>")
                 lines.append(f"\t\t</bin>")
+        elif key1 == "performance":
+            lines.append(f"\t\t<mode>{key2['mode']}</mode>")
+            for name, measures in list(key2["stages"].items()) + [("total", key2["total"])]:
+                lines.append(f"\t\t<stage>")
+                lines.append(f"\t\t\t<name>{name}</name>")
+                for key_2, value in measures.items():
+                    lines.append(f"\t\t\t<{key_2}>{value}</{key_2}>")
+                lines.append(f"\t\t</stage>")
+        elif key1 == "unit_cell":
+            for key_2, value in key2.items():
+                if key_2 == "clusters":
+                    for cluster in value:
+                        lines.append(f"\t\t<cluster>")
+                        lines.append(f"\t\t\t<n_crystals>{cluster['n_crystals']}</n_crystals>")
+                        for name, parameter in cluster["median"].items():
+                            lines.append(f"\t\t\t<{name}>{parameter}</{name}>")
+                        lines.append(f"\t\t</cluster>")
+                elif isinstance(value, dict):  # mean, median, trimmed_mean, mad
+                    lines.append(f"\t\t<estimate>")
+                    lines.append(f"\t\t\t<name>{key_2}</name>")
+                    for name, parameter in value.items():
+                        lines.append(f"\t\t\t<{name}>{parameter}</{name}>")
+                    lines.append(f"\t\t</estimate>")
+                else:
+                    lines.append(f"\t\t<{key_2}>{value}</{key_2}>")
+        elif key1 == "crystal_stats":
+            for key_2, value in key2.items():
+                if isinstance(value, dict):  # mean, median, min and max of a statistic
+                    lines.append(f"\t\t<statistic>")
+                    lines.append(f"\t\t\t<name>{key_2}</name>")
+                    for name, x in value.items():
+                        lines.append(f"\t\t\t<{name}>{x}</{name}>")
+                    lines.append(f"\t\t</statistic>")
+                else:
+                    lines.append(f"\t\t<{key_2}>{value}</{key_2}>")
+        elif key1 == "sweep":
+            for i in range(len(key2["d_min_cutoff"])):  # for individual cutoffs
+                lines.append(f"\t\t<cutoff>")
+                for key_2, key_3 in key2.items():
+                    lines.append(f"\t\t\t<{key_2}>{key_3[i]}</{key_2}>")
+                lines.append(f"\t\t</cutoff>")
             #for key_2, key_3 in key2.items():
             #    lines.append(f"\t\t<{key_2}>")  # statistic
             #    for i, value in enumerate(key_3):  # key_3 is list
@@ -381,7 +851,7 @@ def stats_to_xml(stats):  #, xmlout="program.xml"):
     return stats_xml
 
 
-def stats_binned_print(stats_binned):  # , half_dataset_available=False):
+def stats_binned_print(stats_binned, log=None):  # , half_dataset_available=False):
     # stats_print = "%9s%9s%11s%8s%9s%9s%9s%9s"
     header = ["d_max", "d_min", "#obs", "#uniq", "mult.", "%comp", "<I>", "<I/sI>"]
     stats_print_format_header = '{:>8}{:>8}{:>9}{:>8}{:>8}{:>8}{:>9}{:>8}'
@@ -393,7 +863,7 @@ def stats_binned_print(stats_binned):  # , half_dataset_available=False):
         stats_print_format_header += '{:>8}{:>8}{:>8}'
         stats_print_format_values += '{:>8.3f}{:>8.3f}{:>8.3f}'
     # print(stats_print % tuple(stats_print_header))
-    print(stats_print_format_header.format(*header))
+    print(stats_print_format_header.format(*header), file=log)
     for i in range(len(stats_binned["d_max"])):
         values = []
         values.append(stats_binned["d_max"][i])
@@ -410,54 +880,10 @@ def stats_binned_print(stats_binned):  # , half_dataset_available=False):
             values.append(stats_binned["CCstar"][i])
             values.append(stats_binned["rsplit"][i])
         # print(stats_print % tuple(values))
-        print(stats_print_format_values.format(*values))
+        print(stats_print_format_values.format(*values), file=log)
     return
 
 
-class MyArgumentParser(argparse.ArgumentParser):
-    """ Helper class for `argparse`
-
-    It adds an attribute `add_argument_with_check` that check if file
-    given in argument exist but not open it.
-    Inspired by `https://codereview.stackexchange.com/questions/28608/
-    checking-if-cli-arguments-are-valid-files-directories-in-python`
-    """
-    def __is_valid_file(self, parser, arg):
-        """Checks if file
-        given in argument `arg` exists but does not open it.
-        If not, abort.
-
-        Args:
-            self
-            parser: parser of `argparse`
-            arg (str): argument of `argparse`
-
-        Returns:
-            str: Name of the checked file
-        """
-        if not os.path.isfile(arg):
-            parser.error('The file {} does not exist!'.format(arg))
-        else:
-            # File exists so return the filename
-            return arg
-
-    def add_argument_with_check(self, *args, **kwargs):
-        """New attribute for `argparse` that checks if file
-        given in argument exist but does not open it.
-        """
-        # Look for your FILE settings
-        # type = lambda x: self.__is_valid_file(self, x) # PEP8 E731
-        def type(x):
-            return self.__is_valid_file(self, x)
-        kwargs['type'] = type
-        self.add_argument(*args, **kwargs)
-
-    def error(self, message):
-        sys.stderr.write('error: %s\n' % message)
-        print('Run `ccp4-python -m import_serial -h` to show the help message.')
-        sys.exit(2)
-
-
 def get_cell_cellfile(cellfile):
     with open(cellfile, 'r') as f:
         lines = f.readlines()
@@ -494,33 +920,36 @@ def get_cell_cellfile(cellfile):
     return cell, cell_string
 
 
-def get_cell_streamfile(streamfile):
+def get_cell_streamfile(streamfile, stream_summary=None, cell_estimate=None):
+    """Unit cell parameters of all crystals in a CrystFEL stream file, by
+    default their mean.
+    Args:
+        streamfile (str): Path to the stream file
+        stream_summary (StreamSummary): Result of `scan_streamfile()`,
+            the file is scanned if not given
+        cell_estimate (str): "mean", "median", "trimmed" or "cluster",
+            see `cells.robust_cell()`
+    Returns:
+        tuple: List of unit cell parameters and the same as string
+    """
+    if cell_estimate and cell_estimate != "mean":
+        return get_robust_cell_streamfile(streamfile, stream_summary, cell_estimate)
     cell = [None, None, None, None, None, None]
     cell_string = None
-    if os.path.isfile(streamfile + "_tmp"):
-        os.remove(streamfile + "_tmp")
-    with open(streamfile, "r") as file1:
-        with open(streamfile + "_tmp", "a+") as file2:
-            for line in file1:
-                if "Cell parameters " in line and len(line.split()) == 10:
-                    file2.write(line)
-    if os.path.isfile(streamfile + "_tmp"):
-        cell_df = pd.read_csv(
-            streamfile + "_tmp", header=None, index_col=False, sep=r'\s+',
-            names=("none1", "none2", "a", "b", "c", "none3", "alpha", "beta", "gamma", "none4"))
-        cell_df = cell_df.drop(columns=["none1", "none2", "none3", "none4"])
-        cell_df = cell_df.astype(float)
-        cell[0] = round(cell_df.mean()["a"] * 10, 2)
-        cell[1] = round(cell_df.mean()["b"] * 10, 2)
-        cell[2] = round(cell_df.mean()["c"] * 10, 2)
-        cell[3] = round(cell_df.mean()["alpha"], 2)
-        cell[4] = round(cell_df.mean()["beta"], 2)
-        cell[5] = round(cell_df.mean()["gamma"], 2)
+    if stream_summary is None:
+        stream_summary = scan_streamfile(streamfile)
+    cell_mean = stream_summary.mean_cell()
+    if cell_mean:
+        cell[0] = round(cell_mean[0] * 10, 2)
+        cell[1] = round(cell_mean[1] * 10, 2)
+        cell[2] = round(cell_mean[2] * 10, 2)
+        cell[3] = round(cell_mean[3], 2)
+        cell[4] = round(cell_mean[4], 2)
+        cell[5] = round(cell_mean[5], 2)
         cell_string = " ".join(map(str, cell))
         print("")
         print(f"Unit cell parameters fit using file {streamfile}:")
         print(cell_string)
-        os.remove(streamfile + "_tmp")
     else:
         sys.stderr.write(
             f"WARNING: Unit cell parameters could not be fitted from "
@@ -529,29 +958,59 @@ def get_cell_streamfile(streamfile):
     return cell, cell_string
 
 
-def get_wavelength_streamfile(streamfile):
-    energy_eV = None
-    wavelength = None
-    if os.path.isfile(streamfile + "_tmp"):
-        os.remove(streamfile + "_tmp")
-    with open(streamfile, "r") as file1:
-        with open(streamfile + "_tmp", "a+") as file2:
-            for line in file1:
-                if "photon_energy_eV" in line and len(line.split()) == 3:
-                    file2.write(line)
-    if os.path.isfile(streamfile + "_tmp"):
-        energy_eV_df = pd.read_csv(
-            streamfile + "_tmp", header=None, index_col=False, sep=r'\s+',
-            names=("none1", "none2", "energy_eV"))
-        energy_eV_df = energy_eV_df.drop(columns=["none1", "none2"])
-        energy_eV_df = energy_eV_df.astype(float)
-        energy_eV = energy_eV_df.median()["energy_eV"]
+def get_robust_cell_streamfile(streamfile, stream_summary=None, cell_estimate="median"):
+    """Robust estimate of the unit cell parameters from the cells of
+    individual crystals in a CrystFEL stream file.
+    Args:
+        streamfile (str): Path to the stream file
+        stream_summary (StreamSummary): Result of `summarize_stream()` with
+            the crystals, the file is indexed if not given
+        cell_estimate (str): "median", "trimmed" or "cluster"
+    Returns:
+        tuple: List of unit cell parameters and the same as string
+    """
+    if stream_summary is None or stream_summary.crystals is None:
+        stream_summary = summarize_stream(streamfile, crystals=True)
+    crystals = stream_summary.crystals
+    complete = crystals.complete()
+    cells = crystals.cells[complete]
+    labels = crystals.cluster()[complete] if cell_estimate == "cluster" else None
+    cell_robust = robust_cell(cells, cell_estimate, labels)
+    if cell_robust is None:
+        sys.stderr.write(
+            f"WARNING: Unit cell parameters could not be fitted from "
+            f"the file {streamfile}.\n")
+        return None, None
+    cell = [round(float(p), 2) for p in cell_robust]
+    cell_string = " ".join(map(str, cell))
+    mad = " ".join(str(round(float(p), 2)) for p in median_abs_deviation(cells))
+    print("")
+    print(f"Unit cell parameters fit using file {streamfile} "
+          f"({CELL_ESTIMATES[cell_estimate]}, {len(cells)} crystals):")
+    print(cell_string)
+    print(f"Median absolute deviation: {mad}")
+    return cell, cell_string
+
+
+def get_wavelength_streamfile(streamfile, stream_summary=None):
+    """Wavelength from the median photon energy of all chunks in
+    a CrystFEL stream file.
+    Args:
+        streamfile (str): Path to the stream file
+        stream_summary (StreamSummary): Result of `scan_streamfile()`,
+            the file is scanned if not given
+    Returns:
+        float: Wavelength or 0 if not found
+    """
+    if stream_summary is None:
+        stream_summary = scan_streamfile(streamfile)
+    energy_eV = stream_summary.median_energy()
+    if energy_eV:
         wavelength = 12398.425 / energy_eV
         wavelength = round(wavelength, 5)
         print("")
         print(f"Wavelength median using file {streamfile}:")
         print(str(wavelength))
-        os.remove(streamfile + "_tmp")
     else:
         sys.stderr.write(
             f"WARNING: Wavelength could not be fitted from "
@@ -561,7 +1020,8 @@ def get_wavelength_streamfile(streamfile):
 
 
 def get_wavelength_reference(ref):
-    if reflection_file_reader.any_reflection_file(ref).file_type() == 'ccp4_mtz':
+    from iotbx import mtz
+    if is_mtz_file(ref):
         try:
             mtz_object = mtz.object(file_name=ref)
             crystal = mtz.crystal(mtz_object=mtz_object, i_crystal=1)
@@ -580,175 +1040,380 @@ def get_wavelength_reference(ref):
     return wavelength
 
 
-def get_cs_reference(reference):
+REFERENCE_MEMO_SIZE = 32  # number of memoized symmetries of reference files
+
+
+@functools.lru_cache(maxsize=REFERENCE_MEMO_SIZE)
+def _read_cs_reference(path, fingerprint):
     from iotbx import file_reader
-    file = file_reader.any_file(reference)
+    return file_reader.any_file(path).crystal_symmetry()
+
+
+def get_cs_reference(reference, log=None):
+    """Crystal symmetry from a reference file (PDB, mmCIF or MTZ), memoized
+    (for the last `REFERENCE_MEMO_SIZE` files) by the content of the file,
+    e.g. when the same reference is used for many data sets in batch mode.
+    The symmetry and warnings are printed to `log` (default standard
+    output and standard error).
+    """
     try:
-        cs = file.crystal_symmetry()
-        spacegroup = file.crystal_symmetry().space_group().info()
-        cell = list(file.crystal_symmetry().unit_cell().parameters())
+        cs = _read_cs_reference(os.path.abspath(reference), file_fingerprint(reference))
+        spacegroup = cs.space_group().info()
+        cell = list(cs.unit_cell().parameters())
         for i in range(len(cell)):
             cell[i] = round(cell[i], 2)
         cell_string = " ".join(map(str, cell))
-        print("")
-        print(f"Symmetry from the reference file {reference}:")
-        print(str(cs))
+        print("", file=log)
+        print(f"Symmetry from the reference file {reference}:", file=log)
+        print(str(cs), file=log)
     except NotImplementedError:
-        sys.stderr.write(
+        (log or sys.stderr).write(
             f"WARNING: Symmetry could not be found in the provided "
             f"reference file {reference}.\n")
         return None, None, None
     return cs, spacegroup, cell_string
 
 
-def run():
-    from . import __version__
-    # if not which("f2mtz"):
-    #     sys.stderr.write(f"ERROR: Program f2mtz from CCP4 is not available.\n"
-    #                      "Did you source the paths to CCP4 executables?"
-    #                      "Aborting.\n")
-    #     sys.exit(1)
-    parser = MyArgumentParser(
-        description="Calculate statistics of serial MX data from xia2.ssx or CrystFEL and import them to CCP4"
-    )
-    parser.add_argument_with_check(
-        "--hklin", "--HKLIN",
-        help="Specify merged mtz file from xia2.ssx or merged hkl file from CrystFEL",
-        type=str,
-        required=True
-    )
-    parser.add_argument_with_check(
-        "--half-dataset",
-        metavar=("HKL1", "HKL2"),
-        help="CrystFEL only: two half-data-set merge files (usually .hkl1 and .hkl2)",
-        type=str,
-        nargs=2,
-    )
-    parser.add_argument(
-        "--wavelength", "-w",
-        type=float,
-        help="Wavelength (required for data from CrystFEL)",
-    )
-    parser.add_argument(
-        "--spacegroup",
-        type=str,
-        help="Space group",
-    )
-    parser.add_argument(
-        "--cell",
-        type=float,
-        nargs=6,
-        help="Unit cell parameters divided by spaces, e.g. 60 50 40 90 90 90",
-        metavar=("a", "b", "c", "alpha", "beta", "gamma"),
-    )
-    parser.add_argument_with_check(
-        "--cellfile",
-        help="Cell file from CrystFEL",
-        type=str,
-    )
-    parser.add_argument_with_check(
-        "--streamfile",
-        help="Stream file from CrystFEL",
-        type=str,
-    )
-    parser.add_argument_with_check(
-        "--reference", "--ref", "--pdb", "--cif", "--mmcif",
-        metavar="REFERENCE",
-        help="Reference file (PDB, mmCIF or MTZ) to provide spacegroup and unit cell",
-        type=str,
-        dest="ref",
-    )
-    parser.add_argument(
-        "--dmin", "--highres",
-        type=float,
-        help="High-resolution cutoff",
-        default=0,
-        dest='d_min',
-    )
-    parser.add_argument(
-        "--dmax", "--lowres",
-        type=float,
-        help="Low-resolution cutoff",
-        default=0,
-        dest='d_max',
-    )
-    parser.add_argument(
-        "--nbins", "--nshells",
-        type=int,
-        help="Number of resolution bins",
-        default=10,
-        dest='n_bins',
-    )
-    parser.add_argument(
-        "--project",
-        type=str,
-        help="Project name",
-    )
-    parser.add_argument(
-        "--crystal",
-        type=str,
-        help="Crystal name",
-        dest='cryst',
-    )
-    parser.add_argument(
-        "--dataset",
-        type=str,
-        help="Dataset name",
-    )
-    args = parser.parse_args()
+def get_hklin_format(hklin):
+    """Detects the format from the first bytes of the file.
+    Returns:
+        str: "dials" for an MTZ file from xia2.ssx, "crystfel" for
+            a reflection list from CrystFEL
+    """
+    if is_mtz_file(hklin):
+        return "dials"
+    return "crystfel"
 
-    print("")
-    print("Calculate statistics of serial MX data from xia2.ssx or CrystFEL and import them to CCP4")
-    print("")
-    print("Command line arguments:")
-    print(" ".join(sys.argv[1:]))
-    print("")
-    print("Input parameters:")
-    for arg in vars(args):
-        if getattr(args, arg):
-            print('  {} {}'.format(arg, getattr(args, arg) or ''))
 
-    hklin = args.hklin
-    if reflection_file_reader.any_reflection_file(hklin).file_type() == 'ccp4_mtz':
-        hklin_format = "dials"
-    elif reflection_file_reader.any_reflection_file(hklin).file_type() == None:
-        hklin_format = "crystfel"
-        spacegroup = None
-        cell = None
+def find_half_dataset(hklin):
+    """Half-data-set files next to a CrystFEL reflection list.
+    Returns:
+        tuple: Paths to the files .hkl1 and .hkl2 or None
+    """
+    if os.path.isfile(hklin) and os.path.isfile(hklin + "1") and os.path.isfile(hklin + "2"):
+        return (hklin + "1", hklin + "2")
+    return None
 
-    if not args.project:
-        project = "project"
+
+def read_mtz_dials(hklin):
+    """Merged intensities, multiplicities and half-data sets from an MTZ file
+    from xia2.ssx. Only the needed columns are converted to numpy arrays.
+    Returns:
+        tuple: Columns of merged data (including nmeas) and of half-data sets
+            (None if not available), crystal symmetry and anomalous flag
+    """
+    with MtzFile(hklin) as mtz_file:
+        labels = set(mtz_file.labels)
+        if not {"IMEAN", "SIGIMEAN", "N"} <= labels:
+            raise InputError(f"Columns IMEAN, SIGIMEAN and N were not found in the file {hklin}")
+        hkl = mtz_file.miller_indices()
+
+        def observations(label, valid=True):
+            # rows with an intensity and its sigma (missing values are NaN)
+            data = mtz_file.column(label)
+            sigmas = mtz_file.column("SIG" + label)
+            sel = valid & ~np.isnan(data) & ~np.isnan(sigmas)
+            columns = {"h": hkl[sel, 0], "k": hkl[sel, 1], "l": hkl[sel, 2],
+                       "I": data[sel], "sigma(I)": sigmas[sel]}
+            return columns, sel
+
+        # reflections with both intensity and multiplicity
+        nmeas = mtz_file.column("N")
+        merged, sel = observations("IMEAN", ~np.isnan(nmeas))
+        merged["nmeas"] = nmeas[sel]
+        if {"IHALF1", "SIGIHALF1", "IHALF2", "SIGIHALF2"} <= labels:
+            half1 = observations("IHALF1")[0]
+            half2 = observations("IHALF2")[0]
+        else:
+            half1 = None
+            half2 = None
+        cs = mtz_file.crystal_symmetry("IMEAN")
+    return merged, half1, half2, cs, False
+
+
+def read_reflections(hklin, hklin_format, half_dataset=None, cache=None, profiler=None,
+                     concurrent=False):
+    """Reads the merged data and half-data sets.
+    Args:
+        hklin (str): Merged data: reflection list from CrystFEL or MTZ file
+            from xia2.ssx
+        hklin_format (str): "crystfel" or "dials"
+        half_dataset (tuple): CrystFEL only: two half-data-set files
+        cache (Cache): Cache of parsed reflection lists
+        profiler (Profiler): Timing of the stage "parse"
+        concurrent (bool): Read the CrystFEL files in a pool of threads
+            (parsing with NumPy mostly releases the GIL)
+    Returns:
+        tuple: Columns of the merged data set and of the half-data sets
+            (or None), crystal symmetry and anomalous flag (xia2.ssx only)
+    """
+    files = [hklin] + list(half_dataset or [])
+    with stage(profiler, "parse", input_bytes=file_size(*files)) as sizes:
+        if hklin_format == "dials":
+            merged, half1, half2, cs, anomalous_flag = read_mtz_dials(hklin)
+        else:
+            if concurrent and len(files) > 1:
+                with ThreadPoolExecutor(max_workers=len(files)) as executor:
+                    data = list(executor.map(read_hkl_crystfel, files, [cache] * len(files)))
+            else:
+                data = [read_hkl_crystfel(filename, cache) for filename in files]
+            merged, half1, half2 = data + [None] * (3 - len(data))
+            cs = None
+            anomalous_flag = None
+        sizes["n_reflections"] = sum(len(data["I"]) for data in (merged, half1, half2) if data)
+    return merged, half1, half2, cs, anomalous_flag
+
+
+def submit_summarize_stream(streamfile, nproc=1, stream_index=False, crystals=False,
+                            reflections=False):
+    """Starts the scan of a stream file (or loading of its index) in the
+    background, in a worker process so that it does not compete for the GIL
+    with parsing of the reflection files, or with `nproc` > 1 in a thread
+    waiting for the pool of processes of the scan.
+    Returns:
+        concurrent.futures.Future: StreamSummary and its measures from `timed()`
+    """
+    if nproc > 1:
+        executor = ThreadPoolExecutor(max_workers=1)
     else:
-        project = args.project
-    if not args.cryst:
-        cryst = "crystal"
+        executor = ProcessPoolExecutor(max_workers=1)
+    future = executor.submit(
+        timed, summarize_stream, streamfile, nproc, stream_index, crystals, reflections)
+    executor.shutdown(wait=False)
+    return future
+
+
+def read_stream_halves(streamfile, cs, nproc=1, stream_index=False, profiler=None):
+    """Half-data sets merged from two random halves of the crystals in
+    a stream file, see `merge_stream_halves()`.
+    Returns:
+        tuple: Columns of the two half-data sets
+    """
+    with stage(profiler, "stream_merge", input_bytes=file_size(streamfile)) as sizes:
+        if stream_index:
+            index = get_stream_index(streamfile, nproc)
+        else:
+            index = build_stream_index(streamfile, nproc)
+        half1, half2, n_crystals = merge_stream_halves(index, cs.space_group_info(), nproc)
+        sizes["n_reflections"] = int(half1["nmeas"].sum() + half2["nmeas"].sum())
+    print(
+        f"Half-data sets were merged from the stream file {streamfile} "
+        f"(random halves of {n_crystals[0]} and {n_crystals[1]} crystals, without scaling), "
+        f"CC1/2, CC* and Rsplit are approximate")
+    return half1, half2
+
+
+def load_reflection_table(hklin, hklin_format, cs=None, half_dataset=None,
+                          d_max=0, d_min=0, n_bins=10, cache=None, profiler=None,
+                          reflections=None, concurrent=False, log=None):
+    """Reads the merged data (and half-data sets) to a table of reflections.
+    Args:
+        hklin (str): Merged data: reflection list from CrystFEL or MTZ file
+            from xia2.ssx
+        hklin_format (str): "crystfel" or "dials"
+        cs (cctbx.crystal.symmetry): Symmetry, required for CrystFEL
+        half_dataset (tuple): CrystFEL only: two half-data-set files
+        d_max, d_min (float): Resolution cutoffs
+        n_bins (int): Number of resolution bins
+        cache (Cache): Cache of parsed reflection lists
+        profiler (Profiler): Timing of the stages "parse" and "binning"
+        reflections (tuple): Data already read by `read_reflections()`
+        concurrent (bool): Read the CrystFEL files concurrently
+        log (file): Stream for the warnings (default standard error)
+    Returns:
+        tuple: ReflectionTable and crystal symmetry
+    Raises:
+        InputError: No reflections were read from `hklin`
+    """
+    if reflections is None:
+        reflections = read_reflections(
+            hklin, hklin_format, half_dataset, cache, profiler, concurrent)
+    merged, half1, half2, mtz_cs, anomalous_flag = reflections
+    if not len(merged["I"]):
+        raise InputError(f"No reflections read from {hklin}")
+    if hklin_format == "dials":
+        cs = mtz_cs
+    n_reflections = sum(len(data["I"]) for data in (merged, half1, half2) if data)
+    # resolution cutoff, asymmetric unit and binning applied once to all data
+    with stage(profiler, "binning", n_reflections=n_reflections):
+        mapped = None
+        if cache and hklin_format == "crystfel":
+            files = [hklin] + list(half_dataset or [])
+            mapped = [map_hkl_to_asu(filename, data, cs, cache)
+                      for filename, data in zip(files, (merged, half1, half2))]
+        table = build_reflection_table(
+            cs, merged, half1, half2, anomalous_flag, d_max=d_max, d_min=d_min, n_bins=n_bins,
+            mapped=mapped)
+    report_unmatched(table, log=log)
+    return table, cs
+
+
+def report_unmatched(table, n_examples=5, log=None):
+    """Warns about reflections missing in some of the data sets (matched
+    by Miller indices in the asymmetric unit)."""
+    names = {"merged": "merged data set", "half1": "half-data set 1", "half2": "half-data set 2"}
+    lines = []
+    for name, indices in table.unmatched().items():
+        if indices.size:
+            examples = "; ".join(" ".join(str(i) for i in hkl) for hkl in indices[:n_examples])
+            lines.append(f"  {names[name]}: {len(indices)} (e.g. {examples})\n")
+    if lines:
+        (log or sys.stderr).write(
+            "WARNING: Reflections missing in the other data sets "
+            "(excluded from CC1/2, CC* and Rsplit):\n" + "".join(lines))
+
+
+def stats_cache_key(hklin, half_dataset, cs, d_max, d_min, n_bins, stream_halves=None):
+    """Statistics depend only on the input files, symmetry and parameters.
+    Half-data sets merged from a stream file (`stream_halves`) are
+    identified by the stream file and the seed of the split of crystals,
+    without hashing the whole stream file."""
+    inputs = [file_fingerprint(hklin)]
+    if stream_halves:
+        inputs += [stream_file_id(stream_halves), STREAM_SPLIT_SEED]
+    elif half_dataset:
+        inputs += [file_fingerprint(half) for half in half_dataset]
+    return (*inputs, symmetry_key(cs), d_max, d_min, n_bins)
+
+
+def calc_stats(table, cache=None, stats_key=None, sweep_dmin=None, sweep_shells=None,
+               cc_min=None, ccstar_min=None, isigi_min=None, profiler=None, log=None):
+    """Calculates and prints statistics of merged data, of half-data sets
+    (if available) and optionally a sweep of high-resolution cutoffs.
+    Args:
+        table (ReflectionTable): Reflections
+        cache (Cache): Cache of the statistics
+        stats_key (tuple): Fingerprints of the input files, symmetry and
+            parameters identifying the statistics in the cache
+        sweep_dmin (list): High-resolution cutoffs for the sweep
+        sweep_shells (int): Number of cutoffs for the sweep if `sweep_dmin`
+            is not given (default 50 if a threshold is given)
+        cc_min, ccstar_min, isigi_min (float): Thresholds for the outer
+            shell to suggest a high-resolution cutoff
+        profiler (Profiler): Timing of the stages "statistics" and "sweep"
+        log (file): Stream for the printed output and warnings (default
+            standard output and standard error)
+    Returns:
+        dict: Statistics "overall" and "binned" (and "cumulative", "sweep")
+    """
+    print("Overall values:\n", file=log)
+    with stage(profiler, "statistics", n_reflections=len(table)):
+        stats = calc_stats_table(table, cache, stats_key, log)
+    print("\nBinned values:\n", file=log)
+    stats_binned_print(stats["binned"], log)
+
+    thresholds = cc_min is not None or ccstar_min is not None or isigi_min is not None
+    if sweep_dmin or sweep_shells or thresholds:
+        print("\nResolution cutoff sweep:\n", file=log)
+        if sweep_dmin:
+            cutoffs = sweep_dmin
+        else:
+            cutoffs = sweep_cutoffs(table, sweep_shells or 50)
+        with stage(profiler, "sweep", n_reflections=len(table), n_cutoffs=len(cutoffs)):
+            stats.update(calc_stats_sweep(
+                table, cutoffs, cc_min, ccstar_min, isigi_min, log))
+    return stats
+
+
+def calc_stats_table(table, cache=None, stats_key=None, log=None):
+    """Overall and binned statistics of merged data and of half-data sets
+    (if available), cached if `cache` is given, printed to `log` (default
+    standard output).
+    Returns:
+        dict: Statistics "overall", "binned" (and "cumulative")
+    """
+    if cache:
+        # statistics depend only on the input files, symmetry and parameters
+        stats_merged = cache.call(
+            cache.key("stats_merged", *stats_key), calc_stats_merged, table, log=log)
     else:
-        dataset = args.dataset
-    if not args.dataset:
-        dataset = "dataset"
+        stats_merged = calc_stats_merged(table, log)
+    if table.has_halves:
+        # calculate statistics CC1/2, CC* and Rsplit
+        if cache:
+            stats_compare = cache.call(
+                cache.key("stats_compare", *stats_key), calc_stats_compare, table, log=log)
+        else:
+            stats_compare = calc_stats_compare(table, log)
     else:
-        dataset = args.dataset
-    prefix = f"{project}_{dataset}"
-    prefix = "".join(i for i in prefix if i not in r"\/:*?<>|")
-    hklout = f"{prefix}.mtz"
-    logout = f"{prefix}.html"
-    jsonout = f"{prefix}.json"
-    xmlout = "program.xml"
-    # xmlout = f"{prefix}.xml"
-    d_max = args.d_max
-    d_min = args.d_min
-    n_bins = args.n_bins
+        stats_compare = None
+    return combine_stats(stats_merged, stats_compare)
 
-    # wavelength required for CrystFEL
-    if hklin_format == "crystfel" and not args.wavelength:
-        sys.stderr.write(
-            "ERROR: Wavelength is not specified but required for CrystFEL.\n"
-            "Specify wavelength (option  --wavelength)\n")
-        sys.stderr.write("Aborting.\n")
-        sys.exit(1)
-    else:
-        wavelength = args.wavelength
-    # process symmetry: space group and unit cell parameters
+
+def combine_stats(stats_merged, stats_compare=None):
+    """Overall and binned statistics of merged data from `calc_stats_merged()`
+    and of half-data sets from `calc_stats_compare()` (if available), with
+    CC1/2, CC* and Rsplit cumulative up to the high-resolution limit d_min
+    of each bin.
+    Returns:
+        dict: Statistics "overall", "binned" (and "cumulative")
+    """
+    if stats_compare:
+        stats_overall = {**stats_merged["overall"], **stats_compare["overall"]}
+        stats_binned = {**stats_merged["binned"], **stats_compare["binned"]}
+        stats_cumulative = {"d_min": stats_merged["binned"]["d_min"],
+                            **stats_compare["cumulative"]}
+        return {"overall": stats_overall, "binned": stats_binned,
+                "cumulative": stats_cumulative}
+    stats_overall = {**stats_merged["overall"]}
+    stats_binned = {**stats_merged["binned"]}
+    return {"overall": stats_overall, "binned": stats_binned}
+
+
+def write_stats(stats, jsonout, xmlout):
+    """Writes statistics to a JSON and an XML file."""
+    stats_json = json.dumps(stats, indent=4)
+    stats_xml = stats_to_xml(stats)  #, xmlout)
+    with open(jsonout, "w") as f:
+        f.write(stats_json)
+    with open(xmlout, "w") as f:
+        f.write(stats_xml)
+
+
+def save_results_db(results_db, stats, metadata, inputs, streamfile=None):
+    """Appends the statistics of a run to the results database, a failure
+    to write it is only reported.
+    Args:
+        results_db (str): Path to the SQLite database
+        stats (dict): Statistics as in the JSON output
+        metadata (dict): Project, dataset, symmetry etc., see `add_run()`
+        inputs (list): Input files identified by the hashes of their content
+        streamfile (str): Stream file, identified by its size, modification
+            time and the hash of its beginning and end
+    """
+    try:
+        fingerprints = {os.path.abspath(path): file_fingerprint(path) for path in inputs}
+        if streamfile:
+            fingerprints[os.path.abspath(streamfile)] = stream_file_id(streamfile).decode()
+        run_id = add_run(results_db, stats, dict(metadata, inputs=fingerprints))
+    except (OSError, sqlite3.Error) as e:
+        sys.stderr.write(f"WARNING: Results could not be saved to the database {results_db}: {e}\n")
+        return
+    print(f"\nResults saved to the database {results_db} (run {run_id})")
+
+
+def write_mtz_crystfel(table, hklout, wavelength):
+    """Writes merged intensities and multiplicities in the original order
+    of the CrystFEL reflection list to an MTZ file."""
+    m_all_i, m_all_nmeas = table.input_order_arrays()
+    mtz_dataset = m_all_i.as_mtz_dataset(column_root_label="IMEAN", wavelength=wavelength)
+    mtz_dataset.add_miller_array(m_all_nmeas, column_root_label="NMEAS")
+    # mtz_dataset.add_miller_array(r_free_flags, column_root_label="FreeR_flag")
+    mtz_dataset.mtz_object().write(file_name=hklout)
+
+
+def get_symmetry(args, hklin_format, get_stream_summary=None):
+    """Crystal symmetry from the options --spacegroup with --cell, --cellfile
+    or --streamfile, or from the reference file. Aborts if the symmetry is
+    required (CrystFEL) and not found.
+    Args:
+        args (argparse.Namespace): Options of the program
+        hklin_format (str): "crystfel" or "dials"
+        get_stream_summary (callable): Returns the StreamSummary of the
+            stream file, the file is scanned if not given
+    Returns:
+        cctbx.crystal.symmetry: Symmetry or None
+    """
     cs = None
     if args.spacegroup:
         if args.cell:
@@ -756,7 +1421,9 @@ def run():
         elif args.cellfile:
             cell, cell_string = get_cell_cellfile(args.cellfile)
         elif args.streamfile:
-            cell, cell_string = get_cell_streamfile(args.streamfile)
+            stream_summary = get_stream_summary() if get_stream_summary else None
+            cell, cell_string = get_cell_streamfile(
+                args.streamfile, stream_summary, args.cell_estimate)
         if args.cell or args.cellfile or args.streamfile:  # everything except reference file
             spacegroup = args.spacegroup
             cs = crystal.symmetry(
@@ -790,83 +1457,246 @@ def run():
                 "or provide reference PDB, mmCIF or MTZ file (option --reference).\n")
         sys.stderr.write("Aborting.\n")
         sys.exit(1)
+    return cs
+
+
+def get_wavelength(args, hklin_format, get_stream_summary=None):
+    """Wavelength from the option --wavelength or (CrystFEL only) from the
+    stream file or the reference file. Aborts if it is required (CrystFEL)
+    and not found.
+    Args:
+        args (argparse.Namespace): Options of the program
+        hklin_format (str): "crystfel" or "dials"
+        get_stream_summary (callable): Returns the StreamSummary of the
+            stream file, the file is scanned if not given
+    Returns:
+        float: Wavelength or None
+    """
+    wavelength = args.wavelength
     if hklin_format == "crystfel" and args.streamfile and not wavelength:
-        wavelength = get_wavelength_streamfile(args.streamfile)
+        stream_summary = get_stream_summary() if get_stream_summary else None
+        wavelength = get_wavelength_streamfile(args.streamfile, stream_summary)
     elif hklin_format == "crystfel" and args.ref and not wavelength:
         wavelength = get_wavelength_reference(args.ref)
+    if hklin_format == "crystfel" and not wavelength:
+        sys.stderr.write(
+            "ERROR: Wavelength is not specified but required for CrystFEL.\n"
+            "Specify wavelength (option  --wavelength)\n")
+        sys.stderr.write("Aborting.\n")
+        sys.exit(1)
+    return wavelength
+
+
+def stop_jobs(jobs, children):
+    """Stops the jobs running in the background when a run aborts: pending
+    jobs are cancelled and the worker processes started since `children`
+    were listed (e.g. of the scan of a stream file) are terminated until
+    the jobs are done. Otherwise the interpreter would wait for them at
+    exit, as it joins the pools of `concurrent.futures`.
+    Args:
+        jobs (list): Jobs (concurrent.futures.Future)
+        children (set): Child processes to keep, from
+            `multiprocessing.active_children()`
+    """
+    for job in jobs:
+        job.cancel()
+    while True:
+        # a job in a thread may start another pool of processes
+        for process in multiprocessing.active_children():
+            if process not in children:
+                process.terminate()
+        running = [job for job in jobs if not job.done()]
+        if not running:
+            break
+        wait(running, timeout=0.1)
+
+
+def run(argv=None):
+    """Runs import_serial with the command line arguments `argv`. If it
+    aborts, the jobs still running in the background are stopped.
+    Returns:
+        dict: Statistics as saved to the JSON file, None if they could
+        not be calculated
+    """
+    jobs = []  # jobs started in the background
+    children = set(multiprocessing.active_children())
+    try:
+        return _run(argv, jobs)
+    except BaseException:  # also SystemExit after an error
+        stop_jobs(jobs, children)
+        raise
+
+
+def _run(argv, jobs):
+    # if not which("f2mtz"):
+    #     sys.stderr.write(f"ERROR: Program f2mtz from CCP4 is not available.\n"
+    #                      "Did you source the paths to CCP4 executables?"
+    #                      "Aborting.\n")
+    #     sys.exit(1)
+    if argv is None:
+        argv = sys.argv[1:]
+    args = get_parser().parse_args(argv)
+
+    print("")
+    print("Calculate statistics of serial MX data from xia2.ssx or CrystFEL and import them to CCP4")
+    print("")
+    print("Command line arguments:")
+    print(" ".join(argv))
+    print("")
+    print("Input parameters:")
+    for arg in vars(args):
+        if getattr(args, arg):
+            print('  {} {}'.format(arg, getattr(args, arg) or ''))
+
+    hklin = args.hklin
+    try:
+        hklin_format = get_hklin_format(hklin)
+    except InputError as e:
+        sys.stderr.write(f"ERROR: {e}\n")
+        sys.stderr.write("Aborting.\n")
+        sys.exit(1)
+    if hklin_format == "crystfel":
+        spacegroup = None
+        cell = None
+
+    if not args.project:
+        project = "project"
+    else:
+        project = args.project
+    if not args.cryst:
+        cryst = "crystal"
+    else:
+        dataset = args.dataset
+    if not args.dataset:
+        dataset = "dataset"
+    else:
+        dataset = args.dataset
+    prefix = f"{project}_{dataset}"
+    prefix = "".join(i for i in prefix if i not in r"\/:*?<>|")
+    hklout = f"{prefix}.mtz"
+    logout = f"{prefix}.html"
+    jsonout = f"{prefix}.json"
+    xmlout = "program.xml"
+    # xmlout = f"{prefix}.xml"
+    d_max = args.d_max
+    d_min = args.d_min
+    n_bins = args.n_bins
+    cache = None
+    if args.cache_dir:
+        cache = Cache(args.cache_dir, args.cache_size or CACHE_SIZE_MB)
+    profiler = Profiler(args.profile, args.profile_dir)
+
+    if (args.cell_estimate or args.cell_table or args.crystal_stats or args.stream_halves) \
+            and not args.streamfile:
+        sys.stderr.write(
+            "WARNING: Options --cell-estimate, --cell-table, --crystal-stats and --stream-halves "
+            "require a stream file (option --streamfile), they are ignored.\n")
+    # wavelength required for CrystFEL, it can be found in a stream or MTZ file
+    if hklin_format == "crystfel" and not args.wavelength \
+            and not args.streamfile and not args.ref:
+        sys.stderr.write(
+            "ERROR: Wavelength is not specified but required for CrystFEL.\n"
+            "Specify wavelength (option  --wavelength)\n")
+        sys.stderr.write("Aborting.\n")
+        sys.exit(1)
+    else:
+        wavelength = args.wavelength
+
+    # the stream file is scanned and the reflection files are read in the
+    # background while the symmetry and wavelength are found; with
+    # --profile, the stages run one after another to measure each of them
+    stream_summary = None  # cell parameters and wavelength from one scan
+    stream_job = None
+    # unit cells of individual crystals from the index of the stream file
+    crystals = bool(args.streamfile and (args.cell_estimate or args.cell_table))
+    crystal_reflections = bool(args.streamfile and args.crystal_stats)
+    if args.streamfile and (
+            args.stream_index or crystals or crystal_reflections
+            or (args.spacegroup and not args.cell and not args.cellfile)
+            or (hklin_format == "crystfel" and not wavelength)):
+        if profiler.profile:
+            with profiler.stage("stream_scan", input_bytes=file_size(args.streamfile)):
+                stream_summary = summarize_stream(args.streamfile, args.nproc or 1,
+                                                  args.stream_index, crystals, crystal_reflections)
+        else:
+            stream_job = submit_summarize_stream(
+                args.streamfile, args.nproc or 1, args.stream_index, crystals, crystal_reflections)
+            jobs.append(stream_job)
+    if hklin_format == "crystfel":
+        half_dataset = args.half_dataset or find_half_dataset(hklin)
+    else:
+        half_dataset = None
+    # half-data sets merged from the stream file once the symmetry is known
+    stream_halves = bool(args.stream_halves and args.streamfile and hklin_format == "crystfel"
+                         and not half_dataset)
+    reflections_job = None
+    if not profiler.profile:
+        executor = ThreadPoolExecutor(max_workers=1)
+        reflections_job = executor.submit(
+            read_reflections, hklin, hklin_format, half_dataset, cache, profiler, True)
+        executor.shutdown(wait=False)
+        jobs.append(reflections_job)
+
+    def get_stream_summary():
+        nonlocal stream_summary
+        if stream_summary is None:
+            try:
+                stream_summary, measures = stream_job.result()
+            except Exception as e:
+                sys.stderr.write(f"ERROR: Stream file {args.streamfile} could not be read: "
+                                 f"{type(e).__name__}: {e}\n")
+                sys.stderr.write("Aborting.\n")
+                sys.exit(1)
+            profiler.add("stream_scan", measures, input_bytes=file_size(args.streamfile))
+        return stream_summary
+
+    cs = get_symmetry(args, hklin_format, get_stream_summary)
+    wavelength = get_wavelength(args, hklin_format, get_stream_summary)
 
     print("")
     print("")
     print("DATA STATISTICS:")
     print("================")
     print("")
+    stats = None
     try:
-        m1 = None
-        m2 = None
-        # load data to Miller arrays
-        if hklin_format == "dials":
-            # miller_arrays = reflection_file_reader.any_reflection_file(file_name=hklin).as_miller_arrays()
-            miller_arrays = mtz.object(hklin).as_miller_arrays()
-            m_all_i = None
-            m1_all_nmeas = None
-            m2_all_nmeas = None
-            for i, column in enumerate(miller_arrays):
-                # print(str(column.info().labels))
-                # if column.is_xray_intensity_array() and str(column.info()).split(".mtz:")[1].split(",")[0] == "IMEAN":
-                # elif column.is_xray_intensity_array() and str(column.info()).split(".mtz:")[1].split(",")[0] == "IHALF1":
-                # elif column.is_xray_intensity_array() and str(column.info()).split(".mtz:")[1].split(",")[0] == "IHALF2":
-                if column.is_xray_intensity_array() and column.info().labels == ["IMEAN", "SIGIMEAN"]:
-                    m_all_i = column
-                elif column.is_xray_intensity_array() and column.info().labels == ["IHALF1", "SIGIHALF1"]:
-                    m1 = column
-                elif column.is_xray_intensity_array() and column.info().labels == ["IHALF2", "SIGIHALF2"]:
-                    m2 = column
-                elif column.info().labels == ['N']:
-                    m_all_nmeas = column.as_double()
-        elif hklin_format == "crystfel":
-            if args.half_dataset:
-                half_dataset = args.half_dataset
-            elif os.path.isfile(hklin) and os.path.isfile(hklin + "1") and os.path.isfile(hklin + "2"):
-                half_dataset = (hklin + "1", hklin + "2")
-                print(
-                    f"Half-dataset files were found automatically and will be used "
-                    f"for calculation of statistics: {half_dataset[0]} {half_dataset[1]}")
-            else:
-                half_dataset = None
-            m_all_i = get_miller_array_crystfel(hklin, cs, "I", d_max=d_max, d_min=d_min)
-            m_all_nmeas = get_miller_array_crystfel(hklin, cs, "nmeas", d_max=d_max, d_min=d_min)
-            if half_dataset:
-                m1 = get_miller_array_crystfel(half_dataset[0], cs, "I", d_max=d_max, d_min=d_min)
-                m2 = get_miller_array_crystfel(half_dataset[1], cs, "I", d_max=d_max, d_min=d_min)
-
-        # set d_min, d_max and binning to miller arrays
-        m_all_i = m_all_i.resolution_filter(d_max=d_max, d_min=d_min)
-        m_all_nmeas = m_all_nmeas.resolution_filter(d_max=d_max, d_min=d_min)
-        m_all_i.setup_binner(n_bins=n_bins)
-        m_all_nmeas.use_binning(m_all_i.binner())
-
-        # calculate and print statistics
-        print("Overall values:\n")
-        stats_merged = calc_stats_merged(m_all_i, m_all_nmeas, d_max, d_min, n_bins)
-        if m1 and m2:
-            # calculate statistics CC1/2, CC* and Rsplit
-            stats_compare = calc_stats_compare(m_all_i, m1, m2, d_max, d_min, n_bins)
-            stats_overall = {**stats_merged["overall"], **stats_compare["overall"]}
-            stats_binned = {**stats_merged["binned"], **stats_compare["binned"]}
-        else:
-            stats_overall = {**stats_merged["overall"]}
-            stats_binned = {**stats_merged["binned"]}
-        print("\nBinned values:\n")
-        stats_binned_print(stats_binned)
-        
-        # save statistics to files
-        stats = {"overall": stats_overall, "binned": stats_binned}
-        stats_json = json.dumps(stats, indent=4)
-        stats_xml = stats_to_xml(stats)  #, xmlout)
-        with open(jsonout, "w") as f:
-            f.write(stats_json)
-        with open(xmlout, "w") as f:
-            f.write(stats_xml)
+        # load data to a table of reflections
+        if hklin_format == "crystfel" and half_dataset and not args.half_dataset:
+            print(
+                f"Half-dataset files were found automatically and will be used "
+                f"for calculation of statistics: {half_dataset[0]} {half_dataset[1]}")
+        reflections = reflections_job.result() if reflections_job else None
+        if stream_halves:
+            if reflections is None:
+                reflections = read_reflections(hklin, hklin_format, None, cache, profiler)
+            merged, _, _, mtz_cs, anomalous_flag = reflections
+            half1, half2 = read_stream_halves(
+                args.streamfile, cs, args.nproc or 1, args.stream_index, profiler)
+            reflections = merged, half1, half2, mtz_cs, anomalous_flag
+        table, cs = load_reflection_table(
+            hklin, hklin_format, cs, half_dataset, d_max, d_min, n_bins, cache, profiler,
+            reflections)
+    except InputError as e:
+        sys.stderr.write(f"ERROR: {e}\n")
+        sys.stderr.write("Aborting.\n")
+        sys.exit(1)
+    except (RuntimeError, ValueError) as e:
+        # without the table, neither statistics nor the MTZ file can be written
+        traceback.print_exc()
+        sys.stderr.write(f"ERROR: Reflections could not be read from {hklin}: {e}\n")
+        sys.stderr.write("Aborting.\n")
+        sys.exit(1)
+
+    # calculate and print statistics
+    try:
+        stats_key = None
+        if cache:
+            stats_key = stats_cache_key(
+                hklin, half_dataset, cs, d_max, d_min, n_bins,
+                args.streamfile if stream_halves else None)
+        stats = calc_stats(
+            table, cache, stats_key, args.sweep_dmin, args.sweep_shells,
+            args.cc_min, args.ccstar_min, args.isigi_min, profiler)
     except RuntimeError:
         traceback.print_exc()
         sys.stderr.write("WARNING: Statistics could not be calculated.\n")
@@ -895,21 +1725,61 @@ def run():
     #    # rc = p.returncode
     # remove hkltmp ?
     # print(f"MTZ file created: {hklout}")
-    if hklin_format == "crystfel":
-        mtz_dataset = m_all_i.as_mtz_dataset(column_root_label="IMEAN", wavelength=wavelength)
-        mtz_dataset.add_miller_array(m_all_nmeas, column_root_label="NMEAS")
-        # mtz_dataset.add_miller_array(r_free_flags, column_root_label="FreeR_flag")
-        mtz_dataset.mtz_object().write(file_name=hklout)
-        print(f"\nMTZ file created: {hklout}")
-        # Clean up a bit
-        files_to_remove = [hklin + "_tmp"]
-        if half_dataset:
-            files_to_remove += [f'{half_dataset[0]}_tmp']
-            files_to_remove += [f'{half_dataset[1]}_tmp']
-        for f in files_to_remove:
-            if os.path.isfile(f):
-                os.remove(f)
-    elif hklin_format == "dials":
-        import shutil
-        shutil.copy2(hklin, hklout)
-    return
+    with profiler.stage("output") as sizes:
+        if hklin_format == "crystfel":
+            write_mtz_crystfel(table, hklout, wavelength)
+            print(f"\nMTZ file created: {hklout}")
+        elif hklin_format == "dials":
+            import shutil
+            shutil.copy2(hklin, hklout)
+        sizes["output_bytes"] = file_size(hklout)
+    if stream_job:
+        get_stream_summary()  # only the index of the stream file was requested
+    if crystals:
+        cell_table = stream_summary.crystals
+        complete = cell_table.complete()
+        labels = cell_table.cluster()
+        if stats is not None:
+            stats["unit_cell"] = cell_distribution(cell_table.cells[complete], labels[complete])
+        if args.cell_table:
+            cell_table.save(args.cell_table, labels)
+            print(f"\nUnit cell parameters of {len(cell_table)} crystals saved: {args.cell_table}")
+    if crystal_reflections:
+        crystal_stats = stream_summary.crystal_stats
+        crystal_stats_summary = crystal_stats.summary()
+        if stats is not None:
+            stats["crystal_stats"] = crystal_stats_summary
+        crystal_stats.save(args.crystal_stats)
+        print("")
+        print(f"Reflections of crystals in the stream file {args.streamfile}:")
+        print(format_crystal_stats(crystal_stats_summary))
+        print(f"Statistics of {len(crystal_stats)} crystals saved: {args.crystal_stats}")
+    # save statistics and performance of the stages to files
+    if stats is not None:
+        stats["performance"] = profiler.as_dict()
+        write_stats(stats, jsonout, xmlout)
+        if args.results_db:
+            unit_cell = cs.unit_cell().parameters() if cs and cs.unit_cell() else None
+            metadata = {
+                "project": project,
+                "crystal": args.cryst or "crystal",
+                "dataset": dataset,
+                "hklin": os.path.abspath(hklin),
+                "hklin_format": hklin_format,
+                "spacegroup": str(cs.space_group_info()) if cs else None,
+                "cell": [round(p, 4) for p in unit_cell] if unit_cell else None,
+                "wavelength": wavelength or None,
+                "d_max_cutoff": d_max or None,
+                "d_min_cutoff": d_min or None,
+                "command": " ".join(argv),
+            }
+            save_results_db(args.results_db, stats, metadata, [hklin] + list(half_dataset or []),
+                            args.streamfile)
+    if cache:
+        print(cache.report())
+    if profiler.profile:
+        print("\nPerformance:\n")
+        print(profiler.report())
+        if args.profile_dir:
+            print(f"\ncProfile statistics of the stages saved to {args.profile_dir}")
+    return stats
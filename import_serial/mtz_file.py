@@ -0,0 +1,73 @@
+# coding: utf-8
+"""Selected columns of MTZ files as numpy arrays, read with iotbx.mtz (the
+file is read once, the columns are converted one by one on request)"""
+import numpy as np
+from .mtz_format import is_mtz_file
+
+
+class MtzFile:
+    """Header and reflection data of an MTZ file.
+
+    Attributes:
+        labels (list): Column labels
+        types (dict): Column types by labels
+        n_reflections (int): Number of reflections
+    """
+    def __init__(self, filename):
+        from iotbx import mtz
+        self.filename = filename
+        if not is_mtz_file(filename):
+            raise ValueError(f"{filename} is not an MTZ file")
+        self._mtz = mtz.object(filename)
+        self.labels = list(self._mtz.column_labels())
+        self.types = dict(zip(self.labels, self._mtz.column_types()))
+        self.n_reflections = self._mtz.n_reflections()
+
+    def column(self, label):
+        """Returns:
+            numpy.ndarray: Values (float64), NaN for missing values
+        """
+        values = self._mtz.get_column(label).extract_values_and_selection_valid(-1)
+        column = values.values.as_numpy_array().astype(np.float64)
+        column[~values.selection_valid.as_numpy_array()] = np.nan
+        return column
+
+    def miller_indices(self):
+        """Returns:
+            numpy.ndarray: Miller indices (n, 3)
+        """
+        from .reflections import miller_indices_as_numpy
+        return miller_indices_as_numpy(self._mtz.extract_miller_indices())
+
+    def dataset(self, label):
+        """Returns:
+            dict: Project, crystal, dataset, unit cell and wavelength of the
+                dataset of a column
+        """
+        column = self._mtz.get_column(label)
+        crystal = column.mtz_crystal()
+        dataset = column.mtz_dataset()
+        return {"project": crystal.project_name(), "crystal": crystal.name(),
+                "dataset": dataset.name(), "cell": crystal.unit_cell_parameters(),
+                "wavelength": dataset.wavelength()}
+
+    def crystal_symmetry(self, label=None):
+        """Crystal symmetry with the unit cell of the dataset of the column
+        `label` (or the global unit cell).
+        Returns:
+            cctbx.crystal.symmetry
+        """
+        from cctbx import crystal
+        cell = self.dataset(label)["cell"] if label else None
+        if not cell or not any(cell):
+            cell = self._mtz.crystals()[0].unit_cell_parameters()  # HKL_base
+        return crystal.symmetry(unit_cell=cell, space_group_info=self._mtz.space_group_info())
+
+    def close(self):
+        self._mtz = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,15 @@
+# coding: utf-8
+"""Markers of the MTZ file format, to recognize MTZ files and to check
+that they were written completely without reading them"""
+
+
+MTZ_MAGIC = b"MTZ "
+MTZ_RECORD = 80  # length of the header records
+MTZ_END = b"MTZENDOFHEADERS"  # last header record, at the end of the file
+
+
+def is_mtz_file(filename):
+    """Checks the first bytes of a file, e.g. to distinguish a merged MTZ
+    file from xia2.ssx from a reflection list from CrystFEL."""
+    with open(filename, "rb") as f:
+        return f.read(len(MTZ_MAGIC)) == MTZ_MAGIC
@@ -0,0 +1,173 @@
+# coding: utf-8
+"""Wall time, CPU time, peak memory and input sizes of the stages of the
+program (parsing, stream scan, binning, statistics, output writing).
+
+The light mode (always on) only reads clocks and the resource usage
+around each stage. The profile mode also resets the peak resident set
+size before each stage (Linux), so that the peak is measured per stage,
+and optionally saves cProfile statistics of each stage.
+"""
+import contextlib
+import cProfile
+import os
+import sys
+import threading
+import time
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_reset():
+    """Resets the peak resident set size of the process (Linux only).
+    Returns:
+        bool: True if the peak was reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """Peak resident set size of the process in MB."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return 0.0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+def cpu_time():
+    """CPU time of the process and of its finished child processes (pools
+    of workers, e.g. for the stream scan)."""
+    t = os.times()
+    return time.process_time() + t.children_user + t.children_system
+
+
+def file_size(*filenames):
+    """Total size of files in bytes, missing files are skipped."""
+    return sum(os.path.getsize(f) for f in filenames if f and os.path.isfile(f))
+
+
+def timed(function, *args, **kwargs):
+    """Calls `function(*args, **kwargs)` and measures it, e.g. in a worker
+    process, for `Profiler.add()`.
+    Returns:
+        tuple: Result of the function and dict of wall_s, cpu_s and peak_rss_mb
+    """
+    t_wall = time.perf_counter()
+    t_cpu = cpu_time()
+    result = function(*args, **kwargs)
+    return result, {"wall_s": time.perf_counter() - t_wall, "cpu_s": cpu_time() - t_cpu,
+                    "peak_rss_mb": peak_rss_mb()}
+
+
+class Profiler:
+    """Collects performance measures of the stages of one run.
+
+    Stages can be measured in several threads at once, their CPU time then
+    includes the other threads.
+
+    Args:
+        profile (bool): Measure the peak memory per stage instead of the
+            peak of the process so far
+        profile_dir (str): Directory for cProfile statistics of each stage
+            (`<stage>.prof`, readable with `python -m pstats`)
+    """
+    def __init__(self, profile=False, profile_dir=None):
+        self.profile = bool(profile or profile_dir)
+        self.profile_dir = profile_dir
+        self.stages = {}
+        self._profiles = {}  # cProfile.Profile by stages
+        self._lock = threading.Lock()
+        self._t_wall = time.perf_counter()
+        self._t_cpu = cpu_time()
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    @contextlib.contextmanager
+    def stage(self, name, **sizes):
+        """Measures a stage. Repeated stages of the same name are summed.
+        Args:
+            name (str): Stage, e.g. "parse"
+            sizes: Input sizes, e.g. input_bytes or n_reflections, which can
+                be also added later to the yielded dict
+        """
+        sizes = dict(sizes)
+        per_stage = self.profile and peak_rss_reset()
+        profiler = None
+        if self.profile_dir:
+            profiler = self._profiles.setdefault(name, cProfile.Profile())
+        t_wall = time.perf_counter()
+        t_cpu = cpu_time()
+        if profiler:
+            profiler.enable()
+        try:
+            yield sizes
+        finally:
+            if profiler:
+                profiler.disable()
+            measures = {"wall_s": time.perf_counter() - t_wall, "cpu_s": cpu_time() - t_cpu,
+                        "peak_rss_mb": peak_rss_mb()}
+            self.add(name, measures, per_stage, **sizes)
+            if profiler:
+                profiler.dump_stats(os.path.join(self.profile_dir, f"{name}.prof"))
+
+    def add(self, name, measures, per_stage=False, **sizes):
+        """Adds measures of a stage, e.g. from `timed()` in another process.
+        Args:
+            name (str): Stage
+            measures (dict): wall_s, cpu_s and peak_rss_mb
+            per_stage (bool): The peak memory was reset for this stage
+            sizes: Input sizes
+        """
+        with self._lock:
+            stage = self.stages.setdefault(name, {"wall_s": 0, "cpu_s": 0, "peak_rss_mb": 0})
+            stage["wall_s"] = round(stage["wall_s"] + measures["wall_s"], 4)
+            stage["cpu_s"] = round(stage["cpu_s"] + measures["cpu_s"], 4)
+            stage["peak_rss_mb"] = round(max(stage["peak_rss_mb"], measures["peak_rss_mb"]), 1)
+            for key, value in sizes.items():
+                stage[key] = stage.get(key, 0) + value
+            stage["peak_rss_per_stage"] = per_stage
+
+    def as_dict(self):
+        """Returns:
+            dict: Mode, stages and the total of the run so far (for the
+                JSON and XML outputs)
+        """
+        return {
+            "mode": "profile" if self.profile else "light",
+            "stages": {name: dict(stage) for name, stage in self.stages.items()},
+            "total": {"wall_s": round(time.perf_counter() - self._t_wall, 4),
+                      "cpu_s": round(cpu_time() - self._t_cpu, 4),
+                      "peak_rss_mb": round(peak_rss_mb(), 1)},
+        }
+
+    def report(self):
+        """Returns:
+            str: Table of the stages
+        """
+        performance = self.as_dict()
+        lines = [f"{'stage':<14}{'wall/s':>9}{'cpu/s':>9}{'peak/MB':>9}"]
+        rows = list(performance["stages"].items()) + [("total", performance["total"])]
+        for name, stage in rows:
+            lines.append(f"{name:<14}{stage['wall_s']:>9.3f}{stage['cpu_s']:>9.3f}"
+                         f"{stage['peak_rss_mb']:>9.0f}")
+        return "\n".join(lines)
+
+
+def stage(profiler, name, **sizes):
+    """`profiler.stage()` or a context doing nothing if `profiler` is None."""
+    if profiler is None:
+        return contextlib.nullcontext(dict(sizes))
+    return profiler.stage(name, **sizes)
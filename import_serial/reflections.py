@@ -0,0 +1,451 @@
+# coding: utf-8
+"""Columnar table of merged reflections and half-data sets"""
+import numpy as np
+try:
+    from cctbx import miller
+    from cctbx.array_family import flex
+except ImportError:  # reported in import_serial.py
+    pass
+
+
+def miller_indices_as_numpy(indices):
+    """Converts flex.miller_index to a numpy array (n, 3) of int32."""
+    return indices.as_vec3_double().as_numpy_array().astype(np.int32)
+
+
+def numpy_as_miller_indices(hkl):
+    """Converts a numpy array (n, 3) to flex.miller_index column by column
+    (much faster than from the 2D array).
+    """
+    return flex.miller_index(*(flex.int(np.ascontiguousarray(hkl[:, i], dtype=np.int32))
+                               for i in range(3)))
+
+
+def miller_array_columns(m, name="I"):
+    """Converts a Miller array to columns as returned by `read_hkl_crystfel()`.
+    Args:
+        m (cctbx.miller.array): Miller array
+        name (str): Name of the data column
+    Returns:
+        dict: numpy arrays h, k, l, `name` and sigma(`name`) if available
+    """
+    hkl = miller_indices_as_numpy(m.indices())
+    columns = {"h": hkl[:, 0], "k": hkl[:, 1], "l": hkl[:, 2]}
+    columns[name] = m.data().as_double().as_numpy_array()
+    if m.sigmas() is not None:
+        columns[f"sigma({name})"] = m.sigmas().as_numpy_array()
+    return columns
+
+
+def pack_indices(hkl, low, span):
+    """Packs Miller indices (n, 3) to int64 keys that are sorted
+    in the same order as the indices (h first, then k and l).
+    """
+    hkl = hkl.astype(np.int64) - low
+    return (hkl[:, 0] * span[1] + hkl[:, 1]) * span[2] + hkl[:, 2]
+
+
+def key_space(*hkl_arrays):
+    """Lowest Miller indices and span of the indices of all arrays for
+    `pack_indices()`.
+    Returns:
+        tuple: low (3), span (3) and the number of possible keys
+    """
+    hkl_arrays = [hkl for hkl in hkl_arrays if hkl.size]
+    if not hkl_arrays:
+        return np.zeros(3, dtype=np.int64), np.ones(3, dtype=np.int64), 1
+    low = np.min([hkl.min(axis=0) for hkl in hkl_arrays], axis=0).astype(np.int64)
+    span = np.max([hkl.max(axis=0) for hkl in hkl_arrays], axis=0) - low + 1
+    return low, span, int(np.prod(span))
+
+
+def _direct(n_keys, n_rows):
+    # a table addressed by keys is used if it is not much larger than the data
+    return n_keys <= 16 * n_rows + (1 << 20)
+
+
+def sort_keys(keys, n_keys):
+    """Stable order of packed keys: counting sort in linear time if the keys
+    are unique and the key space is small, otherwise a comparison sort.
+    Returns:
+        numpy.ndarray: Rows in the order of keys
+    """
+    if _direct(n_keys, keys.size):
+        counts = np.bincount(keys, minlength=n_keys)
+        if keys.size == 0 or counts.max() <= 1:
+            order = np.full(n_keys, -1, dtype=np.int64)
+            order[keys] = np.arange(keys.size)
+            return order[order >= 0]
+    return np.argsort(keys, kind="stable")
+
+
+def lookup_keys(keys, query, n_keys):
+    """Rows of `query` keys in `keys` (the first row of duplicate keys),
+    -1 for unmatched keys. A table addressed by keys gives a linear-time
+    join if the key space is small, otherwise `keys` are sorted.
+    Args:
+        keys (numpy.ndarray): Packed keys of a data set
+        query (numpy.ndarray): Packed keys to look up
+        n_keys (int): Number of possible keys (upper bound of the keys)
+    Returns:
+        numpy.ndarray: Row in `keys` for each query key
+    """
+    if _direct(n_keys, keys.size + query.size):
+        table = np.full(n_keys, -1, dtype=np.int64)
+        table[keys[::-1]] = np.arange(keys.size - 1, -1, -1)
+        return table[query]
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    position = np.searchsorted(sorted_keys, query)
+    found = position < sorted_keys.size
+    found[found] = sorted_keys[position[found]] == query[found]
+    rows = np.full(query.size, -1, dtype=np.int64)
+    rows[found] = order[position[found]]
+    return rows
+
+
+def join_keys(key_sets, n_keys):
+    """Aligns any number of sets of packed keys on the union of their keys
+    in linear time (if the key space is small).
+    Args:
+        key_sets (list): numpy arrays of packed keys, one for each data set
+        n_keys (int): Number of possible keys
+    Returns:
+        tuple: Sorted unique keys of all sets, for each set the row in the
+            union of each of its keys, and for each set the mask of the
+            union rows present in the set
+    """
+    if _direct(n_keys, sum(keys.size for keys in key_sets)):
+        present_any = np.zeros(n_keys, dtype=bool)
+        for keys in key_sets:
+            present_any[keys] = True
+        union = np.flatnonzero(present_any)
+        slot = np.cumsum(present_any) - 1
+        rows = [slot[keys] for keys in key_sets]
+    else:
+        union = np.unique(np.concatenate(key_sets)) if key_sets else np.empty(0, np.int64)
+        rows = [np.searchsorted(union, keys) for keys in key_sets]
+    present = []
+    for set_rows in rows:
+        mask = np.zeros(union.size, dtype=bool)
+        mask[set_rows] = True
+        present.append(mask)
+    return union, rows, present
+
+
+def group_sums(groups, n_groups, values=None):
+    """Sums of values (or counts if values are None) in groups in a single
+    pass. Values are added in the order of rows, as in flex.sum().
+    Args:
+        groups (numpy.ndarray): Group of each row, 0 ... n_groups - 1
+        n_groups (int): Number of groups
+        values (numpy.ndarray): Values of rows
+    Returns:
+        numpy.ndarray: Sum for each group
+    """
+    return np.bincount(groups, weights=values, minlength=n_groups)[:n_groups]
+
+
+def group_min_max(groups, n_groups, values):
+    """Minimum and maximum of values in groups in a single pass,
+    NaN for empty groups.
+    """
+    low = np.full(n_groups, np.inf)
+    high = np.full(n_groups, -np.inf)
+    np.minimum.at(low, groups, values)
+    np.maximum.at(high, groups, values)
+    empty = low > high
+    low[empty] = np.nan
+    high[empty] = np.nan
+    return low, high
+
+
+class ReflectionTable:
+    """Merged reflections and both half-data sets in aligned columns,
+    rows are sorted by Miller indices in the asymmetric unit.
+
+    Columns (numpy arrays with one value per row):
+        asu_hkl: Miller indices in the asymmetric unit (n, 3)
+        hkl: Miller indices as in the input file (n, 3)
+        d: d-spacing
+        bin: resolution bin, 1 ... n_bins
+        I, sigI, nmeas: merged data set
+        I_half1, I_half2: half-data sets
+        has_I, has_half1, has_half2: masks of rows present in the data sets,
+            missing values are NaN
+        order: row of the reflection in the merged data set as read, -1 if
+            the reflection is only in the half-data sets
+
+    The rows of the input data sets in the rows of the table present in
+    them (`sources`) allow to replace the values without building the
+    table again, see `with_values()`.
+    """
+    def __init__(self, crystal_symmetry, anomalous_flag, binning, columns, sources=None):
+        self.crystal_symmetry = crystal_symmetry
+        self.anomalous_flag = anomalous_flag
+        self.binning = binning
+        self.n_bins = binning.n_bins_used()
+        self.has_halves = "I_half1" in columns
+        self.sources = sources
+        self._complete = None
+        for name, values in columns.items():
+            setattr(self, name, values)
+
+    def __len__(self):
+        return self.d.size
+
+    def miller_set(self, selection=None):
+        indices = self.asu_hkl if selection is None else self.asu_hkl[selection]
+        return miller.set(
+            self.crystal_symmetry, numpy_as_miller_indices(indices), self.anomalous_flag)
+
+    def miller_array(self, data, sigmas=None, selection=None):
+        """Miller array with indices in the asymmetric unit.
+        Args:
+            data (str): Name of the column with data
+            sigmas (str): Name of the column with sigmas
+            selection (numpy.ndarray): Rows to select
+        """
+        def column(name):
+            values = getattr(self, name)
+            return flex.double(values if selection is None else values[selection])
+        m = miller.array(
+            miller_set=self.miller_set(selection),
+            data=column(data),
+            sigmas=column(sigmas) if sigmas else None)
+        if data.startswith("I"):
+            m.set_observation_type_xray_intensity()
+        return m
+
+    def n_complete(self, d_min, d_max=None):
+        """Numbers of reflections in the complete (non-anomalous) sets for
+        resolution ranges, the same as `completeness()` of cctbx counts with
+        the default tolerance of d_min.
+        Args:
+            d_min (numpy.ndarray): High-resolution limits
+            d_max (numpy.ndarray): Low-resolution limits, None for no limit
+        Returns:
+            numpy.ndarray: Number of reflections for each range
+        """
+        d_min = np.atleast_1d(d_min)
+        limit = np.nanmin(d_min) * (1 - 1e-6)
+        if self._complete is None or self._complete[0] > limit:
+            # generated once for all ranges, sorted by resolution
+            complete_set = miller.build_set(
+                self.crystal_symmetry, anomalous_flag=False, d_min=limit)
+            complete_set = complete_set.sort(by_value="resolution")
+            self._complete = (
+                limit,
+                complete_set.d_spacings().data().as_numpy_array(),
+                flex.sqrt(complete_set.d_star_sq().data()).as_numpy_array())
+        _, d, d_star = self._complete
+        # d >= d_min (within the floating point precision) and d_star >= 1 / d_max
+        n = np.searchsorted(-d, -d_min * (1 - np.finfo(float).eps), side="right")
+        if d_max is not None:
+            n = n - np.searchsorted(d_star, 1 / np.atleast_1d(d_max), side="left")
+        return np.maximum(n, 0)
+
+    def unmatched(self):
+        """Reflections of each data set missing in at least one of the other
+        data sets (merged, half1, half2).
+        Returns:
+            dict: Miller indices in the asymmetric unit (n, 3) by data sets,
+                empty without half-data sets
+        """
+        if not self.has_halves:
+            return {}
+        return {
+            "merged": self.asu_hkl[self.has_I & ~(self.has_half1 & self.has_half2)],
+            "half1": self.asu_hkl[self.has_half1 & ~(self.has_I & self.has_half2)],
+            "half2": self.asu_hkl[self.has_half2 & ~(self.has_I & self.has_half1)],
+        }
+
+    def input_order_arrays(self):
+        """Returns:
+            tuple: Miller arrays of intensities and multiplicities of the
+            merged data set with the Miller indices and order as read
+        """
+        rows = np.flatnonzero(self.has_I)
+        rows = rows[np.argsort(self.order[rows])]
+        miller_set = miller.set(
+            self.crystal_symmetry, numpy_as_miller_indices(self.hkl[rows]), self.anomalous_flag)
+        m_i = miller.array(
+            miller_set=miller_set,
+            data=flex.double(self.I[rows]),
+            sigmas=flex.double(self.sigI[rows]))
+        m_i.set_observation_type_xray_intensity()
+        m_nmeas = miller.array(miller_set=miller_set, data=flex.double(self.nmeas[rows]))
+        return m_i, m_nmeas
+
+    def with_values(self, merged, half1=None, half2=None):
+        """Table with the same reflections (Miller indices, resolution bins
+        and the complete set) and the values of data sets with the same
+        reflections in the same order as the data sets of this table, e.g.
+        rewritten by partialator.
+        Args:
+            merged (dict): Columns I, sigma(I) and nmeas of the merged data set
+            half1, half2 (dict): Columns I of the half-data sets
+        Returns:
+            ReflectionTable
+        """
+        columns = {name: values for name, values in vars(self).items()
+                   if isinstance(values, np.ndarray)}
+        for column, name, source, present in (
+                ("I", "I", "merged", "has_I"),
+                ("sigI", "sigma(I)", "merged", "has_I"),
+                ("nmeas", "nmeas", "merged", "has_I"),
+                ("I_half1", "I", "half1", "has_half1"),
+                ("I_half2", "I", "half2", "has_half2")):
+            if column not in columns:
+                continue
+            data = {"merged": merged, "half1": half1, "half2": half2}[source]
+            values = np.full(len(self), np.nan)
+            values[columns[present]] = data[name][self.sources[source]]
+            columns[column] = values
+        table = ReflectionTable(
+            self.crystal_symmetry, self.anomalous_flag, self.binning, columns, self.sources)
+        table._complete = self._complete
+        return table
+
+    def nbytes(self):
+        return sum(values.nbytes for values in vars(self).values()
+                   if isinstance(values, np.ndarray))
+
+
+def map_columns_to_asu(cs, columns, anomalous_flag=None):
+    """Maps all rows of one data set to the asymmetric unit, before
+    resolution cutoffs (the result can be cached for the file and symmetry).
+    Args:
+        cs (cctbx.crystal.symmetry): Crystal symmetry
+        columns (dict): Columns h, k, l, e.g. from `read_hkl_crystfel()`
+        anomalous_flag (bool): Anomalous flag of the Miller set
+    Returns:
+        dict: numpy arrays asu_hkl (n, 3) of int32 and d_star (float64)
+    """
+    hkl = np.column_stack((columns["h"], columns["k"], columns["l"])).astype(np.int32)
+    miller_set = miller.set(cs, numpy_as_miller_indices(hkl), anomalous_flag)
+    d_star = flex.sqrt(miller_set.d_star_sq().data()).as_numpy_array()
+    asu = miller_set.indices()
+    # as miller.array.map_to_asu(): Friedel mates are merged if the flag is None
+    miller.map_to_asu(cs.space_group_info().type(), bool(anomalous_flag), asu)
+    return {"asu_hkl": miller_indices_as_numpy(asu), "d_star": d_star}
+
+
+def _prepare(cs, columns, anomalous_flag, d_max, d_min, mapped=None):
+    """Resolution cutoff and mapping to the asymmetric unit of one data set.
+    The cutoff is the same as `miller.set.resolution_filter_selection()`.
+    Returns:
+        tuple: Selection of rows, their Miller indices as read and
+        in the asymmetric unit
+    """
+    if mapped is None:
+        mapped = map_columns_to_asu(cs, columns, anomalous_flag)
+    hkl = np.column_stack((columns["h"], columns["k"], columns["l"])).astype(np.int32)
+    sel = np.ones(len(hkl), dtype=bool)
+    if d_max is not None and d_max > 0:
+        sel &= mapped["d_star"] >= 1 / d_max
+    if d_min is not None and d_min > 0:
+        sel &= mapped["d_star"] <= 1 / d_min
+    return sel, hkl[sel], mapped["asu_hkl"][sel]
+
+
+def build_reflection_table(cs, merged, half1=None, half2=None, anomalous_flag=None,
+                           d_max=0, d_min=0, n_bins=10, mapped=None):
+    """Builds the table of reflections. Every data set is mapped to the
+    asymmetric unit only once, the half-data sets are matched to the merged
+    data set by Miller indices and the resolution bins are assigned to all
+    rows at once.
+
+    Args:
+        cs (cctbx.crystal.symmetry): Crystal symmetry
+        merged (dict): Columns h, k, l, I, sigma(I) and nmeas of the merged
+            data set, e.g. from `read_hkl_crystfel()`
+        half1 (dict): Columns h, k, l and I of the first half-data set
+        half2 (dict): Columns h, k, l and I of the second half-data set
+        anomalous_flag (bool): Anomalous flag of the Miller sets
+        d_max (float): Low-resolution cutoff
+        d_min (float): High-resolution cutoff
+        n_bins (int): Number of resolution bins
+        mapped (list): Results of `map_columns_to_asu()` of the merged data
+            set and of the half-data sets (or None to map them here)
+
+    Returns:
+        ReflectionTable
+    """
+    mapped = list(mapped or []) + [None] * 3
+    halves = [(half, half_mapped) for half, half_mapped in zip((half1, half2), mapped[1:])
+              if half is not None]
+    sel, hkl, asu = _prepare(cs, merged, anomalous_flag, d_max, d_min, mapped[0])
+    prepared_halves = [_prepare(cs, half, anomalous_flag, d_max, d_min, half_mapped)
+                       for half, half_mapped in halves]
+    halves = [half for half, _ in halves]
+    low, span, n_keys = key_space(asu, *(half_asu for _, _, half_asu in prepared_halves))
+
+    # merged data set sorted by Miller indices in the asymmetric unit
+    keys = pack_indices(asu, low, span)
+    order = sort_keys(keys, n_keys)
+    keys = keys[order]
+    columns = {
+        "asu_hkl": asu[order],
+        "hkl": hkl[order],
+        "I": merged["I"][sel][order].astype(np.float64),
+        "sigI": merged["sigma(I)"][sel][order].astype(np.float64),
+        "nmeas": merged["nmeas"][sel][order].astype(np.float64),
+        "order": order,
+    }
+    n_merged = keys.size
+    sources = {"merged": np.flatnonzero(sel)}
+    del sel, hkl, asu, order
+
+    # reflections only in the half-data sets are added
+    half_keys = [pack_indices(half_asu, low, span) for _, _, half_asu in prepared_halves]
+    unmatched = [lookup_keys(keys, half_key, n_keys) < 0 for half_key in half_keys]
+    extra_keys, extra_rows, _ = join_keys(
+        [half_key[sel] for half_key, sel in zip(half_keys, unmatched)], n_keys)
+    if extra_keys.size:
+        extra = {
+            "asu_hkl": np.empty((extra_keys.size, 3), dtype=np.int32),
+            "hkl": np.empty((extra_keys.size, 3), dtype=np.int32),
+            "I": np.full(extra_keys.size, np.nan),
+            "sigI": np.full(extra_keys.size, np.nan),
+            "nmeas": np.full(extra_keys.size, np.nan),
+            "order": np.full(extra_keys.size, -1),
+        }
+        # indices as read from the first half-data set if present in both
+        for (_, half_hkl, half_asu), sel, rows in zip(
+                prepared_halves[::-1], unmatched[::-1], extra_rows[::-1]):
+            extra["asu_hkl"][rows] = half_asu[sel]
+            extra["hkl"][rows] = half_hkl[sel]
+        keys = np.concatenate((keys, extra_keys))
+        rows = sort_keys(keys, n_keys)
+        keys = keys[rows]
+        for name in columns:
+            columns[name] = np.concatenate((columns[name], extra.pop(name)))[rows]
+        del rows
+    columns["has_I"] = columns["order"] >= 0
+
+    for i, (half, (half_sel, _, _), half_key) in enumerate(
+            zip(halves, prepared_halves, half_keys)):
+        position = lookup_keys(keys, half_key, n_keys)
+        values = np.full(keys.size, np.nan)
+        values[position] = half["I"][half_sel]
+        present = np.zeros(keys.size, dtype=bool)
+        present[position] = True
+        columns[f"I_half{i + 1}"] = values
+        columns[f"has_half{i + 1}"] = present
+        rows = np.empty(keys.size, dtype=np.int64)
+        rows[position] = np.flatnonzero(half_sel)
+        sources[f"half{i + 1}"] = rows[present]
+    del prepared_halves, half_keys, keys
+
+    unit_cell = cs.unit_cell()
+    indices = numpy_as_miller_indices(columns["asu_hkl"])
+    columns["d"] = unit_cell.d(indices).as_numpy_array()
+    binning = miller.binning(
+        unit_cell, n_bins, indices.select(flex.bool(columns["has_I"])), 0, 0)
+    binner = miller.binner(binning, miller.set(cs, indices, anomalous_flag))
+    columns["bin"] = binner.bin_indices().as_numpy_array().astype(np.int32)
+    assert n_merged == np.count_nonzero(columns["has_I"])
+    # rows of the input data sets in the table rows present in them
+    sources["merged"] = sources["merged"][columns["order"][columns["has_I"]]]
+    return ReflectionTable(cs, anomalous_flag, binning, columns, sources)
@@ -0,0 +1,363 @@
+# coding: utf-8
+"""Local SQLite database of the results of runs: overall statistics,
+statistics in resolution bins, fingerprints of the input files, symmetry,
+resolution limits and timing of the stages. Each run appends one row to
+the table `runs` in a single transaction, so parallel jobs can write to
+the same database. The results can be queried and exported to CSV or JSON
+from the command line."""
+import argparse
+import contextlib
+import csv
+import datetime
+import json
+import os
+import socket
+import sqlite3
+import sys
+import time
+
+
+RESULTS_DB_VERSION = 1  # stored as PRAGMA user_version
+RESULTS_DB_TIMEOUT = 60  # seconds a writer waits for the lock of another writer
+# statistics in the JSON output and the columns of the database
+STATS_COLUMNS = {
+    "d_max": "d_max",
+    "d_min": "d_min",
+    "n_obs": "n_obs",
+    "n_unique": "n_unique",
+    "completeness": "completeness",
+    "multiplicity": "multiplicity",
+    "I": "mean_i",
+    "IsigI": "mean_i_over_sigma",
+    "cc": "cc_half",
+    "CCstar": "cc_star",
+    "rsplit": "rsplit",
+}
+RUN_COLUMNS = (
+    "id", "time", "project", "crystal", "dataset", "hklin", "hklin_format", "inputs",
+    "spacegroup", "cell", "wavelength", "d_max_cutoff", "d_min_cutoff", "n_bins",
+    "wall_s", "cpu_s", "peak_rss_mb", "host", "workdir", "command")
+STAGE_COLUMNS = ("wall_s", "cpu_s", "peak_rss_mb")
+STATS_COLUMNS_SQL = ", ".join(
+    f"{column} {'INTEGER' if column.startswith('n_') else 'REAL'}"
+    for column in STATS_COLUMNS.values())
+RESULTS_DB_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,  -- end of the run, seconds since the epoch
+    project TEXT,
+    crystal TEXT,
+    dataset TEXT,
+    hklin TEXT,
+    hklin_format TEXT,
+    inputs TEXT,  -- JSON object: fingerprints of the input files by paths
+    spacegroup TEXT,
+    cell TEXT,
+    wavelength REAL,
+    d_max_cutoff REAL,
+    d_min_cutoff REAL,
+    n_bins INTEGER,  -- number of resolution bins, the outer shell is n_bins - 1
+    {STATS_COLUMNS_SQL},
+    wall_s REAL,
+    cpu_s REAL,
+    peak_rss_mb REAL,
+    host TEXT,
+    workdir TEXT,
+    command TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_project_dataset_time ON runs (project, dataset, time);
+CREATE INDEX IF NOT EXISTS runs_time ON runs (time);
+CREATE TABLE IF NOT EXISTS bins (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    bin INTEGER NOT NULL,
+    {STATS_COLUMNS_SQL},
+    PRIMARY KEY (run_id, bin)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS stages (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    stage TEXT NOT NULL,
+    wall_s REAL,
+    cpu_s REAL,
+    peak_rss_mb REAL,
+    PRIMARY KEY (run_id, stage)
+) WITHOUT ROWID;
+"""
+SHELLS = ("overall", "outer", "bins")
+
+
+def connect(path):
+    """Opens the database and creates the tables if needed. The database
+    uses write-ahead logging, so readers do not block writers, and writers
+    wait up to `RESULTS_DB_TIMEOUT` seconds for each other.
+    Args:
+        path (str): Path to the database file
+    Returns:
+        sqlite3.Connection: Connection in autocommit mode (transactions are
+        started explicitly)
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=RESULTS_DB_TIMEOUT, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA foreign_keys = ON")
+    if conn.execute("PRAGMA user_version").fetchone()[0] != RESULTS_DB_VERSION:
+        conn.execute("PRAGMA journal_mode = WAL")
+        with transaction(conn):
+            # checked again with the lock held, another writer may have been first
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version not in (0, RESULTS_DB_VERSION):
+                raise sqlite3.DatabaseError(
+                    f"The results database {path} has an unsupported version {version}")
+            for statement in RESULTS_DB_SCHEMA.split(";"):
+                if statement.strip():
+                    conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {RESULTS_DB_VERSION}")
+    return conn
+
+
+@contextlib.contextmanager
+def transaction(conn):
+    """Write transaction. The lock is taken at the beginning (BEGIN
+    IMMEDIATE), so concurrent writers wait for each other instead of
+    failing when a read transaction is upgraded."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _stats_values(stats, i=None):
+    """Values of `STATS_COLUMNS` in the overall statistics or in bin `i`."""
+    if i is None:
+        return [stats.get(key) for key in STATS_COLUMNS]
+    return [stats[key][i] if key in stats else None for key in STATS_COLUMNS]
+
+
+def add_run(path, stats, metadata):
+    """Appends the results of a run to the database.
+    Args:
+        path (str): Path to the database file
+        stats (dict): Statistics as in the JSON output: overall, binned and
+            performance
+        metadata (dict): Values of the columns of the table `runs` other
+            than statistics and timing, e.g. project, dataset, hklin,
+            inputs (dict of fingerprints), spacegroup, cell (list),
+            wavelength, d_max_cutoff and d_min_cutoff
+    Returns:
+        int: Identifier of the run
+    """
+    overall = stats.get("overall", {})
+    binned = stats.get("binned", {})
+    performance = stats.get("performance", {})
+    total = performance.get("total", {})
+    n_bins = len(binned.get("d_min", []))
+    row = {
+        "time": time.time(),
+        "host": socket.gethostname(),
+        "workdir": os.getcwd(),
+        "n_bins": n_bins,
+    }
+    row.update(metadata)
+    if isinstance(row.get("inputs"), dict):
+        row["inputs"] = json.dumps(row["inputs"])
+    if isinstance(row.get("cell"), (list, tuple)):
+        row["cell"] = " ".join(f"{p:g}" for p in row["cell"])
+    for column in STAGE_COLUMNS:
+        row[column] = total.get(column)
+    row.update(zip(STATS_COLUMNS.values(), _stats_values(overall)))
+    columns = [column for column in row if column in RUN_COLUMNS or column in
+               STATS_COLUMNS.values()]
+    stats_columns = ", ".join(STATS_COLUMNS.values())
+    conn = connect(path)
+    try:
+        with transaction(conn):
+            run_id = conn.execute(
+                f"INSERT INTO runs ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))})",
+                [row[column] for column in columns]).lastrowid
+            conn.executemany(
+                f"INSERT INTO bins (run_id, bin, {stats_columns}) "
+                f"VALUES ({', '.join('?' * (len(STATS_COLUMNS) + 2))})",
+                [[run_id, i] + _stats_values(binned, i) for i in range(n_bins)])
+            conn.executemany(
+                "INSERT INTO stages (run_id, stage, wall_s, cpu_s, peak_rss_mb) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [[run_id, name] + [stage.get(column) for column in STAGE_COLUMNS]
+                 for name, stage in performance.get("stages", {}).items()])
+    finally:
+        conn.close()
+    return run_id
+
+
+def parse_time(text, now=None):
+    """Converts "today", "yesterday", a date or date and time (ISO format,
+    local time) or a number of hours ago ("12h") to seconds since the epoch."""
+    now = now or datetime.datetime.now()
+    text = text.strip().lower()
+    midnight = datetime.datetime.combine(now.date(), datetime.time())
+    if text == "today":
+        moment = midnight
+    elif text == "yesterday":
+        moment = midnight - datetime.timedelta(days=1)
+    elif text.endswith("h") and text[:-1].replace(".", "", 1).isdigit():
+        moment = now - datetime.timedelta(hours=float(text[:-1]))
+    else:
+        moment = datetime.datetime.fromisoformat(text)
+    return moment.timestamp()
+
+
+def query_runs(path, project=None, dataset=None, since=None, until=None, shell="overall",
+               limit=None):
+    """Results of runs in the database, the newest last.
+    Args:
+        path (str): Path to the database file
+        project (str): Only runs of this project
+        dataset (str): Only runs of this data set
+        since (float): Only runs that ended at this time or later (seconds
+            since the epoch)
+        until (float): Only runs that ended before this time
+        shell (str): Statistics "overall", in the "outer" resolution shell
+            or in all resolution "bins" (one row per bin)
+        limit (int): Only this number of the newest runs
+    Returns:
+        list: Dictionaries with the columns of the runs and statistics,
+        the time as a string (local time, ISO format)
+    """
+    if shell not in SHELLS:
+        raise ValueError(f"Unknown shell: {shell}")
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"The results database {path} does not exist")
+    conditions = []
+    parameters = []
+    for condition, value in (("project = ?", project), ("dataset = ?", dataset),
+                             ("time >= ?", since), ("time < ?", until)):
+        if value is not None:
+            conditions.append(condition)
+            parameters.append(value)
+    # the selected runs (newest first for the limit), then their statistics
+    runs = "SELECT * FROM runs"
+    if conditions:
+        runs += f" WHERE {' AND '.join(conditions)}"
+    runs += " ORDER BY time DESC, id DESC"
+    if limit:
+        runs += " LIMIT ?"
+        parameters.append(limit)
+    columns = [f"runs.{column}" for column in RUN_COLUMNS]
+    order = "runs.time, runs.id"
+    if shell == "overall":
+        stats_table = "runs"
+        join = ""
+    else:
+        stats_table = "bins"
+        join = "JOIN bins ON bins.run_id = runs.id"
+        if shell == "outer":
+            join += " AND bins.bin = runs.n_bins - 1"
+        columns.append("bins.bin")
+        order += ", bins.bin"
+    columns += [f"{stats_table}.{column}" for column in STATS_COLUMNS.values()]
+    sql = f"SELECT {', '.join(columns)} FROM ({runs}) AS runs {join} ORDER BY {order}"
+    conn = connect(path)
+    try:
+        rows = [dict(row) for row in conn.execute(sql, parameters)]
+    finally:
+        conn.close()
+    for row in rows:
+        row["time"] = datetime.datetime.fromtimestamp(row["time"]).isoformat(
+            sep=" ", timespec="seconds")
+    return rows
+
+
+def write_rows(rows, f, output_format="csv"):
+    """Writes rows from `query_runs()` as CSV (with a header) or JSON."""
+    if output_format == "json":
+        rows = [dict(row, inputs=json.loads(row["inputs"]) if row.get("inputs") else None)
+                for row in rows]
+        f.write(json.dumps(rows, indent=4) + "\n")
+        return
+    if not rows:
+        return
+    writer = csv.DictWriter(f, fieldnames=list(rows[0]), lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def run_results(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Query the results database written by import_serial with the option "
+                    "--results-db and export the runs to CSV or JSON, e.g. CC1/2 in the outer "
+                    "shell of all runs today: results.db --since today --shell outer",
+    )
+    parser.add_argument(
+        "database",
+        help="SQLite database with the results",
+    )
+    parser.add_argument(
+        "--project",
+        help="Only runs of this project",
+    )
+    parser.add_argument(
+        "--dataset",
+        help="Only runs of this data set",
+    )
+    parser.add_argument(
+        "--since",
+        help="Only runs that ended at this time or later: today, yesterday, a date and "
+             "time (e.g. 2024-05-01 or \"2024-05-01 14:00\", local time) or hours ago (e.g. 12h)",
+    )
+    parser.add_argument(
+        "--until",
+        help="Only runs that ended before this time (the same format as --since)",
+    )
+    parser.add_argument(
+        "--shell",
+        choices=SHELLS,
+        default="overall",
+        help="Overall statistics (default), statistics in the outer resolution shell "
+             "or in all resolution bins (one row per bin)",
+    )
+    parser.add_argument(
+        "--last",
+        type=int,
+        help="Only this number of the newest runs",
+    )
+    parser.add_argument(
+        "--format",
+        choices=("csv", "json"),
+        default="csv",
+        help="Output format (default csv)",
+    )
+    parser.add_argument(
+        "--output", "-o",
+        help="Output file (default: standard output)",
+    )
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parser.parse_args(argv)
+    times = {}
+    for name in ("since", "until"):
+        value = getattr(args, name)
+        if value is not None:
+            try:
+                times[name] = parse_time(value)
+            except ValueError:
+                parser.error(f"Invalid time of --{name}: {value}")
+    try:
+        rows = query_runs(args.database, args.project, args.dataset, times.get("since"),
+                          times.get("until"), args.shell, args.last)
+    except (OSError, sqlite3.Error) as e:
+        sys.stderr.write(f"ERROR: {e}\n")
+        sys.stderr.write("Aborting.\n")
+        sys.exit(1)
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            write_rows(rows, f, args.format)
+        sys.stderr.write(f"{len(rows)} rows written to {args.output}\n")
+    else:
+        write_rows(rows, sys.stdout, args.format)
+
+
+if __name__ == "__main__":
+    run_results()
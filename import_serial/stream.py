@@ -0,0 +1,725 @@
+# coding: utf-8
+"""Scanning of stream files from CrystFEL"""
+import hashlib
+import mmap
+import os
+import zipfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal, InvalidOperation
+import numpy as np
+from .cells import CellTable, save_npz
+
+
+STREAM_CHUNK_BEGIN = b"----- Begin chunk -----"
+STREAM_CHUNK_END = b"----- End chunk -----"
+STREAM_CRYSTAL_BEGIN = b"--- Begin crystal"
+STREAM_CRYSTAL_END = b"--- End crystal"
+STREAM_FILENAME_KEY = b"Image filename: "
+STREAM_EVENT_KEY = b"Event: "
+STREAM_CELL_KEY = b"Cell parameters "
+STREAM_ENERGY_KEY = b"photon_energy_eV"
+# size of the part of the stream file searched at once (bytes)
+STREAM_WINDOW = 1 << 26
+# resolution of the histograms of the unit cell parameters and photon
+# energies (bins per unit): 0.001 A, 0.001 deg and 0.01 eV
+CELL_HISTOGRAM_SCALES = (1e4, 1e4, 1e4, 1e3, 1e3, 1e3)
+ENERGY_HISTOGRAM_SCALE = 100
+
+
+class ValueHistogram:
+    """Histogram of values rounded to a fixed resolution (1 / `scale`),
+    stored sparsely as integer bins. Its size depends on the spread of the
+    values, not on their number, and histograms can be merged exactly.
+    """
+    def __init__(self, scale):
+        self.scale = scale
+        self.counts = Counter()  # bin (value * scale rounded): count
+
+    def __eq__(self, other):
+        return self.scale == other.scale and self.counts == other.counts
+
+    @property
+    def n(self):
+        return sum(self.counts.values())
+
+    def add(self, values):
+        """Adds values (iterable of numbers)."""
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        if values.size:
+            bins, counts = np.unique(np.floor(values * self.scale + 0.5).astype(np.int64),
+                                     return_counts=True)
+            self.counts.update(dict(zip(bins.tolist(), counts.tolist())))
+
+    def add_value(self, value):
+        """Adds one value, ValueError if it is not finite."""
+        if not np.isfinite(value):
+            raise ValueError(f"Not a finite value: {value}")
+        self.counts[int(np.floor(value * self.scale + 0.5))] += 1
+
+    def update(self, other):
+        """Adds the counts of another histogram with the same resolution."""
+        self.counts.update(other.counts)
+
+    def median(self):
+        """Median of the values in the resolution of the histogram or None
+        (only the bins are sorted)."""
+        n = self.n
+        if not n:
+            return None
+        middle = [(n - 1) // 2, n // 2]  # the same positions if n is odd
+        values = []
+        count = 0
+        for value in sorted(self.counts):
+            count += self.counts[value]
+            while middle and middle[0] < count:
+                values.append(value / self.scale)
+                middle.pop(0)
+            if not middle:
+                break
+        return (values[0] + values[1]) / 2
+
+    def as_arrays(self):
+        """Returns:
+            tuple: Bins and counts (int64)
+        """
+        bins = sorted(self.counts)
+        return (np.array(bins, dtype=np.int64),
+                np.array([self.counts[b] for b in bins], dtype=np.int64))
+
+    @classmethod
+    def from_arrays(cls, scale, bins, counts):
+        histogram = cls(scale)
+        histogram.counts = Counter(dict(zip(bins.tolist(), counts.tolist())))
+        return histogram
+
+
+class StreamSummary:
+    """Aggregates collected from a CrystFEL stream file: sums and
+    histograms of the unit cell parameters of all crystals and a histogram
+    of photon energies of all chunks. Sums are exact (decimal) and the
+    histograms have a fixed resolution, so summaries of independently
+    scanned parts of a file can be merged in any order with the same result.
+    Memory does not depend on the size of the stream file, only on the
+    spread of the values.
+    """
+    def __init__(self):
+        self.n_cells = 0
+        self.cell_sums = [Decimal(0)] * 6  # a, b, c (nm), alpha, beta, gamma
+        self.cell_values = [ValueHistogram(scale) for scale in CELL_HISTOGRAM_SCALES]
+        self.energies = ValueHistogram(ENERGY_HISTOGRAM_SCALE)  # photon energy (eV) of chunks
+        self.crystals = None  # CellTable of all crystals, only from an index
+        self.crystal_stats = None  # CrystalStatsTable, only from an index
+
+    def add_cell_line(self, line):
+        """Adds a line in the format:
+        Cell parameters 3.94000 7.85000 4.80000 nm, 90.00000 97.94000 90.00000 deg
+        """
+        self.add_cell_lines((line,))
+
+    def add_cell_lines(self, lines):
+        """Adds lines with unit cell parameters (see `add_cell_line()`),
+        the histograms are updated at once."""
+        added = []
+        for line in lines:
+            items = line.split()
+            if len(items) != 10:
+                continue
+            items = items[2:5] + items[6:9]
+            try:
+                cell = [Decimal(item.decode()) for item in items]
+            except (InvalidOperation, UnicodeDecodeError):
+                continue
+            self.cell_sums = [s + p for s, p in zip(self.cell_sums, cell)]
+            added.append([float(p) for p in cell])
+        for values, column in zip(self.cell_values, zip(*added)):
+            values.add(column)
+        self.n_cells += len(added)
+
+    def add_energy_line(self, line):
+        """Adds a line in the format:
+        photon_energy_eV = 9500.000000
+        """
+        items = line.split()
+        if len(items) != 3:
+            return
+        try:
+            self.energies.add_value(float(items[2]))
+        except ValueError:
+            return
+
+    def merge(self, other):
+        """Adds aggregates of another summary to this one."""
+        self.n_cells += other.n_cells
+        self.cell_sums = [s + o for s, o in zip(self.cell_sums, other.cell_sums)]
+        for values, other_values in zip(self.cell_values, other.cell_values):
+            values.update(other_values)
+        self.energies.update(other.energies)
+        return self
+
+    def mean_cell(self):
+        """Returns:
+            list: Mean a, b, c (nm), alpha, beta, gamma (deg) or None
+        """
+        if not self.n_cells:
+            return None
+        return [float(s / self.n_cells) for s in self.cell_sums]
+
+    def median_cell(self):
+        """Returns:
+            list: Median a, b, c (nm), alpha, beta, gamma (deg) or None
+        """
+        if not self.n_cells:
+            return None
+        return [values.median() for values in self.cell_values]
+
+    def median_energy(self):
+        """Returns:
+            float: Median photon energy (eV) or None
+        """
+        return self.energies.median()
+
+
+def _find_lines(mm, key, start, end):
+    """Yields the whole lines within `mm[start:end]` containing `key`.
+    `start` must be at the beginning of a line."""
+    i = mm.find(key, start, end)
+    while i != -1:
+        line_start = mm.rfind(b"\n", start, i) + 1 or start
+        line_end = mm.find(b"\n", i, end)
+        if line_end == -1:
+            line_end = end
+        yield mm[line_start:line_end]
+        i = mm.find(key, line_end, end)
+
+
+def scan_stream(mm, start=0, end=None, window=STREAM_WINDOW):
+    """Collects unit cell parameters and photon energies from a part of
+    a memory-mapped stream file in a single pass. The part is searched
+    window by window so that each byte is read from disk only once.
+    Args:
+        mm (mmap.mmap): Memory-mapped stream file
+        start (int): First byte, must be at the beginning of a line
+        end (int): Last byte + 1 (default: end of file)
+        window (int): Size of the part searched at once (bytes)
+    Returns:
+        StreamSummary: Aggregates of the part
+    """
+    if end is None:
+        end = len(mm)
+    summary = StreamSummary()
+    while start < end:
+        window_end = mm.find(b"\n", min(start + window, end) - 1, end) + 1 or end
+        summary.add_cell_lines(_find_lines(mm, STREAM_CELL_KEY, start, window_end))
+        for line in _find_lines(mm, STREAM_ENERGY_KEY, start, window_end):
+            summary.add_energy_line(line)
+        start = window_end
+    return summary
+
+
+def open_stream(streamfile):
+    """Memory-maps a stream file for reading.
+    Returns:
+        mmap.mmap: Memory-mapped file or None if the file is empty
+    """
+    with open(streamfile, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def split_stream(mm, n_parts):
+    """Splits a memory-mapped stream file into byte ranges of similar size
+    that begin at the line "----- Begin chunk -----" (or at byte 0).
+    Args:
+        mm (mmap.mmap): Memory-mapped stream file
+        n_parts (int): Requested number of parts
+    Returns:
+        list: Tuples (start, end), fewer than `n_parts` if the file
+        does not contain enough chunks
+    """
+    size = len(mm)
+    bounds = [0]
+    for i in range(1, n_parts):
+        pos = mm.find(b"\n" + STREAM_CHUNK_BEGIN, max(size * i // n_parts, bounds[-1]) - 1)
+        if pos == -1:
+            break
+        if pos + 1 > bounds[-1]:
+            bounds.append(pos + 1)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _scan_streamfile_part(streamfile, start, end):
+    mm = open_stream(streamfile)
+    try:
+        return scan_stream(mm, start, end)
+    finally:
+        mm.close()
+
+
+def scan_streamfile(streamfile, nproc=1):
+    """Collects unit cell parameters of all crystals and photon energies
+    of all chunks from a CrystFEL stream file in a single pass. Nothing
+    is written to disk.
+
+    With `nproc` > 1, the file is split into byte ranges aligned to the
+    beginnings of chunks which are scanned by a pool of processes and
+    their summaries are merged. The sums are exact, so the result is
+    identical to the serial scan.
+    Args:
+        streamfile (str): Path to the stream file
+        nproc (int): Number of processes
+    Returns:
+        StreamSummary: Aggregates of the whole file
+    """
+    mm = open_stream(streamfile)
+    if mm is None:
+        return StreamSummary()
+    try:
+        if nproc <= 1:
+            return scan_stream(mm)
+        # more parts than processes to balance the load
+        parts = split_stream(mm, nproc * 4)
+    finally:
+        mm.close()
+    summary = StreamSummary()
+    with ProcessPoolExecutor(max_workers=nproc) as executor:
+        futures = [executor.submit(_scan_streamfile_part, streamfile, start, end)
+                   for start, end in parts]
+        for future in futures:
+            summary.merge(future.result())
+    return summary
+
+
+# bytes before the parsed offset compared to detect a rewritten stream file
+STREAM_FOLLOW_TAIL = 4096
+
+
+def _complete_chunks_end(mm, start, end):
+    """Position after the line "----- End chunk -----" of the last complete
+    chunk within `mm[start:end]`, or `start` if there is none."""
+    i = mm.rfind(STREAM_CHUNK_END, start, end)
+    while i != -1:
+        line_end = mm.find(b"\n", i, end)
+        if line_end != -1:
+            return line_end + 1
+        i = mm.rfind(STREAM_CHUNK_END, start, i)
+    return start
+
+
+class StreamFollower:
+    """Follows a stream file that is still being written (e.g. by indexamajig
+    during data collection). Each update parses only the complete chunks
+    appended since the last update and adds them to a running summary, so
+    the cost of an update depends on the new data only. An incomplete chunk
+    at the end of the file is parsed in a later update. If the file is
+    truncated or rewritten, it is parsed again from the beginning.
+    Args:
+        streamfile (str): Path to the stream file
+    """
+    def __init__(self, streamfile):
+        self.streamfile = streamfile
+        self.n_restarts = 0
+        self._reset()
+
+    def _reset(self):
+        self.summary = StreamSummary()
+        self.offset = 0  # end of the last parsed complete chunk
+        self._tail = b""  # bytes just before the offset
+
+    def _rewritten(self, mm):
+        if len(mm) < self.offset:
+            return True
+        return mm[self.offset - len(self._tail):self.offset] != self._tail
+
+    def update(self):
+        """Parses the complete chunks appended since the last update.
+        Returns:
+            StreamSummary: Aggregates of the new chunks (already added to
+            `self.summary`)
+        """
+        try:
+            mm = open_stream(self.streamfile)
+        except FileNotFoundError:
+            mm = None
+        if mm is None:
+            if self.offset:  # the file was removed or truncated
+                self._reset()
+                self.n_restarts += 1
+            return StreamSummary()
+        try:
+            if self._rewritten(mm):
+                self._reset()
+                self.n_restarts += 1
+            end = _complete_chunks_end(mm, self.offset, len(mm))
+            new = scan_stream(mm, self.offset, end)
+            self._tail = mm[max(end - STREAM_FOLLOW_TAIL, 0):end]
+            self.offset = end
+        finally:
+            mm.close()
+        self.summary.merge(new)
+        return new
+
+
+STREAM_INDEX_VERSION = 4
+STREAM_INDEX_SUFFIX = ".index.npz"
+# size of the beginning and the end of the stream file used as fingerprint
+STREAM_FINGERPRINT_BYTES = 1 << 20
+
+
+def _line_at(mm, i, end):
+    """Returns the line starting at byte `i` (without newline) and the
+    position of the next line."""
+    line_end = mm.find(b"\n", i, end)
+    if line_end == -1:
+        line_end = end
+    return mm[i:line_end], line_end + 1
+
+
+def _value_after(mm, key, start, end):
+    """Returns the rest of the first line within `mm[start:end]` that
+    contains `key` after the key, or None."""
+    i = mm.find(key, start, end)
+    if i == -1:
+        return None
+    line, next_line = _line_at(mm, i + len(key), end)
+    return line.strip()
+
+
+def index_stream(mm, start=0, end=None):
+    """Finds all chunks and crystals in a part of a memory-mapped stream
+    file and collects their byte offsets, image filename and event, photon
+    energy and unit cell parameters. Aggregates for the mean cell and the
+    median photon energy are collected in the same pass.
+    Args:
+        mm (mmap.mmap): Memory-mapped stream file
+        start (int): First byte, must be at the beginning of a line
+        end (int): Last byte + 1 (default: end of file)
+    Returns:
+        StreamIndex: Index of the part (without file identification)
+    """
+    if end is None:
+        end = len(mm)
+    index = StreamIndex()
+    chunks = index.chunks
+    crystals = index.crystals
+    files = {}
+    summary = index.summary
+    pos = mm.find(STREAM_CHUNK_BEGIN, start, end)
+    while pos != -1:
+        chunk_end = mm.find(STREAM_CHUNK_END, pos, end)
+        if chunk_end == -1:  # incomplete chunk
+            break
+        chunk_end = mm.find(b"\n", chunk_end, end) + 1 or end
+        first_crystal = mm.find(STREAM_CRYSTAL_BEGIN, pos, chunk_end)
+        header_end = chunk_end if first_crystal == -1 else first_crystal
+        filename = _value_after(mm, STREAM_FILENAME_KEY, pos, header_end) or b""
+        event = _value_after(mm, STREAM_EVENT_KEY, pos, header_end) or b""
+        energy = np.nan
+        i = mm.find(STREAM_ENERGY_KEY, pos, header_end)
+        if i != -1:
+            line_start = mm.rfind(b"\n", pos, i) + 1 or pos
+            line, next_line = _line_at(mm, line_start, header_end)
+            summary.add_energy_line(line)
+            items = line.split()
+            if len(items) == 3:
+                try:
+                    energy = float(items[2])
+                except ValueError:
+                    pass
+        i_chunk = len(chunks["begin"])
+        chunks["begin"].append(pos)
+        chunks["end"].append(chunk_end)
+        chunks["file"].append(files.setdefault(filename, len(files)))
+        chunks["event"].append(event)
+        chunks["photon_energy_eV"].append(energy)
+        crystal = first_crystal
+        while crystal != -1:
+            crystal_end = mm.find(STREAM_CRYSTAL_END, crystal, chunk_end)
+            crystal_end = chunk_end if crystal_end == -1 \
+                else mm.find(b"\n", crystal_end, chunk_end) + 1 or chunk_end
+            cell = [np.nan] * 6
+            i = mm.find(STREAM_CELL_KEY, crystal, crystal_end)
+            if i != -1:
+                line_start = mm.rfind(b"\n", crystal, i) + 1 or crystal
+                line, next_line = _line_at(mm, line_start, crystal_end)
+                summary.add_cell_line(line)
+                items = line.split()
+                if len(items) == 10:
+                    try:
+                        cell = [float(item) for item in items[2:5] + items[6:9]]
+                    except ValueError:
+                        pass
+            crystals["begin"].append(crystal)
+            crystals["end"].append(crystal_end)
+            crystals["chunk"].append(i_chunk)
+            crystals["cell"].append(cell)
+            crystal = mm.find(STREAM_CRYSTAL_BEGIN, crystal_end, chunk_end)
+        pos = mm.find(STREAM_CHUNK_BEGIN, chunk_end, end)
+    index.filenames = list(files)
+    return index
+
+
+class StreamIndex:
+    """Index of a CrystFEL stream file: byte offsets of all chunks and
+    crystals, image filenames and events, photon energies of chunks and
+    unit cell parameters of crystals (a, b, c in nm, angles in deg), and
+    the `StreamSummary` of the whole file. The index is saved next to the
+    stream file (or in a cache directory) and identified by the size,
+    modification time and a fingerprint of the stream file.
+    """
+    def __init__(self):
+        self.chunks = {"begin": [], "end": [], "file": [], "event": [],
+                       "photon_energy_eV": []}
+        self.crystals = {"begin": [], "end": [], "chunk": [], "cell": []}
+        self.filenames = []
+        self.summary = StreamSummary()
+        self.file_id = None
+        self.streamfile = None
+
+    def n_chunks(self):
+        return len(self.chunks["begin"])
+
+    def n_crystals(self):
+        return len(self.crystals["begin"])
+
+    def merge(self, other):
+        """Appends the index of the following part of the file."""
+        self.as_arrays()
+        other.as_arrays()
+        # image filenames numbered in the order of their first appearance,
+        # as in `index_stream()`
+        files = {filename: i for i, filename in enumerate(self.filenames)}
+        file_numbers = np.array([files.setdefault(filename, len(files))
+                                 for filename in other.filenames], dtype=np.int32)
+        self.filenames = list(files)
+        n_chunks = self.n_chunks()
+        for key in self.chunks:
+            values = other.chunks[key]
+            if key == "file":
+                values = file_numbers[values]
+            self.chunks[key] = np.concatenate((self.chunks[key], values))
+        for key in self.crystals:
+            values = other.crystals[key]
+            if key == "chunk":
+                values = values + n_chunks
+            self.crystals[key] = np.concatenate((self.crystals[key], values))
+        self.summary.merge(other.summary)
+        return self
+
+    def as_arrays(self):
+        """Converts the columns to compact numpy arrays."""
+        self.chunks["begin"] = np.asarray(self.chunks["begin"], dtype=np.int64)
+        self.chunks["end"] = np.asarray(self.chunks["end"], dtype=np.int64)
+        self.chunks["file"] = np.asarray(self.chunks["file"], dtype=np.int32)
+        self.chunks["event"] = np.asarray(self.chunks["event"], dtype=bytes)
+        self.chunks["photon_energy_eV"] = np.asarray(
+            self.chunks["photon_energy_eV"], dtype=np.float64)
+        self.crystals["begin"] = np.asarray(self.crystals["begin"], dtype=np.int64)
+        self.crystals["end"] = np.asarray(self.crystals["end"], dtype=np.int64)
+        self.crystals["chunk"] = np.asarray(self.crystals["chunk"], dtype=np.int64)
+        self.crystals["cell"] = np.asarray(
+            self.crystals["cell"], dtype=np.float64).reshape(-1, 6)
+        return self
+
+    def image(self, i_chunk):
+        """Returns:
+            tuple: Image filename and event of a chunk (str)
+        """
+        filename = self.filenames[int(self.chunks["file"][i_chunk])]
+        return filename.decode(), bytes(self.chunks["event"][i_chunk]).decode()
+
+    def read_chunk(self, i_chunk):
+        """Reads a chunk directly from the stream file without scanning it.
+        Returns:
+            bytes: Text of the chunk
+        """
+        begin = int(self.chunks["begin"][i_chunk])
+        end = int(self.chunks["end"][i_chunk])
+        with open(self.streamfile, "rb") as f:
+            f.seek(begin)
+            return f.read(end - begin)
+
+    def save(self, filename):
+        """Saves the index atomically in the numpy .npz format."""
+        self.as_arrays()
+        summary = self.summary
+        arrays = {
+            "version": np.array(STREAM_INDEX_VERSION),
+            "file_id": np.array(self.file_id, dtype=bytes),
+            "filenames": np.array(self.filenames, dtype=bytes),
+            "n_cells": np.array(summary.n_cells),
+            "cell_sums": np.array([str(v) for v in summary.cell_sums], dtype=bytes),
+        }
+        arrays["energies"], arrays["energy_counts"] = summary.energies.as_arrays()
+        for i, values in enumerate(summary.cell_values):
+            arrays[f"cell_values_{i}"], arrays[f"cell_counts_{i}"] = values.as_arrays()
+        for key, values in self.chunks.items():
+            arrays["chunk_" + key] = values
+        for key, values in self.crystals.items():
+            arrays["crystal_" + key] = values
+        save_npz(filename, arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """Loads an index saved with `save()`."""
+        index = cls()
+        with np.load(filename, allow_pickle=False) as arrays:
+            if int(arrays["version"]) != STREAM_INDEX_VERSION:
+                return None
+            index.file_id = bytes(arrays["file_id"][()])
+            index.filenames = [bytes(f) for f in arrays["filenames"]]
+            for key in index.chunks:
+                index.chunks[key] = arrays["chunk_" + key]
+            for key in index.crystals:
+                index.crystals[key] = arrays["crystal_" + key]
+            summary = index.summary
+            summary.n_cells = int(arrays["n_cells"])
+            summary.cell_sums = [Decimal(bytes(v).decode()) for v in arrays["cell_sums"]]
+            summary.energies = ValueHistogram.from_arrays(
+                ENERGY_HISTOGRAM_SCALE, arrays["energies"], arrays["energy_counts"])
+            summary.cell_values = [
+                ValueHistogram.from_arrays(
+                    scale, arrays[f"cell_values_{i}"], arrays[f"cell_counts_{i}"])
+                for i, scale in enumerate(CELL_HISTOGRAM_SCALES)]
+        return index
+
+
+def stream_file_id(streamfile):
+    """Identification of the content of a stream file: size, modification
+    time and a hash of the beginning and the end of the file.
+    Returns:
+        bytes: Identification
+    """
+    stat = os.stat(streamfile)
+    h = hashlib.blake2b(digest_size=16)
+    with open(streamfile, "rb") as f:
+        h.update(f.read(STREAM_FINGERPRINT_BYTES))
+        if stat.st_size > STREAM_FINGERPRINT_BYTES:
+            f.seek(max(STREAM_FINGERPRINT_BYTES, stat.st_size - STREAM_FINGERPRINT_BYTES))
+            h.update(f.read())
+    return f"{stat.st_size}:{stat.st_mtime_ns}:{h.hexdigest()}".encode()
+
+
+def stream_index_paths(streamfile, cache_dir=None):
+    """Candidate locations of the index of a stream file: next to the
+    stream file and in the cache directory (default: $XDG_CACHE_HOME or
+    ~/.cache, subdirectory import_serial).
+    Returns:
+        list: Paths
+    """
+    streamfile = os.path.abspath(streamfile)
+    if not cache_dir:
+        cache_dir = os.path.join(
+            os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+            "import_serial")
+    name = hashlib.blake2b(streamfile.encode(), digest_size=8).hexdigest()
+    return [streamfile + STREAM_INDEX_SUFFIX,
+            os.path.join(cache_dir, os.path.basename(streamfile) + "." + name + STREAM_INDEX_SUFFIX)]
+
+
+def _index_streamfile_part(streamfile, start, end):
+    mm = open_stream(streamfile)
+    try:
+        return index_stream(mm, start, end).as_arrays()
+    finally:
+        mm.close()
+
+
+def build_stream_index(streamfile, nproc=1):
+    """Indexes a whole stream file, using a pool of processes if `nproc` > 1.
+    Returns:
+        StreamIndex: Index of the stream file
+    """
+    file_id = stream_file_id(streamfile)
+    mm = open_stream(streamfile)
+    if mm is None:
+        index = StreamIndex()
+    else:
+        try:
+            parts = split_stream(mm, nproc * 4) if nproc > 1 else None
+            if not parts:
+                index = index_stream(mm)
+        finally:
+            mm.close()
+        if parts:
+            index = StreamIndex()
+            with ProcessPoolExecutor(max_workers=nproc) as executor:
+                futures = [executor.submit(_index_streamfile_part, streamfile, start, end)
+                           for start, end in parts]
+                for future in futures:
+                    index.merge(future.result())
+    index.as_arrays()
+    index.file_id = file_id
+    index.streamfile = streamfile
+    return index
+
+
+def load_stream_index(streamfile, cache_dir=None):
+    """Loads the index of a stream file if it exists and the stream file
+    has not changed since the index was built.
+    Returns:
+        StreamIndex: Index or None
+    """
+    file_id = None
+    for path in stream_index_paths(streamfile, cache_dir):
+        if not os.path.isfile(path):
+            continue
+        if file_id is None:
+            file_id = stream_file_id(streamfile)
+        try:
+            index = StreamIndex.load(path)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            continue
+        if index is not None and index.file_id == file_id:
+            index.streamfile = streamfile
+            return index
+    return None
+
+
+def get_stream_index(streamfile, nproc=1, cache_dir=None):
+    """Loads the index of a stream file or builds it and saves it next to
+    the stream file, or in the cache directory if that is not possible.
+    Returns:
+        StreamIndex: Index of the stream file
+    """
+    index = load_stream_index(streamfile, cache_dir)
+    if index is not None:
+        return index
+    index = build_stream_index(streamfile, nproc)
+    for path in stream_index_paths(streamfile, cache_dir):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            index.save(path)
+            break
+        except OSError:
+            continue
+    return index
+
+
+def summarize_stream(streamfile, nproc=1, stream_index=False, crystals=False,
+                     reflections=False):
+    """Cell parameters and photon energies of a stream file from a scan or,
+    if `stream_index`, from its index (built and saved if needed). With
+    `crystals`, the index is needed for the table of unit cells of all
+    crystals (`StreamSummary.crystals`), with `reflections` also for the
+    statistics of their reflection lists (`StreamSummary.crystal_stats`);
+    it is saved only if `stream_index`.
+    Returns:
+        StreamSummary: Aggregates of the whole file
+    """
+    if stream_index:
+        index = get_stream_index(streamfile, nproc)
+    elif crystals or reflections:
+        index = build_stream_index(streamfile, nproc)
+    else:
+        return scan_streamfile(streamfile, nproc)
+    summary = index.summary
+    if crystals:
+        summary.crystals = CellTable.from_index(index)
+    if reflections:
+        from .crystal_stats import CrystalStatsTable  # it imports this module
+        summary.crystal_stats = CrystalStatsTable.from_index(index, nproc)
+    return summary
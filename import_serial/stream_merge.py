@@ -0,0 +1,149 @@
+# coding: utf-8
+"""Half-data sets merged directly from the reflection lists of individual
+crystals in a CrystFEL stream file, for approximate CC1/2, CC* and Rsplit
+when partialator did not write the files .hkl1 and .hkl2. Crystals are
+split randomly (but reproducibly) into two halves and the intensities of
+each half are averaged without scaling or partiality corrections. The
+reflections are mapped to the asymmetric unit and summed per reflection
+in one pass over the memory-mapped file, in parts that can be read in
+a pool of processes."""
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from .crystal_stats import parse_reflection_rows, reflection_rows, stream_windows
+from .reflections import numpy_as_miller_indices, miller_indices_as_numpy, pack_indices
+from .stream import open_stream
+try:
+    from cctbx import miller, sgtbx
+except ImportError:  # reported in import_serial.py
+    pass
+
+
+STREAM_SPLIT_SEED = 0  # seed of the random split of crystals
+# Miller indices are packed to keys with a fixed range, so the sums of
+# parts of the stream file can be added without another pass
+MERGE_INDEX_LIMIT = 1 << 10
+MERGE_LOW = np.full(3, -MERGE_INDEX_LIMIT, dtype=np.int64)
+MERGE_SPAN = np.full(3, 2 * MERGE_INDEX_LIMIT, dtype=np.int64)
+
+
+def split_crystals(n_crystals, seed=STREAM_SPLIT_SEED):
+    """Random split of crystals into two halves of the same size (+-1). It
+    depends only on the number of crystals and the seed, not on the parts
+    the stream file is read in.
+    Returns:
+        numpy.ndarray: Half of each crystal, 0 or 1 (int8)
+    """
+    rng = np.random.default_rng(seed)
+    return (rng.permutation(n_crystals) % 2).astype(np.int8)
+
+
+def reduce_sums(keys, sums):
+    """Adds rows of `sums` with the same key.
+    Args:
+        keys (numpy.ndarray): Packed Miller indices (int64)
+        sums (numpy.ndarray): Sums of I, sigma(I)^2 and the number of
+            observations of each key (n, 3)
+    Returns:
+        tuple: Sorted unique keys and their sums
+    """
+    unique, groups = np.unique(keys, return_inverse=True)
+    groups = groups.ravel()
+    reduced = np.column_stack([np.bincount(groups, sums[:, j], minlength=unique.size)
+                               for j in range(sums.shape[1])])
+    return unique, reduced
+
+
+def merge_halves_part(mm, begins, ends, halves, space_group_symbol):
+    """Sums of the observations of each reflection in the asymmetric unit
+    in the two halves of crystals of a memory-mapped stream file.
+    Args:
+        mm (mmap.mmap): Memory-mapped stream file
+        begins (numpy.ndarray): Offsets of the lines "--- Begin crystal"
+        ends (numpy.ndarray): Offsets of the ends of the crystals
+        halves (numpy.ndarray): Half of each crystal from `split_crystals()`
+        space_group_symbol (str): Hall symbol of the space group
+    Returns:
+        list: Keys and sums from `reduce_sums()` of each half
+    """
+    space_group_type = sgtbx.space_group_info(symbol=space_group_symbol).type()
+    accumulated = [(np.zeros(0, dtype=np.int64), np.zeros((0, 3))) for _ in range(2)]
+    for first, last, buf, line_starts, find in stream_windows(mm, begins, ends):
+        crystal, rows, _ = reflection_rows(find, last - first)
+        columns = parse_reflection_rows(
+            buf, line_starts[rows], line_starts[rows + 1] - 1, ("h", "k", "l", "I", "sigma(I)"))
+        hkl = np.column_stack((columns["h"], columns["k"], columns["l"]))
+        valid = np.isfinite(columns["I"]) & np.isfinite(columns["sigma(I)"]) \
+            & (np.abs(hkl) < MERGE_INDEX_LIMIT).all(axis=1) & hkl.any(axis=1)
+        indices = numpy_as_miller_indices(hkl[valid].astype(np.int32))
+        # Friedel mates are merged, as in the merged data from partialator
+        miller.map_to_asu(space_group_type, False, indices)
+        keys = pack_indices(miller_indices_as_numpy(indices), MERGE_LOW, MERGE_SPAN)
+        sums = np.column_stack((columns["I"][valid], columns["sigma(I)"][valid] ** 2,
+                                np.ones(keys.size)))
+        half = halves[first + crystal[valid]]
+        for i in range(2):
+            keys_i, sums_i = accumulated[i]
+            accumulated[i] = reduce_sums(np.concatenate((keys_i, keys[half == i])),
+                                         np.concatenate((sums_i, sums[half == i])))
+    return accumulated
+
+
+def _merge_halves_streamfile_part(streamfile, begins, ends, halves, space_group_symbol):
+    mm = open_stream(streamfile)
+    try:
+        return merge_halves_part(mm, begins, ends, halves, space_group_symbol)
+    finally:
+        mm.close()
+
+
+def merge_stream_halves(index, space_group_info, nproc=1, seed=STREAM_SPLIT_SEED):
+    """Merges two random halves of the crystals in an indexed stream file.
+    The intensity of a reflection is the mean of its observations and its
+    sigma is propagated from the sigmas of the observations.
+    Args:
+        index (StreamIndex): Index of the stream file
+        space_group_info (cctbx.sgtbx.space_group_info): Space group of the
+            asymmetric unit
+        nproc (int): Number of processes
+        seed (int): Seed of the random split of crystals
+    Returns:
+        tuple: Columns h, k, l, I, sigma(I) and nmeas of the two half-data
+        sets (as from `read_hkl_crystfel()`) and the number of crystals
+        in each half
+    """
+    index.as_arrays()
+    begins, ends = index.crystals["begin"], index.crystals["end"]
+    halves = split_crystals(len(begins), seed)
+    symbol = "Hall: " + space_group_info.type().hall_symbol()
+    if not len(begins):
+        parts = []
+    elif nproc > 1:
+        splits = np.array_split(np.arange(len(begins)), nproc * 4)
+        with ProcessPoolExecutor(max_workers=nproc) as executor:
+            futures = [executor.submit(_merge_halves_streamfile_part, index.streamfile,
+                                       begins[part], ends[part], halves[part], symbol)
+                       for part in splits if len(part)]
+            parts = [future.result() for future in futures]
+    else:
+        parts = [_merge_halves_streamfile_part(index.streamfile, begins, ends, halves, symbol)]
+    data = []
+    for i in range(2):
+        keys, sums = reduce_sums(
+            np.concatenate([np.zeros(0, dtype=np.int64)] + [part[i][0] for part in parts]),
+            np.concatenate([np.zeros((0, 3))] + [part[i][1] for part in parts]))
+        # packed keys back to Miller indices
+        l_index = keys % MERGE_SPAN[2]
+        k_index = keys // MERGE_SPAN[2] % MERGE_SPAN[1]
+        h_index = keys // (MERGE_SPAN[2] * MERGE_SPAN[1])
+        hkl = np.column_stack((h_index, k_index, l_index)) + MERGE_LOW
+        nmeas = sums[:, 2]
+        data.append({
+            "h": hkl[:, 0].astype(np.int32),
+            "k": hkl[:, 1].astype(np.int32),
+            "l": hkl[:, 2].astype(np.int32),
+            "I": sums[:, 0] / nmeas,
+            "sigma(I)": np.sqrt(sums[:, 1]) / nmeas,
+            "nmeas": nmeas,
+        })
+    n_crystals = [int(np.count_nonzero(halves == i)) for i in range(2)]
+    return data[0], data[1], n_crystals
@@ -0,0 +1,377 @@
+# coding: utf-8
+"""Watch mode: statistics recalculated whenever merged data are rewritten,
+e.g. by partialator re-merging (.hkl, .hkl1, .hkl2) or by xia2.ssx writing
+merged MTZ files to a directory"""
+import argparse
+import io
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .atomic import atomic_output
+from .mtz_format import MTZ_END, MTZ_MAGIC, MTZ_RECORD
+
+
+WATCH_TAIL = 4096  # bytes at the end of a file searched for its end marker
+# columns of the data sets compared with the previous update
+VALUE_COLUMNS = {"merged": ("I", "sigma(I)", "nmeas"), "half1": ("I",), "half2": ("I",)}
+CRYSTFEL_END = b"End of reflections"
+
+
+def file_state(filename):
+    """Returns:
+        tuple: Size and modification time of a file or None if it does not exist
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def file_complete(filename):
+    """Checks that a reflection file was written completely: a reflection
+    list from CrystFEL contains the line "End of reflections" (followed only
+    by a few lines), an MTZ file ends with the record MTZENDOFHEADERS."""
+    try:
+        with open(filename, "rb") as f:
+            magic = f.read(len(MTZ_MAGIC))
+            size = os.fstat(f.fileno()).st_size
+            f.seek(max(size - WATCH_TAIL, 0))
+            tail = f.read()
+    except OSError:
+        return False
+    if magic == MTZ_MAGIC:
+        return MTZ_END in tail[-2 * MTZ_RECORD:]
+    return CRYSTFEL_END in tail
+
+
+def _same_columns(a, b, names):
+    import numpy as np
+    if a is None or b is None:
+        return a is None and b is None
+    return all(np.array_equal(a[name], b[name], equal_nan=a[name].dtype.kind == "f")
+               for name in names)
+
+
+class WatchedDataset:
+    """Merged data whose statistics are recalculated when its files are
+    rewritten: a reflection list from CrystFEL with half-data sets or an MTZ
+    file from xia2.ssx. Only the rewritten files are read again. If the
+    reflections (Miller indices) have not changed, the table of reflections
+    (asymmetric unit, resolution bins and the complete set) is reused and
+    only the values are replaced. Statistics of the merged data set and of
+    the half-data sets are recalculated only if their data changed.
+
+    Args:
+        hklin (str): Merged data
+        hklin_format (str): "crystfel" or "dials"
+        half_dataset (tuple): CrystFEL only: two half-data-set files
+        cs (cctbx.crystal.symmetry): Symmetry, required for CrystFEL
+        wavelength (float): Wavelength for the MTZ file (CrystFEL)
+        outputs (dict): Paths of the outputs "json", "xml" and "mtz"
+        args (argparse.Namespace): Options of import_serial (resolution
+            cutoffs, number of bins, cutoff sweep)
+    """
+    def __init__(self, hklin, hklin_format, half_dataset, cs, wavelength, outputs, args):
+        self.hklin = hklin
+        self.hklin_format = hklin_format
+        self.half_dataset = half_dataset
+        self.files = [hklin] + list(half_dataset or [])
+        self.cs = cs
+        self.wavelength = wavelength
+        self.outputs = outputs
+        self.args = args
+        self.processed = {}  # file states of the last update
+        self._seen = {}  # file states and the time when they were seen first
+        self.data = {}  # columns of the data sets "merged", "half1", "half2"
+        self.table = None
+        self.stats_merged = None
+        self.stats_compare = None
+
+    def ready(self, settle=0.2):
+        """Checks whether some of the files was rewritten and all of them
+        are complete and have not changed for `settle` seconds.
+        """
+        now = time.monotonic()
+        rewritten = False
+        for filename in self.files:
+            state = file_state(filename)
+            if state is None:
+                return False
+            if self._seen.get(filename, (None,))[0] != state:
+                self._seen[filename] = (state, now)
+            if state != self.processed.get(filename):
+                rewritten = True
+        if not rewritten:
+            return False
+        if any(now - self._seen[filename][1] < settle for filename in self.files):
+            return False
+        return all(file_complete(filename) for filename in self.files)
+
+    def _read(self, changed):
+        from .import_serial import read_hkl_crystfel, read_mtz_dials
+        if self.hklin_format == "dials":
+            merged, half1, half2, cs, anomalous_flag = read_mtz_dials(self.hklin)
+            return {"merged": merged, "half1": half1, "half2": half2}, cs, anomalous_flag
+        names = ["merged", "half1", "half2"][:len(self.files)]
+        data = dict(self.data)
+        read = [(name, filename) for name, filename in zip(names, self.files)
+                if filename in changed]
+        with ThreadPoolExecutor(max_workers=len(read)) as executor:
+            columns = list(executor.map(read_hkl_crystfel, [filename for _, filename in read]))
+        for (name, _), values in zip(read, columns):
+            data[name] = values
+        for name in ("half1", "half2"):
+            data.setdefault(name, None)
+        return data, self.cs, None
+
+    def update(self):
+        """Reads the rewritten files and recalculates the statistics.
+        Returns:
+            dict: Statistics (with performance of the stages) and what was
+            reused ("table", "stats_merged", "stats_compare"), or None if
+            a file changed while it was read (the update is repeated later)
+        """
+        from .cache import symmetry_key
+        from .import_serial import load_reflection_table, calc_stats_merged, \
+            calc_stats_compare, combine_stats, calc_stats_sweep, sweep_cutoffs
+        from .profiling import Profiler, file_size
+        args = self.args
+        states = {filename: file_state(filename) for filename in self.files}
+        changed = [f for f in self.files if states[f] != self.processed.get(f)]
+        profiler = Profiler()
+        with profiler.stage("parse", input_bytes=file_size(*changed)):
+            data, cs, anomalous_flag = self._read(changed)
+        if any(file_state(filename) != states[filename] for filename in self.files):
+            return None
+        previous = self.data
+        same = {name: name in previous
+                and _same_columns(data[name], previous[name], ("h", "k", "l"))
+                for name in data}
+        same_values = {name: same[name] and _same_columns(
+                           data[name], previous[name], VALUE_COLUMNS[name])
+                       for name in data}
+        same_cs = self.table is not None \
+            and symmetry_key(cs) == symmetry_key(self.table.crystal_symmetry)
+        reused = {"table": same_cs and all(same.values())}
+        log = io.StringIO()  # printed tables of statistics, not shown
+        if reused["table"]:
+            table = self.table.with_values(data["merged"], data["half1"], data["half2"])
+        else:
+            table, cs = load_reflection_table(
+                self.hklin, self.hklin_format, cs, self.half_dataset,
+                args.d_max, args.d_min, args.n_bins, profiler=profiler,
+                reflections=(data["merged"], data["half1"], data["half2"], cs,
+                             anomalous_flag))
+        with profiler.stage("statistics", n_reflections=len(table)):
+            reused["stats_merged"] = same_cs and same_values["merged"]
+            if not reused["stats_merged"]:
+                self.stats_merged = calc_stats_merged(table, log)
+            reused["stats_compare"] = reused["table"] and table.has_halves \
+                and same_values["half1"] and same_values["half2"]
+            if not table.has_halves:
+                self.stats_compare = None
+            elif not reused["stats_compare"]:
+                self.stats_compare = calc_stats_compare(table, log)
+            stats = combine_stats(self.stats_merged, self.stats_compare)
+        thresholds = args.cc_min is not None or args.ccstar_min is not None \
+            or args.isigi_min is not None
+        if args.sweep_dmin or args.sweep_shells or thresholds:
+            cutoffs = args.sweep_dmin or sweep_cutoffs(table, args.sweep_shells or 50)
+            with profiler.stage("sweep", n_reflections=len(table), n_cutoffs=len(cutoffs)):
+                stats.update(calc_stats_sweep(
+                    table, cutoffs, args.cc_min, args.ccstar_min, args.isigi_min, log))
+        self.table = table
+        self.data = data
+        self.processed = states
+        # statistics first, the MTZ file from CrystFEL data (slow to write)
+        # only if the merged data changed
+        stats["performance"] = profiler.as_dict()
+        self.write_stats(stats)
+        if self.hklin_format != "crystfel" or not reused["stats_merged"] \
+                or not os.path.isfile(self.outputs["mtz"]):
+            with profiler.stage("output") as sizes:
+                self.write_mtz()
+                sizes["output_bytes"] = file_size(self.outputs["mtz"])
+        return {"stats": stats, "reused": reused, "changed": changed}
+
+    def write_stats(self, stats):
+        """Writes the statistics to the JSON and XML files atomically."""
+        from .import_serial import write_stats
+        with atomic_output(self.outputs["json"]) as jsonout, \
+                atomic_output(self.outputs["xml"]) as xmlout:
+            write_stats(stats, jsonout, xmlout)
+
+    def write_mtz(self):
+        """Writes the MTZ file atomically (a copy of the input for xia2.ssx)."""
+        from .import_serial import write_mtz_crystfel
+        with atomic_output(self.outputs["mtz"]) as hklout:
+            if self.hklin_format == "crystfel":
+                write_mtz_crystfel(self.table, hklout, self.wavelength)
+            else:
+                shutil.copy2(self.hklin, hklout)
+
+
+def update_line(result, latency):
+    """Returns:
+        str: One line about an update from `WatchedDataset.update()`
+    """
+    overall = result["stats"]["overall"]
+    changed = " ".join(os.path.basename(filename) for filename in result["changed"])
+    reflections = "same reflections" if result["reused"]["table"] else "new reflections"
+    line = f"{time.strftime('%H:%M:%S')}  {changed} ({reflections}):"
+    line += f" d_min = {overall['d_min']}, completeness = {overall['completeness']} %," \
+            f" <I/sigma(I)> = {overall['IsigI']}"
+    if "cc" in overall:
+        line += f", CC1/2 = {overall['cc']}"
+    if latency is not None:
+        line += f"  [{latency:.2f} s after the change]"
+    return line
+
+
+class Watcher:
+    """Watches merged data (`WatchedDataset`): one data set from CrystFEL or
+    all MTZ files in a directory, new files are added when they appear.
+    Args:
+        args (argparse.Namespace): Options of import_serial
+        outdir (str): Output directory
+        hklin_dir (str): Directory with MTZ files from xia2.ssx (instead of
+            `args.hklin`)
+        settle (float): Seconds without changes before a file is read
+    """
+    def __init__(self, args, outdir=".", hklin_dir=None, settle=0.2):
+        self.args = args
+        self.outdir = outdir
+        self.hklin_dir = hklin_dir
+        self.settle = settle
+        self.datasets = {}
+        if not hklin_dir:
+            self.datasets[args.hklin] = self._crystfel_or_mtz(args.hklin)
+
+    def _crystfel_or_mtz(self, hklin):
+        from .import_serial import get_hklin_format, find_half_dataset, get_symmetry, \
+            get_wavelength
+        args = self.args
+        hklin_format = get_hklin_format(hklin)
+        prefix = f"{args.project or 'project'}_{args.dataset or 'dataset'}"
+        prefix = "".join(i for i in prefix if i not in r"\/:*?<>|")
+        outputs = {"json": os.path.join(self.outdir, f"{prefix}.json"),
+                   "xml": os.path.join(self.outdir, "program.xml"),
+                   "mtz": os.path.join(self.outdir, f"{prefix}.mtz")}
+        if hklin_format == "crystfel":
+            half_dataset = args.half_dataset or find_half_dataset(hklin)
+            cs = get_symmetry(args, hklin_format)
+            wavelength = get_wavelength(args, hklin_format)
+        else:
+            half_dataset = cs = wavelength = None
+        return WatchedDataset(hklin, hklin_format, half_dataset, cs, wavelength, outputs, args)
+
+    def _scan_dir(self):
+        for entry in sorted(os.scandir(self.hklin_dir), key=lambda entry: entry.name):
+            if entry.name in self.datasets or not entry.name.lower().endswith(".mtz") \
+                    or not entry.is_file():
+                continue
+            stem = os.path.splitext(entry.name)[0]
+            outputs = {key: os.path.join(self.outdir, f"{stem}.{key}")
+                       for key in ("json", "xml", "mtz")}
+            self.datasets[entry.name] = WatchedDataset(
+                entry.path, "dials", None, None, None, outputs, self.args)
+
+    def poll(self):
+        """Updates the data sets whose files were rewritten.
+        Returns:
+            list: Tuples of the data set, result of its update and latency
+            (seconds from the last modification of its files, None for the
+            first update)
+        """
+        from .import_serial import ImportSerialError
+        if self.hklin_dir:
+            self._scan_dir()
+        updates = []
+        for dataset in self.datasets.values():
+            if not dataset.ready(self.settle):
+                continue
+            first = not dataset.processed
+            try:
+                result = dataset.update()
+            except (ImportSerialError, OSError, ValueError, RuntimeError) as e:
+                sys.stderr.write(
+                    f"WARNING: Statistics of {dataset.hklin} could not be calculated: {e}\n")
+                dataset.processed = {f: file_state(f) for f in dataset.files}
+                continue
+            if result is not None:
+                latency = None
+                if not first:
+                    mtime = max(os.stat(filename).st_mtime for filename in result["changed"])
+                    latency = time.time() - mtime
+                updates.append((dataset, result, latency))
+        return updates
+
+
+def run_watch(argv=None):
+    from .cli import get_parser
+    parser = argparse.ArgumentParser(
+        description="Recalculate statistics whenever the merged data are rewritten, e.g. "
+                    "by partialator (.hkl, .hkl1 and .hkl2) or by xia2.ssx (merged MTZ files "
+                    "in a directory). Other options are passed to import_serial.",
+        allow_abbrev=False,  # --hklin is passed to import_serial
+    )
+    parser.add_argument(
+        "--hklin-dir",
+        help="Directory with merged MTZ files from xia2.ssx, all of them are watched "
+             "(instead of --hklin)",
+    )
+    parser.add_argument(
+        "--outdir", "-o",
+        type=str,
+        default=".",
+        help="Output directory (default: current directory)",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.1,
+        help="Seconds between checks of the files (default 0.1)",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=0.2,
+        help="A rewritten file is read when it has not changed for this number of seconds "
+             "and its end was written (default 0.2)",
+    )
+    if argv is None:
+        argv = sys.argv[1:]
+    watch_args, common_argv = parser.parse_known_args(argv)
+    import_serial_parser = get_parser()
+    if watch_args.hklin_dir:
+        for action in import_serial_parser._actions:
+            if action.dest == "hklin":
+                action.required = False
+    args = import_serial_parser.parse_args(common_argv)
+    if watch_args.hklin_dir and args.hklin:
+        parser.error("Specify either --hklin or --hklin-dir")
+    if watch_args.hklin_dir and not os.path.isdir(watch_args.hklin_dir):
+        parser.error(f"The directory {watch_args.hklin_dir} does not exist!")
+    if watch_args.hklin_dir and \
+            os.path.realpath(watch_args.hklin_dir) == os.path.realpath(watch_args.outdir):
+        parser.error("The output directory must differ from --hklin-dir")
+    os.makedirs(watch_args.outdir, exist_ok=True)
+
+    watcher = Watcher(args, watch_args.outdir, watch_args.hklin_dir, watch_args.settle)
+    print("")
+    print(f"Watching {watch_args.hklin_dir or ' '.join(watcher.datasets[args.hklin].files)} "
+          f"(Ctrl+C to stop):")
+    try:
+        while True:
+            for dataset, result, latency in watcher.poll():
+                print(update_line(result, latency), flush=True)
+            time.sleep(watch_args.interval)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    run_watch()
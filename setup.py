@@ -33,7 +33,11 @@ setup(
     zip_safe=False,
     entry_points={
         'console_scripts': [
-            'import_serial = import_serial.import_serial:run',
+            'import_serial = import_serial.cli:main',
+            'import_serial_batch = import_serial.batch:run_batch',
+            'import_serial_follow = import_serial.follow:run_follow',
+            'import_serial_watch = import_serial.watch:run_watch',
+            'import_serial_results = import_serial.results_db:run_results',
         ]
     },
     # install_requires=['numpy', 'matplotlib'],
@@ -0,0 +1,76 @@
+# coding: utf-8
+"""Benchmark of reading CrystFEL reflection lists: the NumPy fixed-width
+parser `read_hkl_crystfel()` compared with the previous pandas path
+(`pandas.read_csv(sep=r'\\s+')` on the stripped data).
+
+$ ccp4-python benchmark_hkl.py --nrefl 3000000
+"""
+import argparse
+import io
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from import_serial.import_serial import hkl_strip, read_hkl_crystfel
+
+
+def write_hkl(filename, n_refl, seed=0):
+    """Writes a synthetic CrystFEL reflection list with `n_refl` reflections."""
+    rng = np.random.default_rng(seed)
+    chunk = 100000
+    with open(filename, "w") as f:
+        f.write("CrystFEL reflection list version 2.0\n")
+        f.write("Symmetry: 2/m_uab\n")
+        f.write("   h    k    l          I    phase   sigma(I)   nmeas\n")
+        for start in range(0, n_refl, chunk):
+            n = min(chunk, n_refl - start)
+            hkl = rng.integers(-150, 150, size=(n, 3))
+            intensity = rng.exponential(500, n) - 50
+            sigma = rng.exponential(20, n) + 1
+            nmeas = rng.integers(1, 200, n)
+            f.writelines(
+                "%4i %4i %4i %10.2f %s %10.2f %7i\n" % (h, k, l, i, "       -", s, m)
+                for (h, k, l), i, s, m in zip(hkl, intensity, sigma, nmeas))
+        f.write("End of reflections\n")
+        f.write("Generated by CrystFEL 0.10.2\n")
+
+
+def read_hkl_pandas(hklin):
+    """The previous parsing path based on pandas."""
+    return pd.read_csv(
+        io.BytesIO(hkl_strip(hklin)), header=None, index_col=False, sep=r'\s+',
+        names=("h", "k", "l", "I", "phase", "sigma(I)", "nmeas"))
+
+
+def best_of(function, repeat):
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - t0)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nrefl", type=int, nargs="+", default=[1000000, 3000000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    print(f"{'#refl':>10}{'MB':>8}{'pandas/s':>10}{'numpy/s':>10}{'speedup':>9}")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for n_refl in args.nrefl:
+            hklin = os.path.join(tmpdir, f"bench_{n_refl}.hkl")
+            write_hkl(hklin, n_refl)
+            size_mb = os.path.getsize(hklin) / 1e6
+            t_pandas, df = best_of(lambda: read_hkl_pandas(hklin), args.repeat)
+            t_numpy, columns = best_of(lambda: read_hkl_crystfel(hklin), args.repeat)
+            for name, values in columns.items():
+                assert np.array_equal(values, df[name].values), name
+            print(f"{n_refl:>10}{size_mb:>8.0f}{t_pandas:>10.2f}{t_numpy:>10.2f}"
+                  f"{t_pandas / t_numpy:>9.1f}")
+            os.remove(hklin)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+# coding: utf-8
+"""Benchmark of the stages of import_serial on synthetic data (no network
+access needed): parsing of reflection lists, scanning and indexing of the
+stream file, binning to the reflection table, statistics, output writing,
+reading of the MTZ file from xia2.ssx and complete runs of the program.
+Wall time, CPU time and peak memory of each stage are saved to a JSON file
+to track the performance across versions.
+
+$ ccp4-python benchmark_suite.py --dmin 1.3 --stream-size-mb 2000 --output bench.json
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from import_serial.profiling import peak_rss_reset, peak_rss_mb
+from synthetic import crystal_symmetry, write_dataset
+
+
+def measure(name, function, results, repeat=1, size_mb=None, n_items=None):
+    """Runs `function()` (best of `repeat`) with the printed output
+    suppressed and records wall time, CPU time and peak memory.
+    Returns:
+        Result of the function
+    """
+    best = None
+    for i in range(repeat):
+        per_stage = peak_rss_reset()
+        t_wall = time.perf_counter()
+        t_cpu = time.process_time()
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            result = function()
+        stage = {"wall_s": round(time.perf_counter() - t_wall, 4),
+                 "cpu_s": round(time.process_time() - t_cpu, 4),
+                 "peak_rss_mb": round(peak_rss_mb(), 1),
+                 "peak_rss_per_stage": per_stage}
+        if best is None or stage["wall_s"] < best["wall_s"]:
+            best = stage
+    if size_mb:
+        best["input_mb"] = round(size_mb, 1)
+        best["mb_per_s"] = round(size_mb / best["wall_s"], 1)
+    if n_items:
+        best["n_items"] = int(n_items)
+        best["items_per_s"] = round(n_items / best["wall_s"])
+    results[name] = best
+    print(f"{name:<16}{best['wall_s']:>9.3f}{best['cpu_s']:>9.3f}{best['peak_rss_mb']:>10.0f}"
+          f"{best.get('mb_per_s', ''):>10}")
+    return result
+
+
+def run_program(args, cwd):
+    """Complete run of the program in a new process.
+    Returns:
+        dict: Wall time, peak memory and the stages measured by the program
+    """
+    code = (
+        "import resource, sys, time\n"
+        "t = time.perf_counter()\n"
+        "from import_serial.cli import main\n"
+        f"main({args!r})\n"
+        "sys.stderr.write('\\nBENCHMARK %f %d\\n' % (time.perf_counter() - t, "
+        "resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))\n")
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+        + [env["PYTHONPATH"]] * bool(env.get("PYTHONPATH")))
+    t_wall = time.perf_counter()
+    p = subprocess.run([sys.executable, "-c", code], cwd=cwd, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, encoding="utf-8")
+    line = [line for line in p.stderr.splitlines() if line.startswith("BENCHMARK")][-1]
+    t_run, maxrss = line.split()[1:]
+    with open(os.path.join(cwd, "project_dataset.json")) as f:
+        performance = json.load(f)["performance"]
+    return {"wall_s": round(time.perf_counter() - t_wall, 4), "run_s": round(float(t_run), 4),
+            "peak_rss_mb": round(int(maxrss) / 1024, 1), "stages": performance["stages"]}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding="utf-8").stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--spacegroup", default="P21")
+    parser.add_argument("--cell", type=float, nargs=6, default=(39.4, 78.5, 48.0, 90, 97.94, 90))
+    parser.add_argument("--dmin", type=float, default=1.6, help="Resolution of the merged data")
+    parser.add_argument("--stream-size-mb", type=float, default=200)
+    parser.add_argument("--nbins", type=int, default=20)
+    parser.add_argument("--nproc", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--data", help="Directory with the synthetic data (kept), "
+                                       "a temporary directory is used by default")
+    parser.add_argument("--output", default="benchmark.json")
+    args = parser.parse_args()
+
+    from import_serial import __version__
+    from import_serial.import_serial import read_hkl_crystfel, read_mtz_dials, \
+        calc_stats_merged, calc_stats_compare, write_stats, write_mtz_crystfel
+    from import_serial.reflections import build_reflection_table
+    from import_serial.stream import scan_streamfile, build_stream_index
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        datadir = args.data or tmpdir
+        t = time.perf_counter()
+        files = write_dataset(datadir, args.spacegroup, args.cell, args.dmin,
+                              stream_size_mb=args.stream_size_mb)
+        print(f"Synthetic data written in {time.perf_counter() - t:.1f} s to {datadir}")
+        sizes = {name: os.path.getsize(path) / 1e6 for name, path in files.items()}
+        cs = crystal_symmetry(args.spacegroup, args.cell)
+        stages = {}
+        print(f"\n{'stage':<16}{'wall/s':>9}{'cpu/s':>9}{'peak/MB':>10}{'MB/s':>10}")
+        merged = measure("parse_hkl", lambda: read_hkl_crystfel(files["hkl"]), stages,
+                         args.repeat, sizes["hkl"])
+        half1 = read_hkl_crystfel(files["hkl1"])
+        half2 = read_hkl_crystfel(files["hkl2"])
+        measure("scan_stream", lambda: scan_streamfile(files["stream"], args.nproc), stages,
+                args.repeat, sizes["stream"])
+        index = measure("index_stream", lambda: build_stream_index(files["stream"], args.nproc),
+                        stages, 1, sizes["stream"])
+        table = measure("binning", lambda: build_reflection_table(
+            cs, merged, half1, half2, n_bins=args.nbins), stages, args.repeat,
+            n_items=len(merged["I"]) + len(half1["I"]) + len(half2["I"]))
+        stats_merged = measure("stats_merged", lambda: calc_stats_merged(table), stages,
+                               args.repeat, n_items=len(table))
+        stats_compare = measure("stats_compare", lambda: calc_stats_compare(table), stages,
+                                args.repeat, n_items=len(table))
+        stats = {"overall": {**stats_merged["overall"], **stats_compare["overall"]},
+                 "binned": {**stats_merged["binned"], **stats_compare["binned"]}}
+        outdir = os.path.join(tmpdir, "out")
+        os.makedirs(outdir, exist_ok=True)
+        measure("write_outputs", lambda: (
+            write_stats(stats, os.path.join(outdir, "stats.json"),
+                        os.path.join(outdir, "program.xml")),
+            write_mtz_crystfel(table, os.path.join(outdir, "out.mtz"), 1.0)),
+            stages, args.repeat, n_items=len(table))
+        measure("read_mtz", lambda: read_mtz_dials(files["mtz"]), stages, args.repeat,
+                sizes["mtz"])
+        del merged, half1, half2, table, index
+
+        runs = {
+            "run_crystfel": ["--hklin", files["hkl"], "--spacegroup", args.spacegroup,
+                             "--cell"] + [str(x) for x in args.cell]
+                            + ["--wavelength", "1.0", "--nbins", str(args.nbins)],
+            "run_crystfel_stream": ["--hklin", files["hkl"], "--spacegroup", args.spacegroup,
+                                    "--streamfile", files["stream"], "--nproc", str(args.nproc),
+                                    "--nbins", str(args.nbins)],
+            "run_xia2": ["--hklin", files["mtz"], "--nbins", str(args.nbins)],
+        }
+        for name, run_args in runs.items():
+            results = [run_program(run_args, outdir) for i in range(args.repeat)]
+            stages[name] = min(results, key=lambda r: r["wall_s"])
+            print(f"{name:<16}{stages[name]['wall_s']:>9.3f}{'':>9}"
+                  f"{stages[name]['peak_rss_mb']:>10.0f}")
+
+    report = {
+        "import_serial_version": __version__,
+        "git_commit": git_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "parameters": {key: value for key, value in vars(args).items() if key != "data"},
+        "inputs": {"n_reflections": stats["overall"]["n_unique"],
+                   "file_mb": {name: round(size, 1) for name, size in sizes.items()}},
+        "stages": stages,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"\nResults saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
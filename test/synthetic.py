@@ -0,0 +1,270 @@
+# coding: utf-8
+"""Synthetic serial MX data of configurable size and symmetry for tests and
+benchmarks without network access: merged CrystFEL reflection lists (.hkl,
+.hkl1, .hkl2), CrystFEL stream files with chunks, crystals, unit cells,
+photon energies and reflections, and merged MTZ files as from xia2.ssx.
+
+$ ccp4-python synthetic.py --outdir data --dmin 1.6 --stream-size-mb 2000
+"""
+import argparse
+import io
+import os
+import numpy as np
+
+
+HKL_HEADER = """CrystFEL reflection list version 2.0
+Symmetry: {symmetry}
+   h    k    l          I    phase   sigma(I)   nmeas
+"""
+HKL_FOOTER = """End of reflections
+Generated by CrystFEL 0.10.2
+"""
+HKL_FORMAT = "%4i %4i %4i %10.2f        - %10.2f %7i"
+STREAM_HEADER = """CrystFEL stream format 2.3
+Generated by CrystFEL 0.10.2
+Indexing methods used: xgandalf
+----- Begin geometry file -----
+photon_energy = {energy:.0f}
+clen = 0.1
+----- End geometry file -----
+"""
+STREAM_CHUNK = """----- Begin chunk -----
+Image filename: /data/run{run:03d}.h5
+Event: //{event}
+Image serial number: {serial}
+hit = {hit}
+indexed_by = {indexed_by}
+n_indexing_tries = 1
+photon_energy_eV = {energy:f}
+beam_divergence = 0.00e+00 rad
+beam_bandwidth = 1.00e-08 (fraction)
+num_peaks = {n_peaks}
+peak_resolution = 4.0 nm^-1 or 2.5 A
+Peaks from peak search
+  fs/px   ss/px (1/d)/nm^-1     Intensity  Panel
+End of peak list
+"""
+STREAM_CRYSTAL = """--- Begin crystal
+Cell parameters {0:.5f} {1:.5f} {2:.5f} nm, {3:.5f} {4:.5f} {5:.5f} deg
+astar = +0.1 +0.2 +0.3 nm^-1
+bstar = +0.1 +0.2 +0.3 nm^-1
+cstar = +0.1 +0.2 +0.3 nm^-1
+lattice_type = {lattice_type}
+centering = {centering}
+profile_radius = 0.00274 nm^-1
+predict_refine/final_residual = 0.1
+diffraction_resolution_limit = {resolution_nm:.2f} nm^-1 or {resolution:.2f} A
+num_reflections = {n_refl}
+num_saturated_reflections = 0
+num_implausible_reflections = 0
+Reflections measured after indexing
+   h    k    l          I   sigma(I)       peak background  fs/px  ss/px panel
+"""
+STREAM_REFLECTION_FORMAT = "%4i %4i %4i %10.2f %10.2f %10.2f %10.2f %6.1f %6.1f p0"
+STREAM_CRYSTAL_END = "End of reflections\n--- End crystal\n"
+STREAM_CHUNK_END = "----- End chunk -----\n"
+STREAM_POOL = 256  # number of distinct reflection blocks reused in stream files
+
+
+def crystal_symmetry(spacegroup="P21", cell=(39.4, 78.5, 48.0, 90, 97.94, 90)):
+    from cctbx import crystal
+    return crystal.symmetry(unit_cell=tuple(cell), space_group_symbol=spacegroup)
+
+
+def merged_data(cs, d_min=2.0, completeness=0.97, multiplicity=40, b_factor=20, seed=0):
+    """Merged intensities with a Wilson-like fall-off, sigmas from counting
+    statistics and multiplicities decreasing with resolution.
+    Args:
+        cs (cctbx.crystal.symmetry): Symmetry
+        d_min (float): High-resolution limit
+        completeness (float): Fraction of the unique reflections
+        multiplicity (float): Mean multiplicity at low resolution
+        b_factor (float): Overall B factor of the intensities
+        seed (int): Seed of the random number generator
+    Returns:
+        dict: numpy arrays h, k, l, I, sigma(I) and nmeas
+    """
+    from cctbx import miller
+    rng = np.random.default_rng(seed)
+    complete = miller.build_set(cs, anomalous_flag=False, d_min=d_min)
+    hkl = np.array(complete.indices(), dtype=np.int32).reshape(-1, 3)
+    d_star_sq = complete.d_star_sq().data().as_numpy_array()
+    sel = np.sort(rng.permutation(len(hkl))[:int(round(len(hkl) * completeness))])
+    hkl = hkl[sel]
+    d_star_sq = d_star_sq[sel]
+    falloff = np.exp(-b_factor * d_star_sq / 2)
+    nmeas = rng.poisson(multiplicity * (0.5 + 0.5 * falloff)) + 1
+    intensity = rng.exponential(2000, len(hkl)) * falloff
+    sigma = np.sqrt(intensity + 50) * 3 / np.sqrt(nmeas) + 1
+    intensity = intensity + rng.normal(0, sigma)
+    return {"h": hkl[:, 0], "k": hkl[:, 1], "l": hkl[:, 2],
+            "I": intensity, "sigma(I)": sigma, "nmeas": nmeas}
+
+
+def half_data(merged, seed=1, missing=0.01, friedel=False):
+    """Half-data set with a half of the multiplicity and more noise, some
+    reflections are missing. Indices are optionally inverted (Friedel mates)
+    and the order is shuffled as in the files from CrystFEL."""
+    rng = np.random.default_rng(seed)
+    n = len(merged["I"])
+    sel = rng.permutation(n)[:int(round(n * (1 - missing)))]
+    sign = -1 if friedel else 1
+    sigma = merged["sigma(I)"][sel] * np.sqrt(2)
+    return {"h": sign * merged["h"][sel], "k": sign * merged["k"][sel],
+            "l": sign * merged["l"][sel],
+            "I": merged["I"][sel] + rng.normal(0, merged["sigma(I)"][sel]),
+            "sigma(I)": sigma, "nmeas": np.maximum(merged["nmeas"][sel] // 2, 1)}
+
+
+def write_hkl(path, columns, symmetry="2/m_uab", chunk=200000):
+    """Writes a CrystFEL reflection list in its fixed-width format."""
+    with open(path, "w") as f:
+        f.write(HKL_HEADER.format(symmetry=symmetry))
+        names = ("h", "k", "l", "I", "sigma(I)", "nmeas")
+        for start in range(0, len(columns["I"]), chunk):
+            rows = np.column_stack([columns[name][start:start + chunk] for name in names])
+            np.savetxt(f, rows, fmt=HKL_FORMAT)
+        f.write(HKL_FOOTER)
+    return str(path)
+
+
+def _reflection_blocks(merged, n_blocks, n_refl, rng):
+    """Formatted reflection lists of crystals: random subsets of the merged
+    reflections with partial intensities and detector positions."""
+    blocks = []
+    n = len(merged["I"])
+    for i in range(n_blocks):
+        count = int(rng.integers(n_refl // 2, n_refl * 3 // 2 + 1))
+        sel = rng.integers(0, n, count)
+        partiality = rng.uniform(0.1, 1, count)
+        intensity = merged["I"][sel] * partiality + rng.normal(0, 10, count)
+        sigma = np.sqrt(np.abs(intensity) + 100)
+        background = rng.uniform(20, 40, count)
+        rows = np.column_stack((
+            merged["h"][sel], merged["k"][sel], merged["l"][sel], intensity, sigma,
+            intensity + background, background,
+            rng.uniform(0, 1000, count), rng.uniform(0, 1000, count)))
+        text = io.StringIO()
+        np.savetxt(text, rows, fmt=STREAM_REFLECTION_FORMAT)
+        blocks.append((count, text.getvalue()))
+    return blocks
+
+
+def write_stream(path, cs, merged, n_chunks=None, size_mb=None, hit_rate=0.6, n_refl=300,
+                 energy=9500.0, cell_sigma=0.005, seed=2):
+    """Writes a CrystFEL stream file. Each chunk (image) is a hit with the
+    probability `hit_rate` and then contains one or two crystals with
+    slightly varying unit cells, photon energies also vary. The reflection
+    blocks of crystals are drawn from a pool of `STREAM_POOL` blocks so that
+    files of several GB are written quickly.
+    Args:
+        n_chunks (int): Number of chunks
+        size_mb (float): Approximate size of the file if `n_chunks` is not given
+    """
+    rng = np.random.default_rng(seed)
+    blocks = _reflection_blocks(merged, STREAM_POOL, n_refl, rng)
+    cell = np.array(cs.unit_cell().parameters())
+    cell[:3] /= 10  # nm
+    cell_noise = np.array([1, 1, 1, 0.1, 0.1, 0.1]) * (cell != 90)  # right angles kept
+    crystal_info = {"lattice_type": cs.space_group().crystal_system().lower(),
+                    "centering": str(cs.space_group_info())[0], "resolution": 2.0,
+                    "resolution_nm": 5.0}
+    size_limit = size_mb * 1e6 if size_mb and not n_chunks else None
+    with open(path, "w") as f:
+        f.write(STREAM_HEADER.format(energy=energy))
+        i = 0
+        while (n_chunks is not None and i < n_chunks) or \
+                (size_limit is not None and f.tell() < size_limit):
+            n_crystals = int(rng.choice([1, 1, 1, 2])) if rng.random() < hit_rate else 0
+            f.write(STREAM_CHUNK.format(
+                run=i // 1000, event=i % 1000, serial=i + 1, hit=int(n_crystals > 0),
+                indexed_by="xgandalf" if n_crystals else "none",
+                energy=energy + rng.normal(0, 1.5), n_peaks=0))
+            for c in range(n_crystals):
+                count, text = blocks[int(rng.integers(len(blocks)))]
+                cell_crystal = cell * (1 + rng.normal(0, cell_sigma, 6) * cell_noise)
+                f.write(STREAM_CRYSTAL.format(*cell_crystal, n_refl=count, **crystal_info))
+                f.write(text)
+                f.write(STREAM_CRYSTAL_END)
+            f.write(STREAM_CHUNK_END)
+            i += 1
+    return str(path)
+
+
+def write_xia2_mtz(path, cs, merged, half1, half2, anomalous=True, wavelength=0.98):
+    """Writes a merged MTZ file with the columns as from xia2.ssx: IMEAN,
+    SIGIMEAN, IHALF1, SIGIHALF1, IHALF2, SIGIHALF2, N and optionally
+    anomalous intensities I(+), SIGI(+), I(-), SIGI(-)."""
+    from cctbx import miller
+    from cctbx.array_family import flex
+
+    def array(columns, name="I", sigmas=True):
+        indices = flex.miller_index(
+            flex.int(columns["h"].astype(np.int32)), flex.int(columns["k"].astype(np.int32)),
+            flex.int(columns["l"].astype(np.int32)))
+        m = miller.array(
+            miller.set(cs, indices, anomalous_flag=False).map_to_asu(),
+            flex.double(columns[name].astype(np.float64)),
+            flex.double(columns["sigma(I)"]) if sigmas else None)
+        return m
+
+    m_i = array(merged).set_observation_type_xray_intensity()
+    dataset = m_i.as_mtz_dataset(column_root_label="IMEAN", wavelength=wavelength)
+    for label, half in (("IHALF1", half1), ("IHALF2", half2)):
+        m = array(half).set_observation_type_xray_intensity()
+        dataset.add_miller_array(m.common_set(m_i), column_root_label=label)
+    if anomalous:
+        m_anom = m_i.generate_bijvoet_mates()
+        dataset.add_miller_array(m_anom, column_root_label="I")
+    dataset.add_miller_array(array(merged, "nmeas", sigmas=False),
+                             column_root_label="N", column_types="R")
+    dataset.mtz_object().write(str(path))
+    return str(path)
+
+
+def write_dataset(outdir, spacegroup="P21", cell=(39.4, 78.5, 48.0, 90, 97.94, 90), d_min=2.0,
+                  stream_chunks=None, stream_size_mb=None, mtz=True, seed=0):
+    """Writes a complete synthetic data set to `outdir`.
+    Returns:
+        dict: Paths of the files: hkl, hkl1, hkl2, stream, mtz (if written)
+    """
+    os.makedirs(outdir, exist_ok=True)
+    cs = crystal_symmetry(spacegroup, cell)
+    merged = merged_data(cs, d_min=d_min, seed=seed)
+    half1 = half_data(merged, seed=seed + 1)
+    half2 = half_data(merged, seed=seed + 2, friedel=True)
+    laue = str(cs.space_group().build_derived_laue_group().info()).replace(" ", "")
+    files = {
+        "hkl": write_hkl(os.path.join(outdir, "data.hkl"), merged, laue),
+        "hkl1": write_hkl(os.path.join(outdir, "data.hkl1"), half1, laue),
+        "hkl2": write_hkl(os.path.join(outdir, "data.hkl2"), half2, laue),
+    }
+    if stream_chunks or stream_size_mb:
+        files["stream"] = write_stream(
+            os.path.join(outdir, "data.stream"), cs, merged, stream_chunks, stream_size_mb,
+            seed=seed + 3)
+    if mtz:
+        files["mtz"] = write_xia2_mtz(os.path.join(outdir, "data.mtz"), cs, merged, half1, half2)
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--outdir", default="synthetic")
+    parser.add_argument("--spacegroup", default="P21")
+    parser.add_argument("--cell", type=float, nargs=6, default=(39.4, 78.5, 48.0, 90, 97.94, 90))
+    parser.add_argument("--dmin", type=float, default=2.0, help="Resolution of the merged data")
+    parser.add_argument("--stream-chunks", type=int, help="Number of chunks of the stream file")
+    parser.add_argument("--stream-size-mb", type=float, help="Size of the stream file")
+    parser.add_argument("--no-mtz", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    files = write_dataset(
+        args.outdir, args.spacegroup, args.cell, args.dmin, args.stream_chunks,
+        args.stream_size_mb, not args.no_mtz, args.seed)
+    for name, path in files.items():
+        print(f"{name:>6}: {path} ({os.path.getsize(path) / 1e6:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import contextlib
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import import_serial.import_serial
+from import_serial.api import compute_statistics, InputError, SymmetryError
+from import_serial.import_serial import run
+from test_batch import write_hkl_set
+
+
+SYMMETRY = ("P21", (39.4, 78.5, 48.0, 90, 97.94, 90))
+
+
+def test_compute_statistics(tmp_path, capsys):
+    hklin = str(tmp_path / "data.hkl")
+    write_hkl_set(hklin)
+    write_hkl_set(hklin + "1")
+    write_hkl_set(hklin + "2", d_min=3.5)
+    result = compute_statistics(hklin, symmetry=SYMMETRY, d_min=3.2, n_bins=4)
+    assert capsys.readouterr() == ("", "")
+    assert "Overall values" in result.log
+    assert result.hklin_format == "crystfel"
+    assert len(result.binned["d_min"]) == 4
+    assert result.overall["cc"] == 1.0
+    # CC1/2 cumulative up to the high-resolution limit of each bin
+    cumulative = result.stats["cumulative"]
+    assert cumulative["d_min"] == result.binned["d_min"]
+    assert cumulative["cc"][0] == result.binned["cc"][0]
+    assert cumulative["cc"][-1] == result.overall["cc"]
+    arrays = result.miller_arrays()
+    assert arrays["IMEAN"].size() == result.overall["n_unique"]
+    assert arrays["IHALF1"].size() == arrays["IHALF2"].size() < arrays["IMEAN"].size()
+
+    # the same statistics as from the command line program
+    result.write(jsonout=str(tmp_path / "api.json"))
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            run(["--hklin", hklin, "--spacegroup", SYMMETRY[0], "--cell"]
+                + [str(p) for p in SYMMETRY[1]] + ["--wavelength", "1", "--dmin", "3.2", "--nbins", "4"])
+    finally:
+        os.chdir(cwd)
+    with open(tmp_path / "api.json") as f1, open(tmp_path / "project_dataset.json") as f2:
+        stats_api, stats_run = json.load(f1), json.load(f2)
+    # timing differs, the program has also the stage "output"
+    assert set(stats_api.pop("performance")["stages"]) == {"parse", "binning", "statistics"}
+    assert "output" in stats_run.pop("performance")["stages"]
+    assert stats_api == stats_run
+    with open(tmp_path / "program.xml") as f:
+        xml = f.read()
+    cumulative = xml[xml.index("<cumulative>"):xml.index("</cumulative>")]
+    assert cumulative.count("<bin>") == 4 and cumulative.count("<rsplit>") == 4
+    assert not os.path.exists(tmp_path / "api.mtz")
+    with pytest.raises(InputError):
+        result.write(hklout=str(tmp_path / "api.mtz"))  # wavelength required
+    result.write(hklout=str(tmp_path / "api.mtz"), wavelength=1.0)
+    assert os.path.isfile(tmp_path / "api.mtz")
+
+
+def test_compute_statistics_errors(tmp_path):
+    hklin = str(tmp_path / "data.hkl")
+    with pytest.raises(InputError):
+        compute_statistics(hklin, symmetry=SYMMETRY)
+    write_hkl_set(hklin)
+    with pytest.raises(SymmetryError):
+        compute_statistics(hklin)
+    with pytest.raises(SymmetryError):
+        compute_statistics(hklin, symmetry=("X 99", SYMMETRY[1]))
+    with pytest.raises(InputError):
+        compute_statistics(hklin, half_dataset=(hklin + "1", hklin + "2"), symmetry=SYMMETRY)
+
+
+def test_unreadable_input(tmp_path, monkeypatch):
+    hklin = str(tmp_path / "bad.hkl")
+    with open(hklin, "w") as f:
+        f.write("not a reflection list\n")
+    with pytest.raises(InputError, match="No reflections read from"):
+        compute_statistics(hklin, symmetry=SYMMETRY)
+    # the program aborts instead of writing outputs without reflections
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        stderr = io.StringIO()
+        with pytest.raises(SystemExit) as e:
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(stderr):
+                run(["--hklin", hklin, "--spacegroup", SYMMETRY[0], "--cell"]
+                    + [str(p) for p in SYMMETRY[1]] + ["--wavelength", "1"])
+    finally:
+        os.chdir(cwd)
+    assert e.value.code == 1
+    assert stderr.getvalue() == f"ERROR: No reflections read from {hklin}\nAborting.\n"
+    assert not os.path.exists(tmp_path / "project_dataset.mtz")
+
+    def failing_read(hklin, cache=None):
+        raise ValueError("broken line")
+    monkeypatch.setattr(import_serial.import_serial, "read_hkl_crystfel", failing_read)
+    with pytest.raises(InputError, match="broken line"):
+        compute_statistics(hklin, symmetry=SYMMETRY)
+
+
+def test_compute_statistics_threads(tmp_path, capsys):
+    hklin = str(tmp_path / "data.hkl")
+    write_hkl_set(hklin)
+    write_hkl_set(hklin + "1")
+    write_hkl_set(hklin + "2", d_min=3.5)
+    # the printed output of each call is in its own log, nothing is printed
+    expected = [compute_statistics(hklin, symmetry=SYMMETRY, n_bins=n_bins, sweep_shells=5).log
+                for n_bins in (2, 3, 4, 5)]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(
+            lambda n_bins: compute_statistics(hklin, symmetry=SYMMETRY, n_bins=n_bins,
+                                              sweep_shells=5), (2, 3, 4, 5)))
+    assert [result.log for result in results] == expected
+    assert capsys.readouterr() == ("", "")
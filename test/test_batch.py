@@ -0,0 +1,60 @@
+import json
+import os
+import pytest
+from cctbx import crystal, miller
+from import_serial.batch import read_manifest, manifest_row_argv, run_batch
+from import_serial.import_serial import get_parser
+from test_hkl import HKL_HEADER, HKL_FOOTER
+
+
+def write_hkl_set(path, d_min=3.0):
+    cs = crystal.symmetry(unit_cell=(39.4, 78.5, 48.0, 90, 97.94, 90), space_group_symbol="P21")
+    indices = miller.build_set(cs, anomalous_flag=False, d_min=d_min).indices()
+    lines = ["%4i %4i %4i %10.2f %s %10.2f %7i\n" % (h, k, l, 100 + (h * k + l) % 37, "       -", 5, 3)
+             for h, k, l in indices]
+    with open(path, "w") as f:
+        f.write(HKL_HEADER + "".join(lines) + HKL_FOOTER)
+
+
+def test_manifest_row_argv(tmp_path):
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text(
+        "name,hklin,half_dataset,cell,spacegroup,dmin,stream_index\n"
+        "a,a.hkl,a.hkl1 a.hkl2,39.4 78.5 48.0 90 97.94 90,P21,2.5,yes\n"
+        "b,/data/b.hkl,,,,,\n")
+    rows = read_manifest(str(manifest))
+    assert rows[1] == {"name": "b", "hklin": "/data/b.hkl"}
+    argv = manifest_row_argv(rows[0], get_parser(), "/data")
+    assert argv == [
+        "--hklin", "/data/a.hkl", "--half-dataset", "/data/a.hkl1", "/data/a.hkl2",
+        "--cell", "39.4", "78.5", "48.0", "90", "97.94", "90", "--spacegroup", "P21",
+        "--dmin", "2.5", "--stream-index"]
+    with pytest.raises(ValueError):
+        manifest_row_argv({"hklin": "a.hkl", "resolution": 2}, get_parser())
+
+
+@pytest.mark.parametrize("nproc", [1, 2])
+def test_run_batch(tmp_path, nproc):
+    write_hkl_set(tmp_path / "a.hkl")
+    write_hkl_set(tmp_path / "b.hkl", d_min=4.0)
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(json.dumps([
+        {"name": "a", "hklin": "a.hkl", "dmin": 3.5},
+        {"hklin": "b.hkl", "project": "p", "dataset": "b"},
+        {"name": "missing", "hklin": "missing.hkl", "spacegroup": "", "cell": None},
+    ]))
+    outdir = tmp_path / "out"
+    common = ["--spacegroup", "P21", "--cell", "39.4", "78.5", "48.0", "90", "97.94", "90",
+              "--wavelength", "1.0", "--nbins", "5"]
+    with pytest.raises(SystemExit) as e:  # one data set failed
+        run_batch([str(manifest), "--nproc", str(nproc), "--outdir", str(outdir)] + common)
+    assert e.value.code == 1
+    with open(outdir / "batch_summary.json") as f:
+        results = json.load(f)
+    assert [r["name"] for r in results] == ["a", "p_b", "missing"]
+    assert [r["status"] for r in results] == ["ok", "ok", "failed"]
+    assert results[0]["overall"]["d_min"] == 3.5
+    assert results[1]["overall"]["d_min"] == pytest.approx(4.0, abs=0.01)
+    assert os.path.isfile(outdir / "a" / "project_dataset.mtz")
+    assert os.path.isfile(outdir / "p_b" / "p_b.json")
+    assert "does not exist" in (outdir / "missing" / "import_serial.log").read_text()
@@ -0,0 +1,121 @@
+import io
+import os
+import numpy as np
+import pytest
+from import_serial.atomic import atomic_output
+from import_serial.cache import Cache, FINGERPRINT_MEMO_SIZE, _content_hash, file_fingerprint
+from cctbx import crystal
+from import_serial.import_serial import REFERENCE_MEMO_SIZE, _read_cs_reference, get_cs_reference, \
+    load_reflection_table, read_hkl_crystfel
+from test_hkl import write_hkl, check_columns
+
+
+def test_cache_hkl(tmp_path):
+    hklin = write_hkl(tmp_path / "data.hkl")
+    cache = Cache(str(tmp_path / "cache"))
+    check_columns(read_hkl_crystfel(hklin, cache))
+    assert (cache.hits, cache.misses) == (0, 1)
+    check_columns(read_hkl_crystfel(hklin, cache))
+    assert (cache.hits, cache.misses) == (1, 1)
+    # same content in another file
+    copy = tmp_path / "copy.hkl"
+    copy.write_bytes(open(hklin, "rb").read())
+    assert file_fingerprint(str(copy)) == file_fingerprint(hklin)
+    check_columns(read_hkl_crystfel(str(copy), cache))
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_cache_asu(tmp_path):
+    hklin = write_hkl(tmp_path / "data.hkl")
+    cache = Cache(str(tmp_path / "cache"))
+    cs = crystal.symmetry(unit_cell=(39.4, 78.5, 48.0, 90, 97.94, 90), space_group_symbol="P21")
+    expected, _ = load_reflection_table(hklin, "crystfel", cs, d_min=3.0)
+    table, _ = load_reflection_table(hklin, "crystfel", cs, d_min=3.0, cache=cache)
+    # parsed columns and their mapping to the asymmetric unit
+    assert (cache.hits, cache.misses) == (0, 2)
+    table_cut, _ = load_reflection_table(hklin, "crystfel", cs, d_min=6.0, cache=cache)
+    assert (cache.hits, cache.misses) == (2, 2)
+    for name in ("asu_hkl", "hkl", "I", "nmeas", "bin"):
+        assert np.array_equal(getattr(table, name), getattr(expected, name))
+    assert np.array_equal(table_cut.asu_hkl, expected.asu_hkl[expected.d >= 6.0])
+    cs_p1 = crystal.symmetry(unit_cell=cs.unit_cell(), space_group_symbol="P1")
+    load_reflection_table(hklin, "crystfel", cs_p1, cache=cache)
+    assert (cache.hits, cache.misses) == (3, 3)
+
+
+def test_file_fingerprint(tmp_path):
+    path = tmp_path / "data.txt"
+    path.write_bytes(b"abc")
+    fingerprint = file_fingerprint(str(path))
+    path.write_bytes(b"abcd")
+    assert file_fingerprint(str(path)) != fingerprint
+    # the memo is bounded
+    for i in range(FINGERPRINT_MEMO_SIZE + 10):
+        other = tmp_path / f"{i}.txt"
+        other.write_bytes(b"abc")
+        assert file_fingerprint(str(other)) == fingerprint
+    assert _content_hash.cache_info().currsize == FINGERPRINT_MEMO_SIZE
+
+
+
+def test_get_cs_reference(tmp_path):
+    reference = tmp_path / "ref.pdb"
+    atom = "ATOM      1  CA  GLY A   1       1.000   2.000   3.000  1.00 10.00           C\n"
+    reference.write_text("CRYST1   39.400   78.500   48.000  90.00  97.94  90.00 P 1 21 1\n" + atom)
+    log = io.StringIO()
+    cs, spacegroup, cell = get_cs_reference(str(reference), log)
+    assert str(spacegroup) == "P 1 21 1" and cell == "39.4 78.5 48.0 90.0 97.94 90.0"
+    assert "Symmetry from the reference file" in log.getvalue()
+    assert get_cs_reference(str(reference), io.StringIO())[0] is cs
+    # a changed reference file is read again
+    reference.write_text("CRYST1   40.000   78.500   48.000  90.00  97.94  90.00 P 1 21 1\n" + atom)
+    assert get_cs_reference(str(reference), io.StringIO())[2].startswith("40.0 ")
+    assert _read_cs_reference.cache_info().currsize <= REFERENCE_MEMO_SIZE
+
+def test_cache_call(tmp_path, capsys):
+    cache = Cache(str(tmp_path / "cache"))
+    calls = []
+
+    def function(x, log=None):
+        calls.append(x)
+        print(f"x = {x}", file=log)
+        return {"x": [x, 2 * x]}
+
+    for i in range(2):
+        assert cache.call(cache.key("function", 1.5), function, 1.5) == {"x": [1.5, 3.0]}
+        assert capsys.readouterr().out == "x = 1.5\n"
+    assert calls == [1.5]
+    log = io.StringIO()
+    assert cache.call(cache.key("function", 1.5), function, 1.5, log=log) == {"x": [1.5, 3.0]}
+    assert log.getvalue() == "x = 1.5\n" and capsys.readouterr().out == ""
+
+
+def test_cache_evict(tmp_path):
+    cache = Cache(str(tmp_path / "cache"), max_size_mb=1)
+    data = {"a": np.zeros(50000)}  # 400 kB
+    keys = [cache.key(i) for i in range(3)]
+    cache.put_arrays(keys[0], data)
+    cache.put_arrays(keys[1], data)
+    os.utime(cache._path(keys[0], ".npz"), ns=(0, 0))
+    os.utime(cache._path(keys[1], ".npz"), ns=(10**9, 10**9))
+    cache.get_arrays(keys[0])  # the first entry is used again
+    cache.put_arrays(keys[2], data)
+    assert cache.get_arrays(keys[0]) is not None
+    assert cache.get_arrays(keys[1]) is None
+    assert cache.get_arrays(keys[2]) is not None
+
+
+def test_atomic_output(tmp_path):
+    path = tmp_path / "out.txt"
+    path.write_text("old")
+    with pytest.raises(RuntimeError):
+        with atomic_output(str(path)) as tmp:
+            with open(tmp, "w") as f:
+                f.write("partial")
+            raise RuntimeError
+    assert path.read_text() == "old"
+    with atomic_output(str(path)) as tmp:
+        with open(tmp, "w") as f:
+            f.write("new")
+    assert path.read_text() == "new"
+    assert [p.name for p in tmp_path.iterdir()] == ["out.txt"]
@@ -0,0 +1,93 @@
+import contextlib
+import io
+import json
+import os
+import numpy as np
+import pytest
+from import_serial.cells import CellTable, robust_cell, cluster_cells, cell_histograms, \
+    cell_distribution, median_abs_deviation
+from import_serial.import_serial import run
+from import_serial.stream import summarize_stream
+from synthetic import write_dataset
+from test_stream import stream_text, CELLS
+
+
+CELL = np.array([39.4, 78.5, 48.0, 90, 97.94, 90])
+
+
+def cells_with_outliers(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    cells = CELL * (1 + rng.normal(0, 0.001, (n, 6)))
+    cells[:100, 0] *= 2  # mis-indexed lattice
+    cells[100:140] *= rng.uniform(0.5, 1.5, (40, 6))  # outliers
+    return cells
+
+
+def test_robust_cell():
+    cells = cells_with_outliers()
+    mean = robust_cell(cells, "mean")
+    assert mean[0] > CELL[0] * 1.04
+    for estimate in ("median", "trimmed", "cluster"):
+        assert robust_cell(cells, estimate) == pytest.approx(CELL, rel=0.003)
+    labels = cluster_cells(cells)
+    assert np.count_nonzero(labels == 0) > 1800
+    assert np.all(labels[:100] == 1)
+    assert np.all(labels[100:140] == -1)
+    assert median_abs_deviation(cells[labels == 0]) == pytest.approx(CELL * 0.001, rel=0.1)
+    assert robust_cell(cells[:0], "median") is None
+
+    histograms = cell_histograms(cells, n_bins=20)
+    edges, counts = histograms["a"]
+    assert len(edges) == 21 and len(counts) == 20
+    assert counts.sum() == np.count_nonzero((cells[:, 0] >= edges[0]) & (cells[:, 0] <= edges[-1]))
+    assert counts.sum() >= 0.99 * len(cells)
+    assert np.array_equal(counts, np.histogram(cells[:, 0], edges)[0])
+
+    distribution = cell_distribution(cells, labels)
+    assert distribution["n_crystals"] == 2000
+    assert [c["n_crystals"] for c in distribution["clusters"]] == [
+        np.count_nonzero(labels == 0), 100]
+    assert distribution["n_outliers"] == 40
+    assert distribution["clusters"][1]["median"]["a"] == pytest.approx(2 * CELL[0], rel=0.003)
+
+
+def test_cell_table(tmp_path):
+    streamfile = str(tmp_path / "test.stream")
+    with open(streamfile, "w") as f:
+        f.write(stream_text())
+    summary = summarize_stream(streamfile)
+    assert summary.crystals is None
+    summary = summarize_stream(streamfile, crystals=True)
+    table = summary.crystals
+    assert len(table) == len(CELLS)
+    assert table.cells == pytest.approx(np.array(CELLS) * [10, 10, 10, 1, 1, 1])
+    assert table.image(2) == ("/data/run.h5", "//2")
+
+    path = str(tmp_path / "cells.npz")
+    table.save(path, table.cluster())
+    loaded = CellTable.load(path)
+    assert loaded.cells == pytest.approx(table.cells, rel=1e-6)
+    assert loaded.image(1) == ("/data/run.h5", "//1")
+    with np.load(path) as arrays:
+        assert arrays["cluster"].tolist() == [0, 0, 0]
+        assert arrays["beta_edges"].shape == (101,) and arrays["beta_counts"].shape == (100,)
+
+
+def test_run_cell_estimate(tmp_path):
+    files = write_dataset(str(tmp_path), "P21", tuple(CELL), d_min=3.0, stream_chunks=50, mtz=False)
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            run(["--hklin", files["hkl"], "--spacegroup", "P21", "--streamfile", files["stream"],
+                 "--cell-estimate", "median", "--cell-table", "cells.npz"])
+    finally:
+        os.chdir(cwd)
+    table = summarize_stream(files["stream"], crystals=True).crystals
+    median = [round(p, 2) for p in np.median(table.cells, axis=0)]
+    assert " ".join(map(str, median)) in stdout.getvalue()
+    with open(tmp_path / "project_dataset.json") as f:
+        unit_cell = json.load(f)["unit_cell"]
+    assert unit_cell["n_crystals"] == len(table)
+    assert sum(c["n_crystals"] for c in unit_cell["clusters"]) + unit_cell["n_outliers"] == len(table)
+    assert CellTable.load(str(tmp_path / "cells.npz")).cells == pytest.approx(table.cells, rel=1e-6)
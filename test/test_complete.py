@@ -6,6 +6,29 @@ import shutil
 import urllib.request  # Python 3
 from helper import run, tmp_environ
 from import_serial import __version__
+from cctbx import crystal, miller
+from cctbx.array_family import flex
+
+
+def expected_binned_nmeas(hklin, d_min=1.65, n_bins=10):
+    """#obs and multiplicity in the resolution bins, summed from the
+    multiplicities of the reflections in each bin of a CrystFEL .hkl file
+    (in space group P21 with the cell of the test data)."""
+    with open(hklin) as f:
+        lines = f.read().split("End of reflections")[0].splitlines()
+    first = next(i for i, line in enumerate(lines) if line.split()[:3] == ["h", "k", "l"]) + 1
+    h, k, l, nmeas = zip(*((int(x[0]), int(x[1]), int(x[2]), float(x[6]))
+                           for x in (line.split() for line in lines[first:]) if x))
+    cs = crystal.symmetry(unit_cell=(39.4, 78.5, 48.0, 90, 97.94, 90), space_group_symbol="P21")
+    indices = flex.miller_index(flex.int(h), flex.int(k), flex.int(l))
+    m_nmeas = miller.array(miller.set(cs, indices), data=flex.double(nmeas))
+    m_nmeas = m_nmeas.resolution_filter(d_min=d_min).map_to_asu()
+    m_nmeas.setup_binner(n_bins=n_bins)
+    rows = []
+    for i_bin in m_nmeas.binner().range_used():
+        data = m_nmeas.select(m_nmeas.binner().selection(i_bin)).data()
+        rows.append((sum(data.iround()), flex.mean(data)))
+    return rows
 
 
 @pytest.mark.parametrize(
@@ -206,9 +229,22 @@ Binned values:
     stdout_all = cp.stdout.splitlines(True)
     # print("".join(stdout_all))  # for debugging
     expected_stdout_list = expected_stdout.splitlines(keepends=True)
+    binned = False
+    nmeas_rows = None
+    if "116720-721.lst-asdf-scale" in project:
+        nmeas_rows = expected_binned_nmeas(hklin)
+        assert sum(n_obs for n_obs, _ in nmeas_rows) == 2663073
+        nmeas_rows = iter(nmeas_rows)
     for i, line in enumerate(expected_stdout_list):
         # print(i)            # for debugging
-        assert expected_stdout_list[i] == stdout_all[i]
+        if nmeas_rows is not None and binned and line.strip():
+            # the expected #obs and mult. were computed with multiplicities
+            # matched to the bins by their position in the reflection list,
+            # they are replaced by the values matched by Miller indices
+            n_obs, multiplicity = next(nmeas_rows)
+            line = line[:16] + f"{n_obs:>9d}" + line[25:33] + f"{multiplicity:>8.2f}" + line[41:]
+        binned = line.startswith("   d_max") or (binned and bool(line.strip()))
+        assert line == stdout_all[i]
     # assert expected_stdout in "".join(stdout_all)
     if project == "dials-xia2-ssx":
         for halfline in expected_stdout_list:
@@ -0,0 +1,126 @@
+import contextlib
+import io
+import json
+import os
+import numpy as np
+import pytest
+from import_serial.crystal_stats import CrystalStatsTable, crystal_stats_part, \
+    parse_reflection_rows
+from import_serial.import_serial import run
+from import_serial.stream import build_stream_index, open_stream
+from synthetic import write_dataset
+
+
+CELL = (39.4, 78.5, 48.0, 90, 97.94, 90)
+
+
+ROW = "%4i %4i %4i %10.2f %10.2f %10.2f %10.2f %6.1f %6.1f p0\n"
+
+
+def crystal_text(rows, resolution=5.0, profile_radius=0.00274):
+    text = "--- Begin crystal\n"
+    text += "Cell parameters 3.94 7.85 4.80 nm, 90.00 97.94 90.00 deg\n"
+    if profile_radius is not None:
+        text += f"profile_radius = {profile_radius:.5f} nm^-1\n"
+    if resolution is not None:
+        text += f"diffraction_resolution_limit = {resolution:.2f} nm^-1 or {10 / resolution:.2f} A\n"
+    if rows is not None:
+        text += f"num_reflections = {len(rows)}\n"
+        text += "Reflections measured after indexing\n"
+        text += "   h    k    l          I   sigma(I)       peak background  fs/px  ss/px panel\n"
+        for h, k, l, i, sigma in rows:
+            text += ROW % (h, k, l, i, sigma, i + 50, 30, 100, 200)
+        text += "End of reflections\n"
+    return text + "--- End crystal\n"
+
+
+def write_stream(path, crystals):
+    text = "CrystFEL stream format 2.3\n"
+    for i, crystal in enumerate(crystals):
+        text += f"----- Begin chunk -----\nImage filename: /data/run.h5\nEvent: //{i}\n"
+        text += "photon_energy_eV = 9500.0\n" + crystal + "----- End chunk -----\n"
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def test_crystal_stats(tmp_path):
+    rows = [(1, 2, 3, 100.0, 10.0), (-4, 5, -6, -25.5, 5.1), (7, 8, 9, 1234567890.5, 2.0),
+            (1, 1, 1, 5.0, 0.0)]
+    streamfile = str(tmp_path / "test.stream")
+    write_stream(streamfile, [
+        crystal_text(rows),
+        crystal_text(rows[:1], resolution=4.0, profile_radius=None),
+        crystal_text(None, resolution=None),
+        crystal_text([]),
+    ])
+    index = build_stream_index(streamfile)
+    table = CrystalStatsTable.from_index(index)
+    i_over_sigma = np.mean([100 / 10, -25.5 / 5.1, 1234567890.5 / 2])
+    expected = np.array([
+        [4, 2.0, i_over_sigma, 0.00274],
+        [1, 2.5, 10.0, np.nan],
+        [np.nan, np.nan, np.nan, 0.00274],
+        [0, 2.0, np.nan, 0.00274],
+    ])
+    assert table.stats == pytest.approx(expected, nan_ok=True)
+    assert table.image(1) == ("/data/run.h5", "//1")
+    # the same in small windows and in a pool of processes
+    mm = open_stream(streamfile)
+    try:
+        for window in (1, 10):
+            parts = [crystal_stats_part(mm, index.crystals["begin"][i:i + window],
+                                        index.crystals["end"][i:i + window])
+                     for i in range(0, len(index.crystals["begin"]), window)]
+            assert np.concatenate(parts) == pytest.approx(expected, nan_ok=True)
+    finally:
+        mm.close()
+    assert CrystalStatsTable.from_index(index, nproc=2).stats == pytest.approx(expected, nan_ok=True)
+
+    summary = table.summary()
+    assert summary["n_crystals"] == 4
+    assert summary["n_reflections_total"] == 5
+    assert summary["n_reflections"] == {"mean": 1.67, "median": 1.0, "min": 0.0, "max": 4.0}
+    path = str(tmp_path / "crystals.npz")
+    table.save(path)
+    loaded = CrystalStatsTable.load(path)
+    assert loaded.stats == pytest.approx(expected, nan_ok=True, rel=1e-6)
+    with np.load(path) as arrays:
+        assert arrays["n_reflections_edges"][0] <= 1 and arrays["n_reflections_edges"][-1] >= 1
+        assert arrays["n_reflections_counts"].sum() >= 1
+
+
+def test_parse_reflection_rows():
+    rows = [(1, 2, 3, 100.0, 10.0), (-4, 5, -6, -25.5, 5.1), (7, 8, 9, 99999.99, 0.01),
+            (0, 0, 1, -0.01, 123.45)]
+    text = "".join(ROW % (h, k, l, i, sigma, 0, 0, 0, 0) for h, k, l, i, sigma in rows)
+    text += "   1    1    1 not_a_number  10.0 0 0 0 0 p0\n"
+    buf = np.frombuffer(text.encode(), dtype=np.uint8)
+    ends = np.flatnonzero(buf == ord("\n"))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    columns = parse_reflection_rows(buf, starts, ends)
+    intensity, sigma = columns["I"], columns["sigma(I)"]
+    assert intensity[:4].tolist() == [row[3] for row in rows]
+    assert sigma[:4].tolist() == [row[4] for row in rows]
+    assert np.isnan(intensity[4]) and np.isnan(sigma[4])
+    columns = parse_reflection_rows(buf, starts, ends, ("h", "k", "l", "I"))
+    assert sorted(columns) == ["I", "h", "k", "l"]
+    assert columns["l"][:4].tolist() == [row[2] for row in rows]
+    assert columns["I"][:4].tolist() == [row[3] for row in rows] and np.isnan(columns["h"][4])
+
+
+def test_run_crystal_stats(tmp_path):
+    files = write_dataset(str(tmp_path), "P21", CELL, d_min=3.0, stream_chunks=50, mtz=False)
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            run(["--hklin", files["hkl"], "--spacegroup", "P21", "--cell"] + [str(p) for p in CELL]
+                + ["--streamfile", files["stream"], "--crystal-stats", "crystals.npz"])
+    finally:
+        os.chdir(cwd)
+    table = CrystalStatsTable.load(str(tmp_path / "crystals.npz"))
+    with open(tmp_path / "project_dataset.json") as f:
+        summary = json.load(f)["crystal_stats"]
+    assert summary["n_crystals"] == len(table) > 0
+    assert summary["n_reflections_total"] == table.column("n_reflections").sum()
+    assert summary["resolution"]["median"] == 2.0
@@ -0,0 +1,51 @@
+import pytest
+import numpy as np
+from import_serial.import_serial import hkl_strip, parse_hkl_fixed_width, read_hkl_crystfel
+
+
+HKL_HEADER = """CrystFEL reflection list version 2.0
+Symmetry: 2/m_uab
+   h    k    l          I    phase   sigma(I)   nmeas
+"""
+HKL_FOOTER = """End of reflections
+Generated by CrystFEL 0.10.2
+"""
+HKL_REFLECTIONS = [
+    (-21, 0, 1, -14.63, 17.51, 11),
+    (0, 2, -28, 771.78, 6.18, 13),
+    (3, -45, 7, 1234567.01, 1200.5, 1024),
+    (0, 0, 1, -0.05, 0.01, 1),
+]
+
+
+def write_hkl(path, line_format="%4i %4i %4i %10.2f %s %10.2f %7i\n", newline="\n"):
+    lines = [line_format % (h, k, l, i, "       -", s, n)
+             for h, k, l, i, s, n in HKL_REFLECTIONS]
+    text = HKL_HEADER + "".join(lines) + HKL_FOOTER
+    with open(path, "w", newline="") as f:
+        f.write(text.replace("\n", newline))
+    return str(path)
+
+
+def check_columns(columns):
+    expected = np.array(HKL_REFLECTIONS)
+    for i, name in enumerate(("h", "k", "l", "I", "sigma(I)", "nmeas")):
+        assert np.array_equal(columns[name], expected[:, i])
+    assert columns["h"].dtype == np.int32
+    assert columns["I"].dtype == np.float64
+    assert columns["nmeas"].dtype == np.int32
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_read_hkl_fixed_width(tmp_path, newline):
+    hklin = write_hkl(tmp_path / "data.hkl", newline=newline)
+    assert bytes(hkl_strip(hklin)).startswith(b" -21    0    1")
+    assert parse_hkl_fixed_width(hkl_strip(hklin)) is not None
+    check_columns(read_hkl_crystfel(hklin))
+    assert [p.name for p in tmp_path.iterdir()] == ["data.hkl"]
+
+
+def test_read_hkl_whitespace(tmp_path):
+    hklin = write_hkl(tmp_path / "data.hkl", line_format="%i %i %i %.2f %s %.2f %i\n")
+    assert parse_hkl_fixed_width(hkl_strip(hklin)) is None
+    check_columns(read_hkl_crystfel(hklin))
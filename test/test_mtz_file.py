@@ -0,0 +1,73 @@
+import numpy as np
+from cctbx import crystal, miller
+from cctbx.array_family import flex
+from iotbx import mtz
+from import_serial.mtz_file import MtzFile
+from import_serial.mtz_format import is_mtz_file
+from import_serial.import_serial import read_mtz_dials
+
+
+def write_mtz(path):
+    """MTZ file as from xia2.ssx with an additional anomalous column group
+    and missing values."""
+    cs = crystal.symmetry(unit_cell=(39.4, 78.5, 48.0, 90, 97.94, 90), space_group_symbol="P21")
+    complete = miller.build_set(cs, anomalous_flag=False, d_min=3.0)
+    rng = np.random.default_rng(1)
+    n = complete.size()
+
+    def intensities(miller_set, sel=None):
+        sel = np.ones(miller_set.size(), bool) if sel is None else sel
+        m = miller.array(miller_set, flex.double(rng.exponential(100, miller_set.size())),
+                         flex.double(rng.exponential(5, miller_set.size()) + 1))
+        return m.select(flex.bool(sel)).set_observation_type_xray_intensity()
+
+    dataset = intensities(complete, rng.random(n) > 0.05).as_mtz_dataset(
+        column_root_label="IMEAN", wavelength=0.98)
+    dataset.add_miller_array(intensities(complete, rng.random(n) > 0.1), column_root_label="IHALF1")
+    dataset.add_miller_array(intensities(complete), column_root_label="IHALF2")
+    anomalous = complete.customized_copy(anomalous_flag=True).complete_set()
+    dataset.add_miller_array(intensities(anomalous), column_root_label="I")
+    nmeas = miller.array(complete, flex.double(rng.integers(1, 30, n).astype(float)))
+    dataset.add_miller_array(nmeas.select(flex.bool(rng.random(n) > 0.05)),
+                             column_root_label="N", column_types="R")
+    dataset.mtz_object().write(str(path))
+    return str(path)
+
+
+def test_mtz_file(tmp_path):
+    hklin = write_mtz(tmp_path / "data.mtz")
+    assert is_mtz_file(hklin)
+    reference = mtz.object(hklin)
+    with MtzFile(hklin) as mtz_file:
+        assert mtz_file.labels == reference.column_labels()
+        assert mtz_file.n_reflections == reference.n_reflections()
+        assert mtz_file.dataset("IMEAN")["wavelength"] == reference.crystals()[1].datasets()[0].wavelength()
+        cs = mtz_file.crystal_symmetry("IMEAN")
+        assert cs.unit_cell().parameters() == reference.crystals()[1].unit_cell().parameters()
+        assert cs.space_group() == reference.space_group()
+        assert np.array_equal(mtz_file.miller_indices(), np.array(reference.extract_miller_indices()))
+        for column in reference.columns():
+            values = column.extract_values_and_selection_valid(-1)
+            valid = values.selection_valid.as_numpy_array()
+            assert np.array_equal(np.isnan(mtz_file.column(column.label())), ~valid)
+            assert np.array_equal(mtz_file.column(column.label())[valid],
+                                  values.values.as_numpy_array()[valid])
+
+
+def test_read_mtz_dials(tmp_path):
+    hklin = write_mtz(tmp_path / "data.mtz")
+    merged, half1, half2, cs, anomalous_flag = read_mtz_dials(hklin)
+    # the same as from the Miller arrays
+    arrays = {tuple(m.info().labels): m for m in mtz.object(hklin).as_miller_arrays()}
+    m_i, m_nmeas = arrays[("IMEAN", "SIGIMEAN")].common_sets(arrays[("N",)])
+    assert anomalous_flag == m_i.anomalous_flag()
+    assert cs.is_similar_symmetry(m_i.crystal_symmetry())
+    assert np.array_equal(np.column_stack((merged["h"], merged["k"], merged["l"])),
+                          np.array(m_i.indices()))
+    assert np.array_equal(merged["I"], m_i.data().as_numpy_array())
+    assert np.array_equal(merged["sigma(I)"], m_i.sigmas().as_numpy_array())
+    assert np.array_equal(merged["nmeas"], m_nmeas.data().as_numpy_array())
+    for half, labels in ((half1, ("IHALF1", "SIGIHALF1")), (half2, ("IHALF2", "SIGIHALF2"))):
+        m = arrays[labels]
+        assert np.array_equal(half["I"], m.data().as_numpy_array())
+        assert np.array_equal(half["h"], np.array(m.indices())[:, 0])
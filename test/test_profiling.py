@@ -0,0 +1,53 @@
+import contextlib
+import io
+import json
+import os
+import pstats
+import time
+from import_serial.import_serial import run
+from import_serial.profiling import Profiler
+from test_batch import write_hkl_set
+
+
+def test_profiler_stages():
+    profiler = Profiler()
+    for n in (10, 20):
+        with profiler.stage("parse", n_reflections=n):
+            time.sleep(0.01)
+    with profiler.stage("binning") as sizes:
+        sizes["n_reflections"] = 30
+    performance = profiler.as_dict()
+    assert performance["mode"] == "light"
+    assert list(performance["stages"]) == ["parse", "binning"]
+    assert performance["stages"]["parse"]["n_reflections"] == 30
+    assert performance["stages"]["parse"]["wall_s"] >= 0.02
+    assert performance["stages"]["binning"]["n_reflections"] == 30
+    assert performance["total"]["wall_s"] >= performance["stages"]["parse"]["wall_s"]
+    assert performance["total"]["peak_rss_mb"] > 0
+
+
+def test_run_profile(tmp_path):
+    hklin = str(tmp_path / "data.hkl")
+    write_hkl_set(hklin)
+    write_hkl_set(hklin + "1")
+    write_hkl_set(hklin + "2")
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            run(["--hklin", hklin, "--spacegroup", "P21", "--cell", "39.4", "78.5", "48.0", "90",
+                 "97.94", "90", "--wavelength", "1", "--profile-dir", "profile"])
+    finally:
+        os.chdir(cwd)
+    assert "Performance:" in out.getvalue()
+    with open(tmp_path / "project_dataset.json") as f:
+        performance = json.load(f)["performance"]
+    assert performance["mode"] == "profile"
+    stages = performance["stages"]
+    assert list(stages) == ["parse", "binning", "statistics", "output"]
+    assert stages["parse"]["input_bytes"] == 3 * os.path.getsize(hklin)
+    assert stages["output"]["output_bytes"] == os.path.getsize(tmp_path / "project_dataset.mtz")
+    for stage in stages:
+        assert pstats.Stats(str(tmp_path / "profile" / f"{stage}.prof")).total_calls > 0
+    with open(tmp_path / "program.xml") as f:
+        assert "<name>binning</name>" in f.read()
@@ -0,0 +1,169 @@
+import contextlib
+import io
+import numpy as np
+from cctbx import crystal, miller
+from cctbx.array_family import flex
+import pytest
+from import_serial import reflections
+from import_serial.reflections import build_reflection_table, miller_array_columns, \
+    join_keys, lookup_keys, sort_keys
+from import_serial.import_serial import calc_stats_merged, calc_stats_compare, calc_stats_sweep, \
+    calc_rsplit
+
+
+def make_data():
+    cs = crystal.symmetry(unit_cell=(39.4, 78.5, 48.0, 90, 97.94, 90), space_group_symbol="P21")
+    complete = miller.build_set(cs, anomalous_flag=False, d_min=4.0)
+    rng = np.random.default_rng(0)
+    n = complete.size()
+    I = rng.exponential(100, n)
+
+    def columns(rows, sign=1, noise=0):
+        m = miller.array(
+            complete.select(flex.size_t(rows.astype(np.uint64))),
+            flex.double(I[rows] + rng.normal(0, noise, rows.size)),
+            flex.double(np.full(rows.size, 5.0)))
+        result = miller_array_columns(m)
+        for name in "hkl":
+            result[name] = result[name] * sign
+        return result
+
+    merged = columns(rng.permutation(n)[:n - 20])
+    merged["nmeas"] = rng.integers(1, 50, n - 20)
+    half1 = columns(rng.permutation(n)[:n - 10], noise=5)  # some not in merged
+    half2 = columns(rng.permutation(n)[:n - 30], sign=-1, noise=5)  # Friedel mates
+    return cs, merged, half1, half2
+
+
+def test_reflection_table():
+    cs, merged, half1, half2 = make_data()
+    table = build_reflection_table(cs, merged, half1, half2, d_min=4.5, n_bins=5)
+    keys = table.asu_hkl.astype(np.int64) @ np.array([1 << 40, 1 << 20, 1])
+    assert (np.diff(keys) > 0).all()
+    assert table.n_bins == 5
+    assert set(np.unique(table.bin[table.has_I])) == {1, 2, 3, 4, 5}
+
+    # merged data set in the original order
+    m_i, m_nmeas = table.input_order_arrays()
+    assert m_i.size() == np.count_nonzero(table.has_I)
+    original = np.column_stack((merged["h"], merged["k"], merged["l"]))
+    original_sel = miller.set(cs, flex.miller_index(original.tolist())) \
+        .resolution_filter_selection(d_min=4.5).as_numpy_array()
+    assert np.array_equal(np.array(m_i.indices()), original[original_sel])
+    assert np.array_equal(m_i.data().as_numpy_array(), merged["I"][original_sel])
+    assert np.array_equal(m_nmeas.data().as_numpy_array(), merged["nmeas"][original_sel])
+
+    # half-data sets aligned as with common_sets()
+    def half_array(columns):
+        indices = flex.miller_index(
+            np.column_stack((columns["h"], columns["k"], columns["l"])).tolist())
+        m = miller.array(miller.set(cs, indices), flex.double(columns["I"]))
+        return m.resolution_filter(d_min=4.5).map_to_asu().sort("packed_indices")
+    m1, m2 = half_array(half1).common_sets(half_array(half2), assert_no_singles=False)
+    both = table.has_half1 & table.has_half2
+    assert np.array_equal(table.I_half1[both], m1.data().as_numpy_array())
+    assert np.array_equal(table.I_half2[both], m2.data().as_numpy_array())
+    assert np.isnan(table.I[~table.has_I]).all()
+    assert (table.has_half1 | table.has_half2 | table.has_I).all()
+
+
+def test_calc_stats_merged_binned():
+    cs, merged, half1, half2 = make_data()
+    table = build_reflection_table(cs, merged, n_bins=7)
+    with contextlib.redirect_stdout(io.StringIO()):
+        stats = calc_stats_merged(table)
+    # reference: selection of each bin from Miller arrays
+    m = table.miller_array("I", "sigI")
+    m.setup_binner(n_bins=7)
+    for key, values in stats["binned"].items():
+        assert len(values) == 7, key
+    for i, i_bin in enumerate(m.binner().range_used()):
+        m_sel = m.select(m.binner().selection(i_bin))
+        d_max, d_min = m_sel.d_max_min()
+        completeness = m_sel.as_non_anomalous_set().completeness(d_max=d_max)
+        assert stats["binned"]["d_max"][i] == round(d_max, 3)
+        assert stats["binned"]["d_min"][i] == round(d_min, 3)
+        assert stats["binned"]["n_unique"][i] == m_sel.size()
+        assert stats["binned"]["completeness"][i] == round(completeness * 100, 2)
+        assert stats["binned"]["I"][i] == round(m_sel.mean(), 2)
+        assert stats["binned"]["IsigI"][i] == round(m_sel.i_over_sig_i(), 2)
+    assert stats["overall"]["n_obs"] == int(merged["nmeas"].sum())
+    # multiplicities matched to the bins by Miller indices
+    m_nmeas = table.miller_array("nmeas", selection=table.has_I)
+    m_nmeas.use_binning_of(m)
+    for i, i_bin in enumerate(m.binner().range_used()):
+        nmeas = m_nmeas.select(m.binner().selection(i_bin)).data()
+        assert stats["binned"]["n_obs"][i] == int(flex.sum(nmeas))
+        assert stats["binned"]["multiplicity"][i] == round(flex.mean(nmeas), 2)
+    assert stats["overall"]["completeness"] == round(m.as_non_anomalous_set().completeness() * 100, 2)
+
+
+@pytest.mark.parametrize("direct", [True, False])
+def test_join_keys(monkeypatch, direct):
+    # linear-time joins with a table addressed by keys and with sorting
+    monkeypatch.setattr(reflections, "_direct", lambda n_keys, n_rows: direct)
+    rng = np.random.default_rng(2)
+    n_keys = 1000
+    sets = [rng.permutation(n_keys)[:n] for n in (600, 500, 0, 700)]
+    union, rows, present = join_keys(sets, n_keys)
+    assert np.array_equal(union, np.unique(np.concatenate(sets)))
+    for keys, set_rows, mask in zip(sets, rows, present):
+        assert np.array_equal(union[set_rows], keys)
+        assert np.count_nonzero(mask) == keys.size
+    keys = np.array([5, 3, 9, 3, 7])
+    assert lookup_keys(keys, np.array([3, 7, 4, 5, 11]), 20).tolist() == [1, 4, -1, 0, -1]
+    assert lookup_keys(keys[:0], np.array([3]), 20).tolist() == [-1]
+    assert np.array_equal(sort_keys(sets[0], n_keys), np.argsort(sets[0], kind="stable"))
+    assert np.array_equal(sort_keys(keys, 20), np.argsort(keys, kind="stable"))
+
+
+def test_unmatched():
+    cs, merged, half1, half2 = make_data()
+    table = build_reflection_table(cs, merged, half1, half2)
+    unmatched = table.unmatched()
+    all_sets = table.has_I & table.has_half1 & table.has_half2
+    assert sum(len(indices) for indices in unmatched.values()) == \
+        np.count_nonzero(table.has_I & ~all_sets) + np.count_nonzero(table.has_half1 & ~all_sets) \
+        + np.count_nonzero(table.has_half2 & ~all_sets)
+    # half1 has 10 reflections more than merged (20 missing), half2 has 30 missing
+    assert len(unmatched["half1"]) >= 10
+    assert build_reflection_table(cs, merged).unmatched() == {}
+
+
+def test_calc_stats_compare():
+    cs, merged, half1, half2 = make_data()
+    table = build_reflection_table(cs, merged, half1, half2, n_bins=6)
+    with contextlib.redirect_stdout(io.StringIO()):
+        stats = calc_stats_compare(table)
+    both = table.has_half1 & table.has_half2
+    for i_bin in range(1, 7):
+        sel = both & (table.bin == i_bin)
+        I1 = flex.double(table.I_half1[sel])
+        I2 = flex.double(table.I_half2[sel])
+        cc = flex.linear_correlation(I1, I2).coefficient()
+        assert abs(stats["binned"]["cc"][i_bin - 1] - round(cc, 3)) <= 0.001
+        assert stats["binned"]["rsplit"][i_bin - 1] == round(calc_rsplit(I1, I2), 3)
+    # cumulative values up to the last bin include all bins
+    sel = both & (table.bin >= 1) & (table.bin <= 6)
+    cc = flex.linear_correlation(
+        flex.double(table.I_half1[sel]), flex.double(table.I_half2[sel])).coefficient()
+    assert len(stats["cumulative"]["cc"]) == 6
+    assert abs(stats["cumulative"]["cc"][-1] - round(cc, 3)) <= 0.001
+    assert stats["cumulative"]["cc"][0] == stats["binned"]["cc"][0]
+
+
+def test_calc_stats_sweep():
+    cs, merged, half1, half2 = make_data()
+    table = build_reflection_table(cs, merged, half1, half2, n_bins=5)
+    with contextlib.redirect_stdout(io.StringIO()):
+        sweep = calc_stats_sweep(table, [5.0, 8.0, 4.5], cc_min=-1)
+    assert sweep["sweep"]["d_min_cutoff"] == [8.0, 5.0, 4.5]
+    assert sweep["suggested_d_min"] == 4.5
+    # the same overall values as with the cutoff applied while loading the data
+    for i, d_min in enumerate(sweep["sweep"]["d_min_cutoff"]):
+        table_cut = build_reflection_table(cs, merged, half1, half2, d_min=d_min, n_bins=5)
+        with contextlib.redirect_stdout(io.StringIO()):
+            overall = {**calc_stats_merged(table_cut)["overall"],
+                       **calc_stats_compare(table_cut)["overall"]}
+        for key, value in overall.items():
+            assert abs(sweep["sweep"][key][i] - value) <= 0.001 + 1e-9, (d_min, key)
@@ -0,0 +1,129 @@
+import contextlib
+import csv
+import datetime
+import io
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+import pytest
+from import_serial.import_serial import run
+from import_serial.results_db import add_run, parse_time, query_runs, run_results
+from synthetic import write_dataset
+from test_crystal_stats import CELL
+
+
+def run_stats(cc, n_bins=3):
+    keys = ("d_max", "d_min", "n_obs", "n_unique", "completeness", "multiplicity",
+            "I", "IsigI", "cc", "CCstar", "rsplit")
+    overall = {key: 1.0 for key in keys}
+    overall.update(cc=cc, n_obs=1000)
+    binned = {key: [float(i) for i in range(n_bins)] for key in keys}
+    binned["cc"] = [cc + 0.1 * (n_bins - i) for i in range(n_bins)]
+    performance = {"stages": {"parse": {"wall_s": 0.5, "cpu_s": 0.4, "peak_rss_mb": 100.0}},
+                   "total": {"wall_s": 1.5, "cpu_s": 1.2, "peak_rss_mb": 120.0}}
+    return {"overall": overall, "binned": binned, "performance": performance}
+
+
+def add_runs(path, project, n):
+    return [add_run(path, run_stats(0.5), {"project": project, "dataset": str(i)})
+            for i in range(n)]
+
+
+def test_results_db(tmp_path):
+    path = str(tmp_path / "results.db")
+    add_run(path, run_stats(0.9), {"project": "a", "dataset": "01", "spacegroup": "P 1 21 1",
+                                   "cell": [39.4, 78.5, 48.0, 90, 97.94, 90],
+                                   "inputs": {"/data/a.hkl": "0123"}})
+    add_run(path, run_stats(0.8, n_bins=2), {"project": "b", "dataset": "01"})
+    add_run(path, run_stats(0.7), {"project": "a", "dataset": "02"})
+
+    rows = query_runs(path)
+    assert [row["cc_half"] for row in rows] == [0.9, 0.8, 0.7]
+    assert rows[0]["cell"] == "39.4 78.5 48 90 97.94 90"
+    assert json.loads(rows[0]["inputs"]) == {"/data/a.hkl": "0123"}
+    assert rows[0]["n_obs"] == 1000 and isinstance(rows[0]["n_obs"], int)
+    assert rows[0]["wall_s"] == 1.5
+    assert [row["dataset"] for row in query_runs(path, project="a")] == ["01", "02"]
+    assert [row["cc_half"] for row in query_runs(path, project="a", dataset="02")] == [0.7]
+    # the outer shell is the last bin of each run
+    outer = query_runs(path, shell="outer")
+    assert [(row["bin"], row["cc_half"]) for row in outer] == [
+        (2, pytest.approx(1.0)), (1, pytest.approx(0.9)), (2, pytest.approx(0.8))]
+    assert len(query_runs(path, shell="bins")) == 8
+    assert [row["cc_half"] for row in query_runs(path, limit=2)] == [0.8, 0.7]
+    assert [row["bin"] for row in query_runs(path, shell="bins", limit=1)] == [0, 1, 2]
+    assert query_runs(path, since=time.time() + 3600) == []
+    assert len(query_runs(path, since=parse_time("today"), until=parse_time("1h") + 7200)) == 3
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM stages").fetchone()[0] == 3
+        plan = " ".join(row[-1] for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM runs WHERE project = 'a' AND dataset = '01' "
+            "AND time >= 0"))
+        assert "runs_project_dataset_time" in plan
+
+    output = str(tmp_path / "outer.csv")
+    with contextlib.redirect_stderr(io.StringIO()):
+        run_results([path, "--project", "a", "--since", "today", "--shell", "outer",
+                     "-o", output])
+    with open(output) as f:
+        rows = list(csv.DictReader(f))
+    assert [(row["dataset"], float(row["cc_half"])) for row in rows] == [
+        ("01", pytest.approx(1.0)), ("02", pytest.approx(0.8))]
+    with contextlib.redirect_stdout(io.StringIO()) as stdout:
+        run_results([path, "--last", "1", "--format", "json"])
+    rows = json.loads(stdout.getvalue())
+    assert len(rows) == 1 and rows[0]["dataset"] == "02"
+    with pytest.raises(SystemExit):
+        with contextlib.redirect_stderr(io.StringIO()):
+            run_results([str(tmp_path / "missing.db")])
+
+
+def test_parse_time():
+    now = datetime.datetime(2024, 5, 2, 15, 30)
+    assert parse_time("today", now) == datetime.datetime(2024, 5, 2).timestamp()
+    assert parse_time("yesterday", now) == datetime.datetime(2024, 5, 1).timestamp()
+    assert parse_time("12h", now) == datetime.datetime(2024, 5, 2, 3, 30).timestamp()
+    assert parse_time("2024-04-30 14:00", now) == datetime.datetime(2024, 4, 30, 14).timestamp()
+    with pytest.raises(ValueError):
+        parse_time("last week", now)
+
+
+def test_concurrent_writers(tmp_path):
+    path = str(tmp_path / "results.db")
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(add_runs, path, f"p{i}", 10) for i in range(4)]
+        ids = [run_id for future in futures for run_id in future.result()]
+    assert sorted(ids) == list(range(1, 41))
+    rows = query_runs(path, shell="bins")
+    assert len(rows) == 40 * 3
+    for i in range(4):
+        assert len(query_runs(path, project=f"p{i}")) == 10
+
+
+def test_run_results_db(tmp_path):
+    files = write_dataset(str(tmp_path), "P21", CELL, d_min=3.0, stream_chunks=20, mtz=False)
+    path = str(tmp_path / "results.db")
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            run(["--hklin", files["hkl"], "--spacegroup", "P21", "--cell"] + [str(p) for p in CELL]
+                + ["--wavelength", "1.0", "--project", "test", "--dataset", "01",
+                   "--nbins", "5", "--dmin", "3.2", "--results-db", path])
+    finally:
+        os.chdir(cwd)
+    assert "Results saved to the database" in stdout.getvalue()
+    with open(tmp_path / "test_01.json") as f:
+        stats = json.load(f)
+    [row] = query_runs(path, project="test", dataset="01", shell="outer")
+    assert row["bin"] == 4 and row["n_bins"] == 5
+    assert row["cc_half"] == stats["binned"]["cc"][-1]
+    assert row["d_min_cutoff"] == 3.2 and row["d_max_cutoff"] is None
+    assert row["spacegroup"] == "P 1 21 1" and row["wavelength"] == 1.0
+    assert sorted(json.loads(row["inputs"])) == sorted(
+        os.path.abspath(files[name]) for name in ("hkl", "hkl1", "hkl2"))
+    [row] = query_runs(path)
+    assert row["cc_half"] == stats["overall"]["cc"]
+    assert row["wall_s"] > 0
@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+import pytest
+
+
+# modules imported only after the arguments are validated
+HEAVY_MODULES = ("numpy", "pandas", "scipy", "cctbx", "iotbx", "scitbx", "boost_adaptbx",
+                 "sqlite3", "multiprocessing")
+
+
+def import_times(args, cwd):
+    """Imported modules and their import times (self, cumulative) in seconds
+    reported by `python -X importtime -m import_serial ARGS`."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+        + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "import_serial"] + args,
+        cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="utf-8")
+    times = {}
+    for line in p.stderr.splitlines():
+        if line.startswith("import time:") and "self [us]" not in line:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            times[name.strip()] = (int(self_us) / 1e6, int(cumulative_us) / 1e6)
+    return p, times
+
+
+def import_report(times, n=15):
+    """Modules with the longest cumulative import time."""
+    lines = [f"{'self/s':>8} {'cumul/s':>8}  module"]
+    for name, (t_self, t_cumulative) in sorted(times.items(), key=lambda x: -x[1][1])[:n]:
+        lines.append(f"{t_self:8.3f} {t_cumulative:8.3f}  {name}")
+    return "\n".join(lines)
+
+
+@pytest.mark.parametrize("args", [["--help"], ["--hklin", "missing.hkl"]])
+def test_startup(tmp_path, args):
+    p, times = import_times(args, str(tmp_path))
+    assert "usage" in p.stdout or "does not exist" in p.stderr
+    report = import_report(times)
+    print(report)
+    heavy = [name for name in times if name.split(".")[0] in HEAVY_MODULES]
+    assert not heavy, "Heavy modules imported before validation of arguments:\n" + report
@@ -0,0 +1,180 @@
+import pytest
+import os
+import statistics
+from import_serial.stream import scan_streamfile, scan_stream, open_stream, split_stream, \
+    build_stream_index, get_stream_index, load_stream_index, StreamFollower, ValueHistogram, STREAM_INDEX_SUFFIX
+
+
+STREAM_HEADER = """CrystFEL stream format 2.3
+Generated by CrystFEL 0.10.2
+----- Begin geometry file -----
+photon_energy = 9500
+----- End geometry file -----
+"""
+CELLS = [
+    (3.94, 7.85, 4.80, 90.0, 97.94, 90.0),
+    (3.95, 7.86, 4.81, 90.0, 97.90, 90.0),
+    (3.93, 7.84, 4.79, 90.0, 97.98, 90.0),
+]
+ENERGIES = [9500.0, 9499.5, 9500.0, 9501.25]
+
+
+def stream_text(cells=CELLS, energies=ENERGIES):
+    text = STREAM_HEADER
+    for i, energy in enumerate(energies):
+        text += "----- Begin chunk -----\n"
+        text += f"Image filename: /data/run.h5\nEvent: //{i}\n"
+        text += f"photon_energy_eV = {energy:f}\n"
+        if i < len(cells):
+            text += "--- Begin crystal\n"
+            text += "Cell parameters %.5f %.5f %.5f nm, %.5f %.5f %.5f deg\n" % cells[i]
+            text += "Reflections measured after indexing\n"
+            text += "   h    k    l          I   sigma(I)       peak background  fs/px  ss/px panel\n"
+            text += "   1    2    3     100.00      10.00     150.00      50.00  100.0  200.0 p0\n"
+            text += "End of reflections\n--- End crystal\n"
+        text += "----- End chunk -----\n"
+    return text
+
+
+@pytest.fixture
+def streamfile(tmp_path):
+    path = tmp_path / "data.stream"
+    path.write_text(stream_text())
+    return str(path)
+
+
+def test_scan_streamfile(streamfile, tmp_path):
+    summary = scan_streamfile(streamfile)
+    assert summary.n_cells == len(CELLS)
+    for i, value in enumerate(summary.mean_cell()):
+        assert value == pytest.approx(statistics.mean(c[i] for c in CELLS))
+    for i, value in enumerate(summary.median_cell()):
+        assert value == pytest.approx(statistics.median(c[i] for c in CELLS))
+    assert summary.median_energy() == statistics.median(ENERGIES)
+    assert [p.name for p in tmp_path.iterdir()] == ["data.stream"]
+
+
+def test_scan_stream_windows(streamfile):
+    mm = open_stream(streamfile)
+    whole = scan_stream(mm)
+    small_windows = scan_stream(mm, window=64)
+    assert small_windows.n_cells == whole.n_cells
+    assert small_windows.cell_sums == whole.cell_sums
+    assert small_windows.energies == whole.energies
+    mm.close()
+
+
+def test_scan_streamfile_empty(tmp_path):
+    path = tmp_path / "empty.stream"
+    path.write_text("")
+    summary = scan_streamfile(str(path))
+    assert summary.mean_cell() is None
+    assert summary.median_energy() is None
+
+
+def test_scan_streamfile_parallel(tmp_path):
+    path = tmp_path / "data.stream"
+    energies = [9500.0 + (i % 7) * 0.25 for i in range(200)]
+    cells = [(3.94 + i * 1e-5, 7.85, 4.80 - i * 1e-5, 90.0, 97.94, 90.0) for i in range(150)]
+    path.write_text(stream_text(cells, energies))
+    mm = open_stream(str(path))
+    parts = split_stream(mm, 8)
+    assert len(parts) == 8
+    for start, end in parts[1:]:
+        assert mm[start:end].startswith(b"----- Begin chunk -----\n")
+    mm.close()
+    serial = scan_streamfile(str(path))
+    parallel = scan_streamfile(str(path), nproc=3)
+    assert parallel.n_cells == serial.n_cells == len(cells)
+    assert parallel.cell_sums == serial.cell_sums
+    assert parallel.mean_cell() == serial.mean_cell()
+    assert parallel.median_energy() == serial.median_energy() == statistics.median(energies)
+    # cell histograms have a fixed resolution (0.001 A), not one bin per crystal
+    assert parallel.cell_values == serial.cell_values
+    assert len(serial.cell_values[0].counts) == 16
+    assert serial.median_cell()[0] == pytest.approx(statistics.median(c[0] for c in cells), abs=1e-4)
+
+
+
+def test_stream_index_parallel(tmp_path):
+    path = tmp_path / "data.stream"
+    energies = [9500.0] * 120
+    text = stream_text(CELLS * 30, energies)
+    # images of 7 files, each file in several parts of the stream file
+    chunks = text.split("/data/run.h5")
+    text = chunks[0] + "".join(f"/data/run{i % 7}.h5" + chunk
+                               for i, chunk in enumerate(chunks[1:]))
+    path.write_text(text)
+    serial = build_stream_index(str(path))
+    parallel = build_stream_index(str(path), nproc=3)
+    assert parallel.filenames == serial.filenames == [b"/data/run%d.h5" % i for i in range(7)]
+    assert (parallel.chunks["file"] == serial.chunks["file"]).all()
+    assert [parallel.image(i)[0] for i in range(8)] == [f"/data/run{i % 7}.h5" for i in range(8)]
+
+def test_value_histogram(tmp_path):
+    histogram = ValueHistogram(100)
+    histogram.add([9500.0, 9499.5, float("nan")])
+    histogram.add_value(9501.25)
+    histogram.add_value(9500.0)
+    assert histogram.n == 4
+    assert histogram.median() == statistics.median(ENERGIES)
+    # the size depends on the spread of the values, not on their number
+    path = tmp_path / "data.stream"
+    energies = [9500.0 + i * 1e-5 for i in range(400)]
+    path.write_text(stream_text([], energies))
+    summary = scan_streamfile(str(path))
+    assert summary.energies.n == 400 and len(summary.energies.counts) == 1
+    assert summary.median_energy() == 9500.0
+
+
+def test_stream_index(streamfile, tmp_path):
+    index = get_stream_index(streamfile, cache_dir=str(tmp_path / "cache"))
+    assert os.path.isfile(streamfile + STREAM_INDEX_SUFFIX)
+    summary = scan_streamfile(streamfile)
+    assert index.n_chunks() == len(ENERGIES)
+    assert index.n_crystals() == len(CELLS)
+    assert index.summary.cell_sums == summary.cell_sums
+    assert index.summary.energies == summary.energies
+    assert index.image(1) == ("/data/run.h5", "//1")
+    assert index.read_chunk(2).startswith(b"----- Begin chunk -----\nImage filename")
+    assert index.read_chunk(2).endswith(b"----- End chunk -----\n")
+    loaded = load_stream_index(streamfile)
+    assert loaded is not None
+    assert loaded.summary.mean_cell() == summary.mean_cell()
+    assert loaded.summary.median_energy() == summary.median_energy()
+    assert loaded.summary.median_cell() == summary.median_cell()
+    assert (loaded.crystals["cell"] == index.crystals["cell"]).all()
+    # the index is not used if the stream file changes
+    with open(streamfile, "a") as f:
+        f.write(stream_text(CELLS[:1], ENERGIES[:1])[len(STREAM_HEADER):])
+    assert load_stream_index(streamfile) is None
+    assert get_stream_index(streamfile).n_crystals() == len(CELLS) + 1
+
+
+def test_stream_follower(tmp_path):
+    path = tmp_path / "data.stream"
+    energies = [9500.0 + (i % 3) * 0.5 for i in range(30)]
+    cells = [(3.94 + (i % 5) * 1e-3, 7.85, 4.80, 90.0, 97.94 + i * 0.01, 90.0) for i in range(20)]
+    text = stream_text(cells, energies)
+    follower = StreamFollower(str(path))
+    assert follower.update().n_cells == 0  # the file does not exist yet
+    # the file is written in pieces that end in the middle of chunks and lines
+    pieces = [0, 500, 1234, 1235, 3000, len(text) - 10, len(text)]
+    for written_start, written_end in zip(pieces[:-1], pieces[1:]):
+        with open(path, "a") as f:
+            f.write(text[written_start:written_end])
+        follower.update()
+        assert follower.offset <= written_end
+        assert follower.offset == 0 or text[:follower.offset].endswith("----- End chunk -----\n")
+        assert follower.summary.n_cells == text[:follower.offset].count("Cell parameters")
+    assert follower.offset == len(text)
+    summary = scan_streamfile(str(path))
+    assert follower.summary.cell_sums == summary.cell_sums
+    assert follower.summary.energies == summary.energies
+    assert follower.summary.median_cell() == summary.median_cell()
+    assert follower.update().n_cells == 0
+    # a rewritten file is parsed again from the beginning
+    path.write_text(stream_text(CELLS, ENERGIES))
+    follower.update()
+    assert follower.n_restarts == 1
+    assert follower.summary.n_cells == len(CELLS)
@@ -0,0 +1,90 @@
+import contextlib
+import io
+import json
+import os
+import numpy as np
+import pytest
+from cctbx import crystal, sgtbx
+from import_serial.cache import file_fingerprint
+from import_serial.import_serial import run, stats_cache_key
+from import_serial.stream import build_stream_index, stream_file_id
+from import_serial.stream_merge import STREAM_SPLIT_SEED, merge_stream_halves, split_crystals
+from synthetic import write_dataset
+from test_crystal_stats import CELL, crystal_text, write_stream
+
+
+def test_split_crystals():
+    halves = split_crystals(1001)
+    assert np.count_nonzero(halves == 0) == 501
+    assert np.array_equal(halves, split_crystals(1001))
+    assert not np.array_equal(halves, split_crystals(1001, seed=1))
+
+
+def test_merge_stream_halves(tmp_path):
+    # (-1 2 -3) is equivalent to (1 2 3) in P21, (1 -2 3) is its Friedel mate
+    crystals = [
+        [(1, 2, 3, 10.0, 2.0), (-1, 2, -3, 20.0, 2.0), (0, 0, 2, 5.0, 1.0)],
+        [(1, -2, 3, 30.0, 4.0)],
+        [(0, 0, 2, 7.0, 1.0), (0, 0, 0, 1.0, 1.0)],
+        [(2, 0, 0, 3.0, 1.0)],
+    ]
+    streamfile = str(tmp_path / "test.stream")
+    write_stream(streamfile, [crystal_text(rows) for rows in crystals] + [crystal_text(None)])
+    index = build_stream_index(streamfile)
+    half1, half2, n_crystals = merge_stream_halves(index, sgtbx.space_group_info("P21"))
+    halves = split_crystals(5)
+    assert n_crystals == [3, 2]
+
+    for i, half in enumerate((half1, half2)):
+        sums = {}
+        for c in np.flatnonzero(halves[:4] == i):
+            for h, k, l, intensity, sigma in crystals[c]:
+                if (h, k, l) == (0, 0, 0):
+                    continue
+                key = (abs(h), abs(k), abs(l))
+                values = sums.setdefault(key, [0, 0, 0])
+                values[0] += intensity
+                values[1] += sigma ** 2
+                values[2] += 1
+        merged = {(h, k, l): (intensity, sigma, n) for h, k, l, intensity, sigma, n in zip(
+            half["h"], half["k"], half["l"], half["I"], half["sigma(I)"], half["nmeas"])}
+        assert {tuple(abs(x) for x in hkl) for hkl in merged} == set(sums)
+        for hkl, (intensity, sigma, n) in merged.items():
+            s = sums[tuple(abs(x) for x in hkl)]
+            assert intensity == pytest.approx(s[0] / s[2])
+            assert sigma == pytest.approx(np.sqrt(s[1]) / s[2])
+            assert n == s[2]
+
+    parallel = merge_stream_halves(index, sgtbx.space_group_info("P21"), nproc=2)
+    for half, half_parallel in zip((half1, half2), parallel):
+        for name in half:
+            assert half_parallel[name] == pytest.approx(half[name])
+
+
+def test_run_stream_halves(tmp_path):
+    files = write_dataset(str(tmp_path), "P21", CELL, d_min=3.0, stream_chunks=100, mtz=False)
+    os.remove(files["hkl1"])
+    os.remove(files["hkl2"])
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            run(["--hklin", files["hkl"], "--spacegroup", "P21", "--streamfile", files["stream"],
+                 "--stream-halves"])
+    finally:
+        os.chdir(cwd)
+    assert "Half-data sets were merged from the stream file" in stdout.getvalue()
+    with open(tmp_path / "project_dataset.json") as f:
+        result = json.load(f)
+    assert 0.5 < result["overall"]["cc"] <= 1
+    assert result["overall"]["rsplit"] > 0
+    assert "stream_merge" in result["performance"]["stages"]
+
+
+def test_stats_cache_key_stream_halves(tmp_path):
+    files = write_dataset(str(tmp_path), "P21", CELL, d_min=3.0, stream_chunks=10, mtz=False)
+    cs = crystal.symmetry(unit_cell=CELL, space_group_symbol="P21")
+    key = stats_cache_key(files["hkl"], None, cs, 0, 0, 10, files["stream"])
+    assert key[:3] == (file_fingerprint(files["hkl"]), stream_file_id(files["stream"]),
+                       STREAM_SPLIT_SEED)
+    assert key != stats_cache_key(files["hkl"], None, cs, 0, 0, 10)
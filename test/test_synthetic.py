@@ -0,0 +1,96 @@
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pytest
+import import_serial.import_serial
+from import_serial.api import compute_statistics
+from import_serial.import_serial import run
+from import_serial.stream import scan_streamfile
+from synthetic import write_dataset
+
+
+CELL = (39.4, 78.5, 48.0, 90, 97.94, 90)
+
+
+def test_synthetic_dataset(tmp_path):
+    files = write_dataset(str(tmp_path), "P21", CELL, d_min=3.0, stream_chunks=50)
+    assert sorted(files) == ["hkl", "hkl1", "hkl2", "mtz", "stream"]
+    summary = scan_streamfile(files["stream"])
+    assert summary.n_cells > 0
+    cell = [float(s) / summary.n_cells for s in summary.cell_sums]
+    assert np.allclose(np.array(cell[:3]) * 10, CELL[:3], rtol=0.01)
+    crystfel = compute_statistics(files["hkl"], symmetry=("P21", CELL), n_bins=5)
+    xia2 = compute_statistics(files["mtz"], n_bins=5)
+    assert xia2.hklin_format == "dials"
+    assert crystfel.overall["n_unique"] == xia2.overall["n_unique"]
+    assert crystfel.overall["cc"] > 0.9
+
+
+def test_run_stream_concurrent(tmp_path):
+    # reading of the reflection files overlaps with the scan of the stream
+    # file, --profile runs the stages one after another
+    files = write_dataset(str(tmp_path), "P21", CELL, d_min=3.0, stream_chunks=50, mtz=False)
+    results = []
+    for option in ([], ["--profile"]):
+        outdir = tmp_path / f"run{len(results)}"
+        outdir.mkdir()
+        cwd = os.getcwd()
+        os.chdir(outdir)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                run(["--hklin", files["hkl"], "--spacegroup", "P21", "--streamfile", files["stream"]]
+                    + option)
+        finally:
+            os.chdir(cwd)
+        with open(outdir / "project_dataset.json") as f:
+            results.append(json.load(f))
+    for stats in results:
+        assert {"stream_scan", "parse", "binning"} <= set(stats.pop("performance")["stages"])
+    assert results[0] == results[1]
+
+
+def slow_summarize_stream(streamfile, nproc=1, *args):
+    if nproc > 1:  # in a thread that waits for a pool of processes
+        with ProcessPoolExecutor(max_workers=nproc) as executor:
+            executor.submit(time.sleep, 60).result()
+    else:
+        time.sleep(60)
+
+
+def failing_summarize_stream(*args):
+    raise ValueError("broken chunk")
+
+
+@pytest.mark.parametrize("nproc", ["1", "2"])
+def test_run_abort_stream_job(tmp_path, monkeypatch, nproc):
+    files = write_dataset(str(tmp_path), "P21", CELL, d_min=3.0, stream_chunks=10, mtz=False)
+    monkeypatch.setattr(import_serial.import_serial, "summarize_stream", slow_summarize_stream)
+    # the space group is missing, the scan of the stream file is stopped
+    start = time.perf_counter()
+    stderr = io.StringIO()
+    with pytest.raises(SystemExit) as e:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(stderr):
+            run(["--hklin", files["hkl"], "--cell"] + [str(p) for p in CELL]
+                + ["--streamfile", files["stream"], "--nproc", nproc])
+    assert e.value.code == 1
+    assert "ERROR: Space group was not specified" in stderr.getvalue()
+    assert time.perf_counter() - start < 30
+    assert multiprocessing.active_children() == []
+
+
+def test_run_stream_job_error(tmp_path, monkeypatch):
+    files = write_dataset(str(tmp_path), "P21", CELL, d_min=3.0, stream_chunks=10, mtz=False)
+    monkeypatch.setattr(import_serial.import_serial, "summarize_stream", failing_summarize_stream)
+    stderr = io.StringIO()
+    with pytest.raises(SystemExit) as e:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(stderr):
+            run(["--hklin", files["hkl"], "--spacegroup", "P21", "--streamfile", files["stream"]])
+    assert e.value.code == 1
+    assert stderr.getvalue().endswith(
+        f"ERROR: Stream file {files['stream']} could not be read: ValueError: broken chunk\n"
+        "Aborting.\n")
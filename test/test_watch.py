@@ -0,0 +1,93 @@
+import json
+import os
+from import_serial.api import compute_statistics
+from import_serial.cli import get_parser
+from import_serial.watch import Watcher, file_complete
+from synthetic import crystal_symmetry, merged_data, half_data, write_hkl, write_dataset
+
+
+CELL = (39.4, 78.5, 48.0, 90, 97.94, 90)
+
+
+def read_stats(path):
+    with open(path) as f:
+        stats = json.load(f)
+    stats.pop("performance")
+    return stats
+
+
+def expected_stats(hklin):
+    result = compute_statistics(hklin, symmetry=("P21", CELL), n_bins=5)
+    return {key: value for key, value in result.stats.items() if key != "performance"}
+
+
+def test_watch_crystfel(tmp_path):
+    cs = crystal_symmetry("P21", CELL)
+    merged = merged_data(cs, d_min=3.0)
+    hklin = str(tmp_path / "data.hkl")
+    write_hkl(hklin, merged)
+    half1 = half_data(merged, seed=1)
+    write_hkl(hklin + "1", half1)
+    write_hkl(hklin + "2", half_data(merged, seed=2))
+    args = get_parser().parse_args(
+        ["--hklin", hklin, "--spacegroup", "P21", "--cell"] + [str(p) for p in CELL]
+        + ["--wavelength", "1", "--nbins", "5"])
+    outdir = tmp_path / "out"
+    outdir.mkdir()
+    watcher = Watcher(args, str(outdir), settle=0)
+    jsonout = str(outdir / "project_dataset.json")
+    [(dataset, result, latency)] = watcher.poll()
+    assert not result["reused"]["table"]
+    assert read_stats(jsonout) == expected_stats(hklin)
+    assert os.path.isfile(outdir / "project_dataset.mtz")
+    assert watcher.poll() == []
+
+    # a partially written file is not read
+    with open(hklin + "1", "w") as f:
+        f.write("CrystFEL reflection list version 2.0\n")
+    assert not file_complete(hklin + "1")
+    assert watcher.poll() == []
+    # the same reflections with other values: the table and the statistics
+    # of the merged data set are reused
+    half1["I"] = half1["I"] * 0.8 + 10
+    write_hkl(hklin + "1", half1)
+    [(dataset, result, latency)] = watcher.poll()
+    assert result["changed"] == [hklin + "1"]
+    assert result["reused"] == {"table": True, "stats_merged": True, "stats_compare": False}
+    assert read_stats(jsonout) == expected_stats(hklin)
+    merged["I"] = merged["I"] * 1.5
+    write_hkl(hklin, merged)
+    [(dataset, result, latency)] = watcher.poll()
+    assert result["reused"] == {"table": True, "stats_merged": False, "stats_compare": True}
+    assert read_stats(jsonout) == expected_stats(hklin)
+    # other reflections: the table is built again
+    write_hkl(hklin + "2", half_data(merged, seed=4, missing=0.1))
+    [(dataset, result, latency)] = watcher.poll()
+    assert not result["reused"]["table"]
+    assert read_stats(jsonout) == expected_stats(hklin)
+    assert [p.name for p in outdir.iterdir() if p.name.endswith(".tmp")] == []
+
+
+def test_watch_mtz_dir(tmp_path):
+    hklin_dir = tmp_path / "merged"
+    write_dataset(str(hklin_dir), "P21", CELL, d_min=3.0)
+    for name in os.listdir(hklin_dir):
+        if not name.endswith(".mtz"):
+            os.remove(hklin_dir / name)
+    parser = get_parser()
+    for action in parser._actions:
+        if action.dest == "hklin":
+            action.required = False
+    args = parser.parse_args(["--nbins", "5"])
+    outdir = tmp_path / "out"
+    outdir.mkdir()
+    watcher = Watcher(args, str(outdir), str(hklin_dir), settle=0)
+    [(dataset, result, latency)] = watcher.poll()
+    [name] = os.listdir(hklin_dir)
+    stem = os.path.splitext(name)[0]
+    result = compute_statistics(str(hklin_dir / name), n_bins=5)
+    assert read_stats(outdir / f"{stem}.json") == {
+        key: value for key, value in result.stats.items() if key != "performance"}
+    assert os.path.isfile(outdir / f"{stem}.xml")
+    assert os.path.isfile(outdir / f"{stem}.mtz")
+    assert watcher.poll() == []